@@ -1,21 +1,45 @@
-from langchain_openai import ChatOpenAI
 from langchain_core.messages import SystemMessage, HumanMessage
-from langgraph.prebuilt import create_react_agent
 from dotenv import load_dotenv
 import os
+import threading
+import time
+from services.rate_limiter import call_with_retry, estimate_tokens
+from services.usage import usage_tracker, usage_scope
+from agent.memory import get_budgeter
+from agent.streaming import ResponseSink, SentenceBuffer
+from typing import Iterator, Optional
 
 # 1 - Carregando api-key
 load_dotenv()
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 
-# 2 - Definindo modelo de IA
-model = ChatOpenAI(
-    model='gpt-4o',
-    api_key=OPENAI_API_KEY,
-    temperature=0.7
-)
+# 2 - Definindo modelo de IA (criado no primeiro uso, junto com o agent)
+_model = None
+_agent = None
+_agent_lock = threading.Lock()
+
+
+def get_model():
+    # max_retries=0: as novas tentativas passam pelo limitador compartilhado
+    # stream_usage=True: o streaming também traz a contagem de tokens
+    global _model
+    if _model is None:
+        with _agent_lock:
+            if _model is None:
+                from langchain_openai import ChatOpenAI
+                _model = ChatOpenAI(
+                    model='gpt-4o',
+                    api_key=OPENAI_API_KEY, #type: ignore
+                    temperature=0.7,
+                    max_retries=0,
+                    stream_usage=True
+                )
+    return _model
 
 # 3 - Definindo prompt do agent
+# O prompt é fixo (nada de data, nome ou dados da sessão aqui dentro): junto
+# com as tools ele forma o prefixo igual em todas as chamadas, que a OpenAI
+# reaproveita do cache. Tudo que muda por sessão vai depois dele.
 system_prompt = """
 Você é um assistente virtual da clínica Itech360, responsável por auxiliar os pacientes no agendamento de consultas e na coleta de informações necessárias para o processo de pagamento. Seu objetivo é entender os sintomas, recomendar o especialista adequado, verificar disponibilidade e registrar os dados do paciente para futura confirmação da consulta.
 
@@ -58,43 +82,80 @@ Regras:
 tools = []  # Adicione suas ferramentas aqui: [consultar_medico, disponibilidadeOuReservar, etc.]
 
 # 5 - Criando o agent
-agent = create_react_agent(
-    model=model,
-    tools=tools
-)
+def get_agent():
+    global _agent
+    if _agent is None:
+        model = get_model()
+        with _agent_lock:
+            if _agent is None:
+                from langgraph.prebuilt import create_react_agent
+                _agent = create_react_agent(
+                    model=model,
+                    tools=tools
+                )
+    return _agent
 
 # 6 - Função para usar o agent
-def run_agent(user_input: str, config=None):
+def _initial_state(user_input: str, session_id=None):
+    """Monta as mensagens de entrada; retorna (budgeter ou None, estado)"""
+    budgeter = get_budgeter() if session_id else None
+    history = budgeter.context(session_id) if budgeter else []
+
+    # Ordem pensada para o cache de prefixo: system prompt fixo (+ tools),
+    # resumo da sessão, últimos turnos e, por fim, a mensagem nova
+    return budgeter, {
+        "messages": [
+            SystemMessage(content=system_prompt),
+            *history,
+            HumanMessage(content=user_input)
+        ]
+    }
+
+
+def run_agent(user_input: str, config=None, session_id=None):
     """
     Executa o agent com uma entrada do usuário
     
     Args:
         user_input: Mensagem do usuário
         config: Configuração adicional (opcional)
+        session_id: Sessão do paciente (Supabase). Quando informado, o prompt
+            inclui o resumo e os últimos turnos da conversa, e o turno atual
+            é gravado no histórico
     
     Returns:
         Resposta do agent
     """
     try:
-        # Estado inicial com system prompt e mensagem do usuário
-        initial_state = {
-            "messages": [
-                SystemMessage(content=system_prompt),
-                HumanMessage(content=user_input)
-            ]
-        }
+        budgeter, initial_state = _initial_state(user_input, session_id)
+        prompt_tokens = sum(estimate_tokens(str(m.content)) for m in initial_state["messages"])
         
-        # Executa o agent
-        result = agent.invoke(initial_state, config=config)
+        def invoke():
+            started = time.monotonic()
+            result = get_agent().invoke(initial_state, config=config)
+            # Só as mensagens geradas nesta execução têm uso de tokens a contar
+            usage_tracker.record_messages(
+                'gpt-4o', result["messages"][len(initial_state["messages"]):],
+                time.monotonic() - started
+            )
+            return result
+
+        # Executa o agent (respeitando o limite de requisições/tokens do gpt-4o)
+        with usage_scope(node='agent', session_id=session_id):
+            result = call_with_retry('gpt-4o', invoke, estimated_tokens=prompt_tokens)
         
         # Retorna a última mensagem do agent
         if result and "messages" in result and len(result["messages"]) > 0:
             last_message = result["messages"][-1]
             # Verifica se é uma mensagem do assistant
             if hasattr(last_message, 'content'):
-                return last_message.content
+                answer = last_message.content
             else:
-                return str(last_message)
+                answer = str(last_message)
+
+            if budgeter:
+                budgeter.record(session_id, user_input, str(answer)) #type: ignore
+            return answer
         else:
             return "Erro: Não foi possível processar a mensagem."
             
@@ -102,13 +163,88 @@ def run_agent(user_input: str, config=None):
         print(f"Erro detalhado: {str(e)}")
         return f"Erro ao executar agent: {str(e)}"
 
+def stream_agent(user_input: str, sink: Optional[ResponseSink] = None,
+                 config=None, session_id=None) -> Iterator[str]:
+    """
+    Variante em streaming do run_agent: gera os pedaços de texto conforme o
+    modelo responde. Frases completas vão para `sink.on_sentence` assim que
+    ficam prontas (ex.: ChatwootSink), e a resposta inteira para
+    `sink.on_complete`. O texto final é o mesmo que o run_agent devolveria.
+
+    Só a abertura do stream passa pelo call_with_retry: depois que o
+    primeiro pedaço chegou, refazer a chamada duplicaria o texto enviado.
+    """
+    sink = sink or ResponseSink()
+    budgeter, initial_state = _initial_state(user_input, session_id)
+    prompt_tokens = sum(estimate_tokens(str(m.content)) for m in initial_state["messages"])
+    buffer = SentenceBuffer()
+    # Texto por mensagem do modelo: a resposta final é a da última
+    texts = {}
+    usage = None
+    last_id = None
+    started = time.monotonic()
+
+    def open_stream():
+        stream = get_agent().stream(initial_state, config=config, stream_mode="messages")
+        return stream, next(stream, None)
+
+    try:
+        with usage_scope(node='agent', session_id=session_id):
+            stream, first = call_with_retry('gpt-4o', open_stream, estimated_tokens=prompt_tokens)
+            item = first
+            while item is not None:
+                chunk, metadata = item
+                if metadata.get("langgraph_node") == "agent":
+                    if getattr(chunk, 'usage_metadata', None):
+                        usage = chunk if usage is None else usage + chunk
+                    text = chunk.content if isinstance(chunk.content, str) else ""
+                    if text:
+                        if chunk.id != last_id:
+                            last_id = chunk.id
+                            texts[last_id] = ""
+                        texts[last_id] += text
+                        sink.on_token(text)
+                        for sentence in buffer.feed(text):
+                            sink.on_sentence(sentence)
+                        yield text
+                item = next(stream, None)
+
+            usage_tracker.record_messages('gpt-4o', [usage] if usage is not None else [],
+                                          time.monotonic() - started)
+    except Exception as e:
+        print(f"Erro no streaming do agent: {str(e)}")
+        sink.on_error(e)
+        raise
+
+    rest = buffer.flush()
+    if rest:
+        sink.on_sentence(rest)
+
+    answer = texts.get(last_id, "")
+    sink.on_complete(answer)
+    if budgeter:
+        budgeter.record(session_id, user_input, answer) #type: ignore
+    return answer
+
+
+def run_agent_streaming(user_input: str, sink: Optional[ResponseSink] = None,
+                        config=None, session_id=None) -> str:
+    """Consome o stream_agent e devolve a resposta completa"""
+    stream = stream_agent(user_input, sink=sink, config=config, session_id=session_id)
+    while True:
+        try:
+            next(stream)
+        except StopIteration as stop:
+            return stop.value
+
+
 # 7 - Função para uso no workflow principal
-def process_with_agent(message: str) -> str:
+def process_with_agent(message: str, session_id=None) -> str:
     """
     Processa mensagem usando o agent
     Para usar no main.py
     """
-    return run_agent(message)
+    return run_agent(message, session_id=session_id) #type: ignore
 
 # 8 - Teste do agent
 if __name__ == '__main__':
@@ -0,0 +1,209 @@
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import List, Optional, Tuple
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, SystemMessage
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Turnos (pergunta + resposta) sempre mantidos literalmente no prompt
+AGENT_HISTORY_TURNS = int(os.getenv("AGENT_HISTORY_TURNS", "6"))
+# Quantos turnos antigos acumular antes de gerar um novo resumo
+AGENT_SUMMARY_EVERY = int(os.getenv("AGENT_SUMMARY_EVERY", "4"))
+AGENT_SUMMARY_MODEL = os.getenv("AGENT_SUMMARY_MODEL", "gpt-4o-mini")
+
+_SUMMARY_PROMPT = """Você mantém o resumo de um atendimento da clínica Itech360.
+Atualize o resumo abaixo com as novas mensagens. Preserve dados do paciente
+(nome, e-mail, CPF, sintomas, especialidade, forma de pagamento, datas e
+horários combinados) e pendências. Responda só com o resumo, em até 150 palavras.
+
+Resumo atual:
+{summary}
+
+Novas mensagens:
+{messages}"""
+
+
+class ConversationStore():
+    """Histórico das conversas em SQLite (WAL), por session_id do Supabase"""
+
+    def __init__(self, db_path):
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.db_path), check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS turns (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                session_id TEXT NOT NULL,
+                role TEXT NOT NULL,
+                content TEXT NOT NULL,
+                created_at REAL NOT NULL
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_turns_session ON turns (session_id, id)")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS summaries (
+                session_id TEXT PRIMARY KEY,
+                summary TEXT NOT NULL,
+                summarized_upto INTEGER NOT NULL
+            )
+        """)
+
+    def append(self, session_id: str, role: str, content: str):
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO turns (session_id, role, content, created_at) VALUES (?, ?, ?, ?)",
+                (session_id, role, content, time.time())
+            )
+
+    def get_summary(self, session_id: str) -> Tuple[str, int]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT summary, summarized_upto FROM summaries WHERE session_id = ?", (session_id,)
+            ).fetchone()
+        return (row[0], row[1]) if row else ("", 0)
+
+    def turns_after(self, session_id: str, after_id: int) -> List[Tuple[int, str, str]]:
+        """Mensagens ainda não resumidas: (id, role, content) em ordem"""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT id, role, content FROM turns WHERE session_id = ? AND id > ? ORDER BY id",
+                (session_id, after_id)
+            ).fetchall()
+
+    def save_summary(self, session_id: str, summary: str, summarized_upto: int):
+        with self._lock:
+            self._conn.execute(
+                """INSERT INTO summaries (session_id, summary, summarized_upto) VALUES (?, ?, ?)
+                   ON CONFLICT(session_id) DO UPDATE SET summary = excluded.summary,
+                   summarized_upto = excluded.summarized_upto""",
+                (session_id, summary, summarized_upto)
+            )
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def _to_message(role: str, content: str) -> BaseMessage:
+    return HumanMessage(content=content) if role == 'user' else AIMessage(content=content)
+
+
+class ContextBudgeter():
+    """
+    Monta o contexto de cada chamada com tamanho limitado: resumo acumulado
+    + turnos literais ainda fora dele. Passando de `keep_turns` turnos, os
+    mais antigos são incorporados ao resumo em segundo plano, a cada
+    `summary_every` turnos, sem atrasar a resposta ao paciente; até lá eles
+    seguem literais, então o contexto fica entre `keep_turns` e
+    `keep_turns + summary_every` turnos.
+    """
+
+    def __init__(self, store: ConversationStore, keep_turns: int = AGENT_HISTORY_TURNS,
+                 summary_every: int = AGENT_SUMMARY_EVERY, summarizer=None):
+        self.store = store
+        self.keep_messages = keep_turns * 2
+        self.summary_every_messages = summary_every * 2
+        self._summarizer = summarizer
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='agent-summary')
+        self._pending = set()
+        self._pending_lock = threading.Lock()
+
+    def context(self, session_id: str) -> List[BaseMessage]:
+        """Mensagens de histórico para entrar no prompt (depois do system prompt)"""
+        summary, upto = self.store.get_summary(session_id)
+        # Todos os turnos depois do resumo: cortar nos últimos keep_turns
+        # deixaria de fora os que ainda esperam o próximo resumo
+        turns = self.store.turns_after(session_id, upto)
+
+        messages: List[BaseMessage] = []
+        if summary:
+            messages.append(SystemMessage(content=f"Resumo do atendimento até aqui:\n{summary}"))
+        messages.extend(_to_message(role, content) for _, role, content in turns)
+        return messages
+
+    def record(self, session_id: str, user_input: str, answer: str):
+        self.store.append(session_id, 'user', user_input)
+        self.store.append(session_id, 'assistant', answer)
+        self._maybe_summarize(session_id)
+
+    def _maybe_summarize(self, session_id: str):
+        _, upto = self.store.get_summary(session_id)
+        overflow = len(self.store.turns_after(session_id, upto)) - self.keep_messages
+        if overflow < self.summary_every_messages:
+            return
+        with self._pending_lock:
+            if session_id in self._pending:
+                return
+            self._pending.add(session_id)
+        self._executor.submit(self._summarize, session_id)
+
+    def _summarize(self, session_id: str):
+        try:
+            summary, upto = self.store.get_summary(session_id)
+            turns = self.store.turns_after(session_id, upto)
+            old_turns = turns[:len(turns) - self.keep_messages]
+            if not old_turns:
+                return
+
+            transcript = "\n".join(
+                f"{'Paciente' if role == 'user' else 'Assistente'}: {content}" for _, role, content in old_turns
+            )
+            new_summary = self._summarize_text(session_id, summary, transcript)
+            self.store.save_summary(session_id, new_summary, old_turns[-1][0])
+        except Exception as e:
+            print(f"Erro ao resumir conversa {session_id}: {e}")
+            with open('erros', 'a') as f:
+                f.write(f'Erro ao resumir conversa {session_id} {time.time()}: {str(e)}\n')
+        finally:
+            with self._pending_lock:
+                self._pending.discard(session_id)
+
+    def _summarize_text(self, session_id: str, summary: str, transcript: str) -> str:
+        from services.rate_limiter import call_with_retry, estimate_tokens
+        from services.usage import usage_tracker
+
+        if self._summarizer is None:
+            from langchain_openai import ChatOpenAI
+            self._summarizer = ChatOpenAI(
+                model=AGENT_SUMMARY_MODEL,
+                api_key=os.getenv("OPENAI_API_KEY"), #type: ignore
+                temperature=0,
+                max_retries=0
+            )
+
+        prompt = _SUMMARY_PROMPT.format(summary=summary or "(vazio)", messages=transcript)
+
+        def invoke():
+            with usage_tracker.timed(AGENT_SUMMARY_MODEL, node='agent_summary', session_id=session_id) as responses:
+                response = self._summarizer.invoke([HumanMessage(content=prompt)]) #type: ignore
+                responses.append(response)
+            return response
+
+        response = call_with_retry(AGENT_SUMMARY_MODEL, invoke, estimated_tokens=estimate_tokens(prompt))
+        return str(response.content).strip()
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
+
+
+_budgeter: Optional[ContextBudgeter] = None
+_budgeter_lock = threading.Lock()
+
+
+def get_budgeter() -> ContextBudgeter:
+    """ContextBudgeter do processo, com o banco em AGENT_MEMORY_DB"""
+    global _budgeter
+    if _budgeter is None:
+        with _budgeter_lock:
+            if _budgeter is None:
+                db_path = os.getenv("AGENT_MEMORY_DB", "conversation_storage/conversations.sqlite3")
+                _budgeter = ContextBudgeter(ConversationStore(db_path))
+    return _budgeter
@@ -0,0 +1,71 @@
+import os
+import re
+from typing import List, Optional
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Frases menores que isso esperam a próxima (evita mandar "Olá!" e "Dr." soltos)
+STREAM_MIN_SENTENCE_CHARS = int(os.getenv("STREAM_MIN_SENTENCE_CHARS", "40"))
+
+# Fim de frase: pontuação seguida de espaço, ou quebra de linha
+_SENTENCE_END = re.compile(r'(?<=[.!?…:])\s+|\n+')
+
+
+class ResponseSink():
+    """
+    Destino da resposta em streaming. Sobrescreva os métodos necessários:
+    - on_token: cada pedaço de texto gerado
+    - on_sentence: cada frase completa (para enviar ao paciente)
+    - on_complete: resposta final inteira
+    - on_error: falha no meio da geração
+    """
+
+    def on_token(self, text: str):
+        pass
+
+    def on_sentence(self, text: str):
+        pass
+
+    def on_complete(self, text: str):
+        pass
+
+    def on_error(self, error: Exception):
+        pass
+
+
+class SentenceBuffer():
+    """Junta os pedaços do streaming e libera frases completas"""
+
+    def __init__(self, min_chars: int = STREAM_MIN_SENTENCE_CHARS):
+        self.min_chars = min_chars
+        self._pending = ""
+
+    def feed(self, text: str) -> List[str]:
+        self._pending += text
+        sentences = []
+        start = 0
+        for match in _SENTENCE_END.finditer(self._pending):
+            candidate = self._pending[start:match.start()].strip()
+            # Quebra de linha sempre fecha o bloco; pontuação só acima do mínimo
+            if candidate and (len(candidate) >= self.min_chars or '\n' in match.group()):
+                sentences.append(candidate)
+                start = match.end()
+        self._pending = self._pending[start:]
+        return sentences
+
+    def flush(self) -> Optional[str]:
+        rest = self._pending.strip()
+        self._pending = ""
+        return rest or None
+
+
+class ChatwootSink(ResponseSink):
+    """Envia cada frase para a conversa do Chatwoot assim que ela fica pronta"""
+
+    def __init__(self, conversation_id):
+        self.conversation_id = conversation_id
+
+    def on_sentence(self, text: str):
+        from services.chatwoot import send_message
+        send_message(self.conversation_id, text)
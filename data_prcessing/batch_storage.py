@@ -0,0 +1,216 @@
+import json
+import sqlite3
+from abc import ABC, abstractmethod
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+from models.models import MessageRecord
+
+
+class BatchStorage(ABC):
+    """
+    Interface de armazenamento dos batches do MessageAccumulator. As
+    mensagens entram e saem como MessageRecord; serializar (se for preciso)
+    é com o backend.
+
+    - append: grava uma mensagem no batch da sessão (O(1))
+    - take: lê e remove, de forma atômica, todas as mensagens da sessão
+    - open_batches: sessões com mensagens pendentes, com o horário da primeira
+      mensagem, a quantidade de mensagens, o total de bytes e o telefone,
+      usado para recuperar batches após reinício
+    """
+
+    def prepare(self, message: MessageRecord):
+        """Trabalho pesado do append (ex.: gravar a mídia), chamado fora do lock do acumulador"""
+
+    @abstractmethod
+    def append(self, session_id: str, message: MessageRecord, received_at: float):
+        ...
+
+    @abstractmethod
+    def take(self, session_id: str) -> List[MessageRecord]:
+        ...
+
+    def discard(self, session_id: str):
+        self.take(session_id)
+
+    @abstractmethod
+    def open_batches(self) -> Dict[str, Tuple[float, int, int, Optional[str]]]:
+        ...
+
+    def close(self):
+        pass
+
+
+class MemoryBatchStorage(BatchStorage):
+    """Batches só em memória: rápido, mas perde mensagens se o processo cair"""
+
+    def __init__(self):
+        # Guarda os próprios MessageRecord, sem serializar
+        self._batches: Dict[str, List[MessageRecord]] = {}
+        self._started: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def append(self, session_id: str, message: MessageRecord, received_at: float):
+        with self._lock:
+            self._batches.setdefault(session_id, []).append(message)
+            self._started.setdefault(session_id, received_at)
+
+    def take(self, session_id: str) -> List[MessageRecord]:
+        with self._lock:
+            self._started.pop(session_id, None)
+            return self._batches.pop(session_id, [])
+
+    def open_batches(self) -> Dict[str, Tuple[float, int, int, Optional[str]]]:
+        with self._lock:
+            return {
+                session_id: (started_at, len(messages), sum(m.size for m in messages), messages[-1].telefone)
+                for session_id, started_at in self._started.items()
+                for messages in (self._batches[session_id],)
+            }
+
+
+class SQLiteBatchStorage(BatchStorage):
+    """
+    Batches em SQLite no modo WAL: cada mensagem é um INSERT (append-only) e
+    o fechamento do batch lê e apaga as linhas da sessão numa transação.
+    Aqui é o único ponto em que as mensagens viram JSON.
+
+    A mídia não entra no JSON: fica em um arquivo em `media_dir` (ao lado do
+    banco) e a linha guarda só o caminho. O arquivo passa a ser do storage
+    quando a linha é gravada e volta a ter dono no MessageRecord do `take`,
+    que o apaga ao liberar a mídia.
+    """
+
+    def __init__(self, db_path, synchronous: str = "NORMAL", media_dir=None):
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.media_dir = Path(media_dir) if media_dir is not None else self.db_path.parent / "media"
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.db_path), check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(f"PRAGMA synchronous={synchronous}")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS batch_messages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                session_id TEXT NOT NULL,
+                received_at REAL NOT NULL,
+                message TEXT NOT NULL,
+                size_bytes INTEGER,
+                telefone TEXT
+            )
+        """)
+        self._ensure_column("size_bytes", "INTEGER")
+        self._ensure_column("telefone", "TEXT")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_batch_messages_session ON batch_messages (session_id, id)")
+
+    def _ensure_column(self, name: str, declaration: str):
+        # Bancos criados por versões anteriores não têm as colunas novas
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(batch_messages)")}
+        if name not in columns:
+            self._conn.execute(f"ALTER TABLE batch_messages ADD COLUMN {name} {declaration}")
+
+    def prepare(self, message: MessageRecord):
+        if message.has_media:
+            message.media.move_to(self.media_dir) #type: ignore
+
+    def append(self, session_id: str, message: MessageRecord, received_at: float):
+        media = message.media if message.has_media else None
+        if media is not None:
+            # No-op quando o acumulador já chamou prepare
+            media.move_to(self.media_dir)
+        message_data = json.dumps(message.to_dict(media_by_reference=True))
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO batch_messages (session_id, received_at, message, size_bytes, telefone) VALUES (?, ?, ?, ?, ?)",
+                (session_id, received_at, message_data, message.size, message.telefone)
+            )
+        if media is not None:
+            # Linha gravada: o arquivo agora é do storage
+            media.detach_file()
+
+    def take(self, session_id: str) -> List[MessageRecord]:
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self._conn.execute(
+                    "SELECT message FROM batch_messages WHERE session_id = ? ORDER BY id", (session_id,)
+                ).fetchall()
+                self._conn.execute("DELETE FROM batch_messages WHERE session_id = ?", (session_id,))
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        messages = []
+        for (message_data,) in rows:
+            try:
+                messages.append(MessageRecord.from_json(message_data))
+            except (json.JSONDecodeError, TypeError) as e:
+                print(f"Erro ao decodificar mensagem do batch {session_id}: {e}")
+        return messages
+
+    def open_batches(self) -> Dict[str, Tuple[float, int, int, Optional[str]]]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT session_id, MIN(received_at), COUNT(*), SUM(COALESCE(size_bytes, LENGTH(message))), MAX(telefone) "
+                "FROM batch_messages GROUP BY session_id"
+            ).fetchall()
+        return {
+            session_id: (started_at, count, size_bytes or 0, telefone)
+            for session_id, started_at, count, size_bytes, telefone in rows
+        }
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def migrate_legacy_json(storage_dir, storage: BatchStorage) -> int:
+    """
+    Importa batches do formato antigo (batch_{session_id}_messages.json e
+    arquivos auxiliares) para o `storage` e apaga os arquivos.
+    Retorna quantas sessões foram migradas.
+    """
+    storage_dir = Path(storage_dir)
+    if not storage_dir.exists():
+        return 0
+
+    migrated = 0
+    for messages_file in storage_dir.glob("batch_*_messages.json"):
+        session_id = messages_file.name[len("batch_"):-len("_messages.json")]
+        timer_file = storage_dir / f"batch_{session_id}_timer.json"
+
+        try:
+            with open(messages_file, 'r', encoding='utf-8') as f:
+                messages = json.load(f)
+        except (json.JSONDecodeError, IOError) as e:
+            print(f"Batch legado ilegível para session_id {session_id}: {e}")
+            continue
+
+        started_at = time.time()
+        try:
+            with open(timer_file, 'r', encoding='utf-8') as f:
+                started_at = json.load(f).get('start_time', started_at)
+        except (json.JSONDecodeError, IOError):
+            pass
+
+        for message_data in messages:
+            try:
+                storage.append(session_id, MessageRecord.from_json(message_data), started_at)
+            except (json.JSONDecodeError, TypeError) as e:
+                print(f"Mensagem legada ilegível para session_id {session_id}: {e}")
+
+        for suffix in ("_messages.json", "_timer.json", "_processor.json", ".lock"):
+            legacy_file = storage_dir / f"batch_{session_id}{suffix}"
+            try:
+                if legacy_file.exists():
+                    legacy_file.unlink()
+            except OSError:
+                pass
+
+        migrated += 1
+
+    if migrated:
+        print(f"{migrated} batch(es) legado(s) migrado(s) de {storage_dir}")
+    return migrated
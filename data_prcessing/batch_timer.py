@@ -0,0 +1,82 @@
+import heapq
+import itertools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class DeadlineScheduler():
+    """
+    Agenda de prazos em uma única thread (heap de deadlines).
+
+    Cada chave tem no máximo um prazo ativo; reagendar substitui o anterior.
+    Quando o prazo vence, `on_expire(chave)` roda em um pequeno pool de
+    threads, então milhares de sessões abertas custam só memória.
+    """
+
+    def __init__(self, on_expire, workers: int = 2, name: str = 'batch-timer'):
+        self.on_expire = on_expire
+        self._heap = []
+        self._deadlines = {}  # chave -> (deadline, seq) vigente
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f'{name}-flush')
+        self._running = True
+        self._thread = threading.Thread(target=self._loop, name=name, daemon=True)
+        self._thread.start()
+
+    def schedule(self, key, deadline: float):
+        """Define (ou substitui) o prazo da chave; `deadline` em time.monotonic()"""
+        with self._cond:
+            entry = (deadline, next(self._seq))
+            self._deadlines[key] = entry
+            heapq.heappush(self._heap, (entry[0], entry[1], key))
+            self._cond.notify()
+
+    def cancel(self, key):
+        with self._cond:
+            self._deadlines.pop(key, None)
+
+    def deadline(self, key):
+        with self._cond:
+            entry = self._deadlines.get(key)
+            return entry[0] if entry else None
+
+    def __len__(self):
+        with self._cond:
+            return len(self._deadlines)
+
+    def _loop(self):
+        with self._cond:
+            while self._running:
+                if not self._heap:
+                    self._cond.wait()
+                    continue
+
+                deadline, seq, key = self._heap[0]
+                if self._deadlines.get(key) != (deadline, seq):
+                    # Prazo cancelado ou substituído
+                    heapq.heappop(self._heap)
+                    continue
+
+                remaining = deadline - time.monotonic()
+                if remaining > 0:
+                    self._cond.wait(timeout=remaining)
+                    continue
+
+                heapq.heappop(self._heap)
+                del self._deadlines[key]
+                self._executor.submit(self._fire, key)
+
+    def _fire(self, key):
+        try:
+            self.on_expire(key)
+        except Exception as e:
+            print(f"Erro ao processar prazo de {key}: {e}")
+
+    def shutdown(self, wait: bool = True):
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        self._thread.join()
+        self._executor.shutdown(wait=wait)
@@ -0,0 +1,65 @@
+import os
+from io import BytesIO
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Maior lado da imagem enviada ao modelo. Com detail=high o gpt-4o reduz o
+# menor lado para 768px, então 1536px no maior lado mantém texto legível
+# sem pagar por pixels que seriam descartados
+IMAGE_MAX_EDGE = int(os.getenv("IMAGE_MAX_EDGE", "1536"))
+IMAGE_JPEG_QUALITY = int(os.getenv("IMAGE_JPEG_QUALITY", "85"))
+# Imagens com o maior lado até aqui vão com detail=low (custo fixo de tokens)
+IMAGE_LOW_DETAIL_EDGE = int(os.getenv("IMAGE_LOW_DETAIL_EDGE", "512"))
+
+
+def preprocess_image(data: bytes, max_edge: int = IMAGE_MAX_EDGE, quality: int = IMAGE_JPEG_QUALITY):
+    """
+    Prepara a imagem para o modelo: aplica a orientação EXIF, reduz para
+    `max_edge` e recodifica em JPEG.
+
+    Returns:
+        (bytes_jpeg, detail) - detail é "low" para imagens pequenas e "high"
+        para as demais. Se a imagem não puder ser lida, devolve os bytes
+        originais com detail "auto".
+    """
+    # Pillow só é carregado quando chega a primeira imagem
+    from PIL import Image, ImageOps
+
+    try:
+        image = Image.open(BytesIO(data))
+        original_format = image.format
+        # 0x0112 = Orientation; 1 é a orientação normal
+        orientation = image.getexif().get(0x0112, 1)
+        # Para JPEG, decodifica já em escala reduzida (bem mais rápido)
+        image.draft('RGB', (max_edge, max_edge))
+        image = ImageOps.exif_transpose(image)
+
+        if image.mode in ('RGBA', 'LA', 'P'):
+            # Remove transparência sobre fundo branco
+            image = image.convert('RGBA')
+            background = Image.new('RGB', image.size, (255, 255, 255))
+            background.paste(image, mask=image.getchannel('A'))
+            image = background
+        elif image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+
+        resized = max(image.size) > max_edge
+        if resized:
+            image.thumbnail((max_edge, max_edge), Image.Resampling.LANCZOS)
+
+        detail = 'low' if max(image.size) <= IMAGE_LOW_DETAIL_EDGE else 'high'
+
+        output = BytesIO()
+        image.save(output, format='JPEG', quality=quality, optimize=True)
+        encoded = output.getvalue()
+
+        if not resized and original_format == 'JPEG' and orientation == 1 and len(data) <= len(encoded):
+            # JPEG pequeno já vem otimizado: recodificar só aumentaria o tamanho.
+            # Com outra orientação o original sairia sem a rotação aplicada
+            return data, detail
+        return encoded, detail
+
+    except Exception as e:
+        print(f"Não foi possível pré-processar a imagem: {e}")
+        return data, 'auto'
@@ -0,0 +1,158 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional
+from dotenv import load_dotenv
+
+load_dotenv()
+
+
+def content_key(data: bytes, *parts) -> str:
+    """SHA-256 do conteúdo da mídia + parâmetros (modelo, prompt, idioma...)"""
+    digest = hashlib.sha256(data)
+    for part in parts:
+        digest.update(b'\0')
+        digest.update(str(part).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def file_content_key(file_path: str, *parts) -> str:
+    """Igual a `content_key`, lendo o arquivo em blocos"""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    for part in parts:
+        digest.update(b'\0')
+        digest.update(str(part).encode('utf-8'))
+    return digest.hexdigest()
+
+
+class MediaResultCache():
+    """
+    Cache de resultados de transcrição/análise de imagem endereçado por conteúdo.
+
+    Camada em memória (LRU) e, opcionalmente, camada em disco com limite de
+    tamanho (remove os arquivos usados há mais tempo).
+    """
+
+    def __init__(self, max_entries: int = 1000, disk_dir: Optional[str] = None, disk_max_bytes: int = 100 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.disk_dir = Path(disk_dir) if disk_dir else None
+        self.disk_max_bytes = disk_max_bytes
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._disk_lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        if self.disk_dir is not None:
+            self.disk_dir.mkdir(parents=True, exist_ok=True)
+
+    def get(self, key: str, media_size: int = 0) -> Optional[str]:
+        """Retorna o resultado em cache; `media_size` conta os bytes que deixaram de ser enviados"""
+        with self._lock:
+            value = self._memory.get(key)
+            if value is not None:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                self.bytes_saved += media_size
+                return value
+
+        value = self._disk_get(key)
+        with self._lock:
+            if value is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            self.bytes_saved += media_size
+        self._memory_put(key, value)
+        return value
+
+    def put(self, key: str, value: Optional[str]):
+        if not value:
+            # Falhas não vão para o cache
+            return
+        self._memory_put(key, value)
+        self._disk_put(key, value)
+
+    def _memory_put(self, key: str, value: str):
+        with self._lock:
+            self._memory[key] = value
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_entries:
+                self._memory.popitem(last=False)
+
+    def _disk_path(self, key: str) -> Path:
+        return self.disk_dir / f'{key}.json' #type: ignore
+
+    def _disk_get(self, key: str) -> Optional[str]:
+        if self.disk_dir is None:
+            return None
+        path = self._disk_path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                value = json.load(f)['value']
+            os.utime(path)  # marca como usado recentemente
+            return value
+        except (OSError, json.JSONDecodeError, KeyError):
+            return None
+
+    def _disk_put(self, key: str, value: str):
+        if self.disk_dir is None:
+            return
+        path = self._disk_path(key)
+        tmp_path = path.with_suffix('.tmp')
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({'value': value}, f, ensure_ascii=False)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"Erro ao gravar cache de mídia em disco: {e}")
+            return
+        self._evict_disk()
+
+    def _evict_disk(self):
+        """Remove os arquivos menos usados até caber em disk_max_bytes"""
+        with self._disk_lock:
+            entries = []
+            total = 0
+            for entry in os.scandir(self.disk_dir): #type: ignore
+                if entry.name.endswith('.json'):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+                    total += stat.st_size
+            if total <= self.disk_max_bytes:
+                return
+            for _, size, path in sorted(entries):
+                try:
+                    os.unlink(path)
+                except OSError:
+                    continue
+                total -= size
+                if total <= self.disk_max_bytes:
+                    break
+
+    def stats(self):
+        with self._lock:
+            hits = self.memory_hits + self.disk_hits
+            lookups = hits + self.misses
+            return {
+                "entries": len(self._memory),
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_ratio": hits / lookups if lookups else 0.0,
+                "bytes_saved": self.bytes_saved,
+            }
+
+
+media_cache = MediaResultCache(
+    max_entries=int(os.getenv("MEDIA_CACHE_MAX_ENTRIES", "1000")),
+    disk_dir=os.getenv("MEDIA_CACHE_DIR") or None,
+    disk_max_bytes=int(os.getenv("MEDIA_CACHE_DISK_MAX_BYTES", str(100 * 1024 * 1024))),
+)
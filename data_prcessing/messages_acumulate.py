@@ -1,119 +1,213 @@
 import json
-import time
-import uuid
 import os
+import time
 import threading
-import fcntl
-from typing import Dict, List, Any
+from collections import deque
+from typing import Dict, List, Any, Callable, Optional, Union
 from pathlib import Path
+from models.models import MessageRecord
+from services.dead_letter import RETRY_HEADER, next_action, log_failure
+from services.metrics import metrics, COUNT_BUCKETS, SIZE_BUCKETS
+from .batch_timer import DeadlineScheduler
+from .batch_storage import BatchStorage, MemoryBatchStorage, SQLiteBatchStorage, migrate_legacy_json
+
+
+class BatchPolicy():
+    """
+    Regras de fechamento do batch de uma sessão.
+
+    Args:
+        idle_timeout: Segundos sem mensagens novas para fechar o batch (a
+            janela reinicia a cada mensagem)
+        max_wait: Tempo máximo, desde a primeira mensagem, que o batch pode
+            ficar aberto
+        max_messages: Quantidade de mensagens que fecha o batch na hora
+        max_bytes: Tamanho total (texto + mídia das mensagens) que fecha o batch na hora
+    """
+
+    def __init__(self, idle_timeout: float = 10, max_wait: float = 50,
+                 max_messages: int = 20, max_bytes: int = 5_000_000):
+        self.idle_timeout = idle_timeout
+        self.max_wait = max_wait
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+
+    @classmethod
+    def from_env(cls, max_wait: float = 50) -> "BatchPolicy":
+        return cls(
+            idle_timeout=float(os.getenv("BATCH_IDLE_TIMEOUT", "10")),
+            max_wait=float(os.getenv("BATCH_MAX_WAIT", str(max_wait))),
+            max_messages=int(os.getenv("BATCH_MAX_MESSAGES", "20")),
+            max_bytes=int(os.getenv("BATCH_MAX_BYTES", "5000000")),
+        )
+
+
+class BatchMetrics():
+    """
+    Métricas dos batches fechados (tamanho, bytes, espera e motivo do
+    fechamento). Também vão para o endpoint /metrics (services/metrics.py),
+    por motivo de fechamento
+    """
+
+    def __init__(self, max_samples: int = 1000):
+        self._lock = threading.Lock()
+        self._samples = deque(maxlen=max_samples)
+        self.batches = 0
+        self.reasons: Dict[str, int] = {}
+
+    def record(self, session_id: str, messages: int, size_bytes: int, wait_time: float, reason: str):
+        print(f"[batch] session_id={session_id} mensagens={messages} bytes={size_bytes} "
+              f"espera={wait_time:.2f}s motivo={reason}")
+        with self._lock:
+            self.batches += 1
+            self.reasons[reason] = self.reasons.get(reason, 0) + 1
+            self._samples.append((messages, size_bytes, wait_time))
+        metrics.observe('batch_messages', reason, messages, COUNT_BUCKETS)
+        metrics.observe('batch_bytes', reason, size_bytes, SIZE_BUCKETS)
+        metrics.observe('batch_wait_seconds', reason, wait_time)
+
+    def summary(self) -> Dict[str, Any]:
+        with self._lock:
+            samples = list(self._samples)
+            summary = {"batches": self.batches, "reasons": dict(self.reasons)}
+        if not samples:
+            return summary
+
+        def percentile(values, q):
+            values = sorted(values)
+            return values[min(len(values) - 1, int(q * len(values)))]
+
+        sizes = [sample[0] for sample in samples]
+        sizes_bytes = [sample[1] for sample in samples]
+        waits = [sample[2] for sample in samples]
+        summary.update({
+            "messages_avg": sum(sizes) / len(sizes),
+            "messages_p95": percentile(sizes, 0.95),
+            "bytes_avg": sum(sizes_bytes) / len(sizes_bytes),
+            "bytes_p95": percentile(sizes_bytes, 0.95),
+            "wait_p50": percentile(waits, 0.50),
+            "wait_p95": percentile(waits, 0.95),
+        })
+        return summary
+
+
+class _Batch():
+    """Metadados de um batch aberto; as mensagens ficam no BatchStorage"""
+
+    def __init__(self, session_id: str, started_at: Optional[float] = None, telefone: Optional[str] = None):
+        self.session_id = session_id
+        # Telefone (remoteJid) da sessão e shard da fila que entregou as
+        # mensagens (None fora do modo com shards e em batches recuperados)
+        self.telefone = telefone
+        self.shard: Optional[int] = None
+        self.messages_count = 0
+        self.size_bytes = 0
+        self.started_at = started_at if started_at is not None else time.time()
+        # Instantes em time.monotonic()
+        self.opened = time.monotonic() - (time.time() - self.started_at)
+        self.deadline = self.opened
+        self.close_reason: Optional[str] = None
+        # Execuções do batch que já falharam (ver MessageAccumulator.recover)
+        self.attempts = 0
+        # No modo bloqueante, indica se alguma chamada está esperando este batch
+        self.claimed = False
+        self.done = threading.Event()
+        self.result: Optional[Dict[str, Any]] = None
+
+
+def _default_storage(storage_dir: Path) -> BatchStorage:
+    backend = os.getenv("BATCH_STORAGE", "sqlite").lower()
+    if backend == "memory":
+        return MemoryBatchStorage()
+    return SQLiteBatchStorage(storage_dir / "batches.sqlite3")
+
 
 class MessageAccumulator:
-    def __init__(self, batch_timeout: int = 50, storage_dir: str = "batch_storage"):
+    def __init__(self, batch_timeout: int = 50, storage_dir: str = "batch_storage",
+                 flush_handler: Optional[Callable[[Dict[str, Any]], None]] = None, flush_workers: int = 2,
+                 storage: Optional[BatchStorage] = None, policy: Optional[BatchPolicy] = None):
         """
-        Inicializa o acumulador de mensagens usando arquivos locais
+        Inicializa o acumulador de mensagens
         
         Args:
-            batch_timeout: Tempo em segundos para aguardar novas mensagens no batch
-            storage_dir: Diretório para armazenar os arquivos de batch
+            batch_timeout: Tempo máximo em segundos que um batch fica aberto
+                (usado como max_wait quando `policy` não é informada)
+            storage_dir: Diretório dos batches persistidos (e dos arquivos JSON legados)
+            flush_handler: Callback chamado com o resultado do batch quando a janela fecha.
+                Sem callback, a primeira mensagem da sessão espera o fechamento do batch
+                (comportamento original); com callback, nenhuma chamada bloqueia.
+            flush_workers: Threads usadas para executar os fechamentos de batch
+            storage: Backend dos batches. Padrão: SQLite em storage_dir
+                (BATCH_STORAGE=memory usa só memória)
+            policy: Regras de fechamento (janela deslizante e limites).
+                Padrão: BatchPolicy.from_env(batch_timeout)
         """
         self.batch_timeout = batch_timeout
+        self.policy = policy if policy is not None else BatchPolicy.from_env(batch_timeout)
+        self.metrics = BatchMetrics()
         self.storage_dir = Path(storage_dir)
         self.storage_dir.mkdir(exist_ok=True)
-        
-    def _get_batch_files(self, session_id: str):
-        """Retorna os caminhos dos arquivos para uma sessão"""
-        return {
-            'messages': self.storage_dir / f"batch_{session_id}_messages.json",
-            'timer': self.storage_dir / f"batch_{session_id}_timer.json",
-            'lock': self.storage_dir / f"batch_{session_id}.lock",
-            'processor': self.storage_dir / f"batch_{session_id}_processor.json"
-        }
-    
-    def _read_json_file(self, file_path: Path, default=None):
-        """Lê arquivo JSON com tratamento de erro"""
-        try:
-            if file_path.exists():
-                with open(file_path, 'r', encoding='utf-8') as f:
-                    return json.load(f)
-        except (json.JSONDecodeError, IOError):
-            pass
-        return default
-    
-    def _write_json_file(self, file_path: Path, data):
-        """Escreve arquivo JSON com tratamento de erro"""
-        try:
-            with open(file_path, 'w', encoding='utf-8') as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
-            return True
-        except IOError:
-            return False
-    
-    def _acquire_lock(self, lock_file: Path, instance_id: str) -> bool:
-        """Tenta adquirir lock exclusivo para o batch"""
-        try:
-            # Cria arquivo de lock se não existir
-            lock_file.touch()
-            
-            with open(lock_file, 'r+') as f:
-                try:
-                    # Tenta fazer lock exclusivo
-                    fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
-                    
-                    # Verifica se o lock já tem dono
-                    f.seek(0)
-                    current_content = f.read().strip()
-                    
-                    if not current_content:
-                        # Lock livre - toma posse
-                        f.seek(0)
-                        f.write(instance_id)
-                        f.truncate()
-                        return True
-                    else:
-                        # Verifica se é o mesmo processo
-                        return current_content == instance_id
-                        
-                except (IOError, OSError):
-                    return False
-        except:
-            return False
-    
-    def _release_lock(self, lock_file: Path):
-        """Libera o lock do batch"""
-        try:
-            if lock_file.exists():
-                lock_file.unlink()
-        except:
-            pass
-    
-    def _is_timer_expired(self, timer_file: Path) -> bool:
-        """Verifica se o timer do batch expirou"""
-        timer_data = self._read_json_file(timer_file)
-        if not timer_data:
-            return True
-            
-        start_time = timer_data.get('start_time', 0)
-        return (time.time() - start_time) >= self.batch_timeout
+        self.flush_handler = flush_handler
+        self.storage = storage if storage is not None else _default_storage(self.storage_dir)
+        self._batches: Dict[str, _Batch] = {}
+        self._lock = threading.Lock()
+        self._scheduler = DeadlineScheduler(self._on_deadline, workers=flush_workers)
+        self._stopped = False
+
+        migrate_legacy_json(self.storage_dir, self.storage)
+        self._recover()
+
+    def _recover(self):
+        """Reabre os batches que ficaram pendentes no storage (ex.: após reinício)"""
+        for session_id, (started_at, messages_count, size_bytes, telefone) in self.storage.open_batches().items():
+            batch = _Batch(session_id, started_at=started_at, telefone=telefone)
+            batch.messages_count = messages_count
+            # O limite de bytes continua valendo para o que já estava no batch
+            batch.size_bytes = size_bytes
+            with self._lock:
+                self._batches[session_id] = batch
+                self._reschedule(batch)
+            remaining = max(0, batch.deadline - time.monotonic())
+            print(f"Batch recuperado para session_id: {session_id}, fecha em {remaining:.1f}s")
+
+    def _reschedule(self, batch: _Batch):
+        """Recalcula o prazo do batch segundo a política (chamar com o lock)"""
+        now = time.monotonic()
+        policy = self.policy
+        if batch.messages_count >= policy.max_messages:
+            batch.close_reason = "max_messages"
+            batch.deadline = now
+        elif batch.size_bytes >= policy.max_bytes:
+            batch.close_reason = "max_bytes"
+            batch.deadline = now
+        else:
+            batch.deadline = min(now + policy.idle_timeout, batch.opened + policy.max_wait)
+        self._scheduler.schedule(batch.session_id, batch.deadline)
+
+    def set_flush_handler(self, flush_handler: Optional[Callable[[Dict[str, Any]], None]]):
+        self.flush_handler = flush_handler
     
-    def accumulate_message(self, message_data: str) -> Dict[str, Any]:
+    def accumulate_message(self, message: Union[MessageRecord, str], shard: Optional[int] = None) -> Dict[str, Any]:
         """
         Acumula mensagem por session_id e decide se deve processar o batch
         
         Args:
-            message_data: JSON string com dados da mensagem (deve conter session_id)
+            message: MessageRecord (ou, no formato legado, JSON string) com
+                session_id. Só o storage serializa a mensagem, se precisar
+            shard: shard da fila que entregou a mensagem (worker com shards)
             
         Returns:
             Dict com resultado:
             - should_process: bool - se deve processar o batch
-            - messages: list - todas as mensagens do batch (se should_process=True)
+            - messages: list - MessageRecords do batch (se should_process=True)
             - status: str - status da operação
             - session_id: str - ID da sessão
         """
         
         try:
-            # Parse da mensagem para extrair session_id
-            message_dict = json.loads(message_data)
-            session_id = message_dict.get('session_id')
+            if isinstance(message, str):
+                message = MessageRecord.from_json(message)
+            session_id = message.session_id
             
             if not session_id:
                 return {
@@ -122,169 +216,285 @@ class MessageAccumulator:
                     "status": "Erro: session_id não encontrado na mensagem",
                     "session_id": ""
                 }
-            
-            # Obtém arquivos para esta sessão
-            files = self._get_batch_files(session_id)
-            instance_id = str(uuid.uuid4())
-            
-            # Verifica se existe timer ativo
-            timer_data = self._read_json_file(files['timer'])
-            
-            if not timer_data or self._is_timer_expired(files['timer']):
-                # Não existe batch ou timer expirou - tenta iniciar novo
-                if self._acquire_lock(files['lock'], instance_id):
-                    # Conseguiu o lock - inicia novo batch
-                    current_time = time.time()
-                    
-                    # Inicializa arquivos do batch
-                    self._write_json_file(files['messages'], [message_data])
-                    self._write_json_file(files['timer'], {
-                        'start_time': current_time,
-                        'expires_at': current_time + self.batch_timeout
-                    })
-                    self._write_json_file(files['processor'], {
-                        'instance_id': instance_id,
-                        'created_at': current_time
-                    })
-                    
-                    print(f"Iniciando batch para session_id: {session_id}, aguardando {self.batch_timeout}s...")
-                    
-                    # Aguarda o timeout
-                    time.sleep(self.batch_timeout)
-                    
-                    # Verifica se ainda é o processador responsável
-                    processor_data = self._read_json_file(files['processor'])
-                    if processor_data and processor_data.get('instance_id') == instance_id:
-                        # Coleta todas as mensagens do batch
-                        all_messages_data = self._read_json_file(files['messages'], [])
-                        
-                        # Converte para objetos Python
-                        messages_list = []
-                        for msg_str in all_messages_data:
-                            try:
-                                messages_list.append(json.loads(msg_str))
-                            except json.JSONDecodeError:
-                                print(f"Erro ao decodificar mensagem: {msg_str}")
-                        
-                        # Limpa os arquivos do batch
-                        for file_path in files.values():
-                            try:
-                                if file_path.exists():
-                                    file_path.unlink()
-                            except:
-                                pass
-                        
-                        print(f"Processando batch para session_id: {session_id} com {len(messages_list)} mensagem(s)")
-                        
-                        return {
-                            "should_process": True,
-                            "messages": messages_list,
-                            "status": f"Processando batch com {len(messages_list)} mensagem(s)",
-                            "session_id": session_id
-                        }
-                    else:
-                        # Outro processo assumiu
-                        self._release_lock(files['lock'])
-                        return {
-                            "should_process": False,
-                            "messages": [],
-                            "status": "Outro processo assumiu o batch",
-                            "session_id": session_id
-                        }
-                else:
-                    # Não conseguiu o lock - adiciona ao batch existente
-                    messages_data = self._read_json_file(files['messages'], [])
-                    messages_data.append(message_data)
-                    self._write_json_file(files['messages'], messages_data)
-                    
-                    return {
-                        "should_process": False,
-                        "messages": [],
-                        "status": "Mensagem adicionada ao batch existente",
-                        "session_id": session_id
-                    }
-            else:
-                # Batch ativo existe - adiciona mensagem
-                messages_data = self._read_json_file(files['messages'], [])
-                messages_data.append(message_data)
-                self._write_json_file(files['messages'], messages_data)
-                
-                # Calcula tempo restante
-                start_time = timer_data.get('start_time', time.time())
-                elapsed = time.time() - start_time
-                remaining = max(0, self.batch_timeout - elapsed)
-                
+
+            # Ex.: grava a mídia em arquivo, sem segurar as outras sessões
+            self.storage.prepare(message)
+
+            blocking = self.flush_handler is None
+            with self._lock:
+                batch = self._batches.get(session_id)
+                is_new = batch is None
+                if is_new:
+                    # Primeira mensagem da sessão - abre novo batch
+                    batch = _Batch(session_id, telefone=message.telefone)
+                    self._batches[session_id] = batch
+                batch.telefone = message.telefone #type: ignore
+                if shard is not None:
+                    batch.shard = shard #type: ignore
+                self.storage.append(session_id, message, time.time())
+                batch.messages_count += 1 #type: ignore
+                batch.size_bytes += message.size #type: ignore
+                # No modo bloqueante a primeira chamada a chegar espera pelo batch
+                # (inclui batches recuperados, que ainda não têm quem os espere)
+                claim = blocking and not batch.claimed #type: ignore
+                if claim:
+                    batch.claimed = True #type: ignore
+                # Janela deslizante: cada mensagem adia o fechamento
+                self._reschedule(batch) #type: ignore
+                remaining = max(0, batch.deadline - time.monotonic()) #type: ignore
+
+            if is_new:
+                print(f"Iniciando batch para session_id: {session_id}, fecha em até {remaining:.1f}s...")
+
+            if claim:
+                # Modo compatível: esta chamada é a "ganhadora" e espera o batch fechar
+                batch.done.wait() #type: ignore
+                return batch.result #type: ignore
+
+            if is_new:
                 return {
                     "should_process": False,
                     "messages": [],
-                    "status": f"Mensagem adicionada ao batch. Tempo restante: {remaining:.1f}s",
+                    "status": f"Batch iniciado, processamento agendado em até {remaining:.1f}s",
                     "session_id": session_id
                 }
-                
-        except json.JSONDecodeError as e:
+
             return {
                 "should_process": False,
                 "messages": [],
-                "status": f"Erro ao decodificar JSON: {str(e)}",
-                "session_id": ""
+                "status": f"Mensagem adicionada ao batch. Tempo restante: {remaining:.1f}s",
+                "session_id": session_id
             }
-        except Exception as e:
+                
+        except json.JSONDecodeError as e:
             return {
                 "should_process": False,
                 "messages": [],
-                "status": f"Erro no acumulador: {str(e)}",
+                "status": f"Erro ao decodificar JSON: {str(e)}",
                 "session_id": ""
             }
+        # Falha ao gravar no storage sobe: a mensagem ainda não tem ack e volta pela fila de retry
+
+    def _on_deadline(self, session_id: str):
+        """Chamado pelo agendador quando o prazo de uma sessão vence"""
+        with self._lock:
+            batch = self._batches.get(session_id)
+            if batch is None or batch.deadline > time.monotonic():
+                # Batch já fechado ou prazo estendido
+                return
+            if self.flush_handler is None and not batch.claimed:
+                # Batch recuperado sem ninguém para processá-lo: continua
+                # guardado até chegar a próxima mensagem da sessão
+                return
+        self._flush(session_id)
+
+    def _flush(self, session_id: str, reason: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        """Fecha o batch da sessão e entrega o resultado"""
+        with self._lock:
+            batch = self._batches.pop(session_id, None)
+            if batch is None:
+                return None
+            # Leitura atômica: nenhuma mensagem nova entra entre o pop e o take
+            messages_list = self.storage.take(session_id)
+            self._scheduler.cancel(session_id)
+
+        now = time.monotonic()
+        if reason is None:
+            reason = batch.close_reason
+        if reason is None:
+            reason = "max_wait" if now >= batch.opened + self.policy.max_wait else "idle"
+        wait_time = time.time() - batch.started_at
+        self.metrics.record(session_id, len(messages_list), sum(m.size for m in messages_list), wait_time, reason)
+
+        print(f"Processando batch para session_id: {session_id} com {len(messages_list)} mensagem(s)")
+
+        batch.result = {
+            # Batch vazio: as mensagens já foram levadas por outro processo
+            "should_process": bool(messages_list),
+            "messages": messages_list,
+            "status": f"Processando batch com {len(messages_list)} mensagem(s)",
+            "session_id": session_id,
+            "wait_time": wait_time,
+            "close_reason": reason,
+            "attempts": batch.attempts
+        }
+        batch.done.set()
+
+        if self.flush_handler is not None and messages_list:
+            try:
+                self.flush_handler(batch.result)
+            except Exception as e:
+                print(f"Erro ao entregar batch de {session_id}: {e}")
+                with open('erros', 'a') as f:
+                    f.write(f'Erro ao entregar batch {session_id} {time.time()}: {str(e)}\n')
+
+        return batch.result
     
     def get_batch_status(self, session_id: str) -> Dict[str, Any]:
         """
         Obtém status atual do batch para uma sessão específica
         """
-        files = self._get_batch_files(session_id)
-        
-        messages_data = self._read_json_file(files['messages'], [])
-        timer_data = self._read_json_file(files['timer'])
-        processor_data = self._read_json_file(files['processor'])
-        
-        active = bool(timer_data and not self._is_timer_expired(files['timer']))
-        
-        if timer_data:
-            start_time = timer_data.get('start_time', time.time())
-            elapsed = time.time() - start_time
-            remaining = max(0, self.batch_timeout - elapsed)
-        else:
-            elapsed = 0
-            remaining = 0
-            
-        return {
-            "session_id": session_id,
-            "active": active,
-            "messages_count": len(messages_data),
-            "elapsed_time": elapsed,
-            "remaining_time": remaining,
-            "processor": processor_data.get('instance_id') if processor_data else None
-        }
+        with self._lock:
+            batch = self._batches.get(session_id)
+            if batch is None:
+                return {
+                    "session_id": session_id,
+                    "active": False,
+                    "messages_count": 0,
+                    "elapsed_time": 0,
+                    "remaining_time": 0
+                }
+
+            return {
+                "session_id": session_id,
+                "active": True,
+                "messages_count": batch.messages_count,
+                "elapsed_time": time.time() - batch.started_at,
+                "size_bytes": batch.size_bytes,
+                "remaining_time": max(0, batch.deadline - time.monotonic())
+            }
     
     def clear_batch(self, session_id: str) -> bool:
         """
         Limpa um batch manualmente para uma sessão específica
         """
-        files = self._get_batch_files(session_id)
-        
-        cleared = False
-        for file_path in files.values():
-            try:
-                if file_path.exists():
-                    file_path.unlink()
-                    cleared = True
-            except:
-                pass
-                
-        return cleared
+        with self._lock:
+            batch = self._batches.pop(session_id, None)
+            self.storage.discard(session_id)
+            self._scheduler.cancel(session_id)
+        if batch is None:
+            return False
+
+        batch.result = {
+            "should_process": False,
+            "messages": [],
+            "status": "Batch descartado",
+            "session_id": session_id
+        }
+        batch.done.set()
+        return True
+
+    def recover(self, result: Dict[str, Any], error: Exception) -> str:
+        """
+        Trata um batch entregue ao flush_handler cujo processamento falhou
+        (as mensagens de origem já receberam ack). Segue a política da fila:
+        volta para o storage e fecha de novo depois da janela de inatividade
+        ou, se o erro é definitivo ou as tentativas acabaram, é gravado em
+        `dead_letter/` com o erro. Retorna 'retry' ou 'dead_letter'.
+        """
+        session_id = result["session_id"]
+        messages = result["messages"]
+        attempts = result.get("attempts", 0)
+        action = next_action(error, {RETRY_HEADER: attempts})
+        log_failure(error, action)
+        with open('erros', 'a') as f:
+            f.write(f'Batch {session_id} falhou ({action}) {time.time()}: {len(messages)} mensagem(s)\n')
+
+        if action == 'retry':
+            self._restore(session_id, messages, attempts + 1)
+        else:
+            self._dead_letter(session_id, messages, attempts, error)
+        return action
+
+    def _restore(self, session_id: str, messages: List[MessageRecord], attempts: int):
+        """Devolve as mensagens ao storage, na frente das que chegaram depois do fechamento"""
+        for message in messages:
+            self.storage.prepare(message)
+        with self._lock:
+            batch = self._batches.get(session_id)
+            newer = self.storage.take(session_id) if batch is not None else []
+            if batch is None:
+                batch = self._batches[session_id] = _Batch(session_id, telefone=messages[-1].telefone if messages else None)
+            batch.attempts = max(batch.attempts, attempts)
+            batch.messages_count = 0
+            batch.size_bytes = 0
+            received_at = time.time()
+            for message in list(messages) + newer:
+                self.storage.append(session_id, message, received_at)
+                batch.messages_count += 1
+                batch.size_bytes += message.size
+            # Nova tentativa só depois da janela de inatividade
+            batch.deadline = time.monotonic() + self.policy.idle_timeout
+            self._scheduler.schedule(session_id, batch.deadline)
+        print(f"Batch de {session_id} devolvido ao storage (tentativa {attempts})")
+
+    def _dead_letter(self, session_id: str, messages: List[MessageRecord], attempts: int, error: Exception):
+        """Grava o batch (com a mídia em base64) e o erro em dead_letter/, para análise e reprocessamento"""
+        dead_letter_dir = self.storage_dir / "dead_letter"
+        dead_letter_dir.mkdir(exist_ok=True)
+        path = dead_letter_dir / f"batch_{session_id}_{int(time.time() * 1000)}.json"
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({
+                "session_id": session_id,
+                "attempts": attempts,
+                "error": str(error),
+                "error_type": type(error).__name__,
+                "failed_at": time.time(),
+                "messages": [message.to_dict() for message in messages],
+            }, f)
+        print(f"Batch de {session_id} gravado em {path}")
+
+    def active_sessions(self) -> int:
+        with self._lock:
+            return len(self._batches)
+
+    def flush_all(self, reason: str = "shutdown"):
+        """Fecha imediatamente todos os batches abertos (ex.: no desligamento)"""
+        self.flush_where(lambda telefone, shard: True, reason=reason)
+
+    def flush_where(self, predicate: Callable[[Optional[str], Optional[int]], bool], reason: str) -> int:
+        """
+        Fecha imediatamente os batches para os quais `predicate(telefone, shard)`
+        é verdadeiro (ex.: os dos shards que passaram para outro nó). Retorna
+        quantos fechou
+        """
+        with self._lock:
+            session_ids = [session_id for session_id, batch in self._batches.items()
+                           if predicate(batch.telefone, batch.shard)]
+        for session_id in session_ids:
+            self._flush(session_id, reason=reason)
+        return len(session_ids)
+
+    def stop(self):
+        """
+        Para de fechar batches por prazo (espera os fechamentos em andamento),
+        mas mantém o storage aberto: batches já entregues ao flush_handler
+        ainda podem voltar para ele via `recover`
+        """
+        if not self._stopped:
+            self._stopped = True
+            self._scheduler.shutdown()
+
+    def close(self, flush: bool = True):
+        """
+        Encerra o acumulador. Com `flush=False` os batches abertos ficam no
+        storage e são recuperados na próxima inicialização. Quem processa os
+        batches deve chamar `stop()` e terminar o que recebeu antes do close.
+        """
+        if flush:
+            self.flush_all()
+        self.stop()
+        self.storage.close()
+
+
+# Acumulador compartilhado pelo processo: os batches vivem em memória,
+# então todas as mensagens precisam passar pela mesma instância
+_accumulator: Optional[MessageAccumulator] = None
+_accumulator_lock = threading.Lock()
+
+
+def get_accumulator() -> MessageAccumulator:
+    global _accumulator
+    if _accumulator is None:
+        with _accumulator_lock:
+            if _accumulator is None:
+                _accumulator = MessageAccumulator()
+    return _accumulator
 
 def process_accumulated_messages(message_data: str) -> str:
     """
-    Função principal para processar mensagens acumuladas
+    Função principal para processar mensagens acumuladas (interface JSON
+    legada; o grafo chama `get_accumulator().accumulate_message` direto)
     
     Args:
         message_data: JSON string com dados da mensagem
@@ -293,15 +503,15 @@ def process_accumulated_messages(message_data: str) -> str:
         JSON string com resultado do processamento
     """
     
-    # Inicializa o acumulador
-    accumulator = MessageAccumulator()
+    # Acumulador compartilhado
+    accumulator = get_accumulator()
     
     # Processa a mensagem
     result = accumulator.accumulate_message(message_data)
     
     if result["should_process"]:
         # Esta é a mensagem "ganhadora" que deve processar todo o batch
-        messages = result["messages"]
+        messages = [message.to_dict() for message in result["messages"]]
         session_id = result["session_id"]
         
         print(f"=== PROCESSANDO BATCH PARA SESSION {session_id} ===")
@@ -319,7 +529,7 @@ def process_accumulated_messages(message_data: str) -> str:
         
         # Log das mensagens processadas
         for i, msg in enumerate(messages, 1):
-            print(f"Mensagem {i}: {msg.get('mensagem', 'N/A')[:50]}...")
+            print(f"Mensagem {i}: {str(msg.get('mensagem') or 'N/A')[:50]}...")
         
         return json.dumps(processed_result)
     
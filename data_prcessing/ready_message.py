@@ -1,31 +1,142 @@
-from .treating import analyze_image, trancribe_audio
-import json
-import time
-
-def classifying_mensagem(useful_variables: str):
-    try:
-        user_variables = json.loads(useful_variables)
-
-    except json.JSONDecodeError as e:
-        print('Erro ao tentar converter para json')
-        with open('erros', 'a')as e:
-            e.write(f'Erro ao tentar converter para json time: {time.time()}')
-
-        error_convertion = json.loads(useful_variables)
-        return  error_convertion
-    
-    if 'mensagem_Imagem' in user_variables: 
-        image_content = analyze_image(user_variables['mensagem'])
-        user_variables['mensagem'] = image_content
-        new_user_variable = user_variables
-        return json.dumps(new_user_variable)
-
-
-    if 'mensagem_audio' in user_variables:
-        image_content = trancribe_audio(user_variables['mensagem'])
-        user_variables['mensagem'] = image_content
-        new_user_variable = user_variables
-        return json.dumps(new_user_variable)
-    else: 
-        return json.dumps(user_variables)
-            
\ No newline at end of file
+from .treating import analyze_image, trancribe_audio, aanalyze_image, atrancribe_audio
+import asyncio
+from models.models import MessageRecord, media_refs, TIPO_AUDIO, TIPO_IMAGEM, TIPO_TEXTO
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
+from typing import List, Optional
+import os
+import threading
+
+# Limite global de chamadas de mídia (Whisper/visão) em paralelo no processo
+MEDIA_CONCURRENCY = int(os.getenv("MEDIA_CONCURRENCY", "4"))
+
+_media_executor = None
+_media_executor_lock = threading.Lock()
+
+
+def _get_media_executor() -> ThreadPoolExecutor:
+    global _media_executor
+    if _media_executor is None:
+        with _media_executor_lock:
+            if _media_executor is None:
+                _media_executor = ThreadPoolExecutor(max_workers=MEDIA_CONCURRENCY, thread_name_prefix='media')
+    return _media_executor
+
+
+def classifying_mensagem(message: MessageRecord) -> MessageRecord:
+    """Converte a mídia da mensagem em texto (descrição da imagem ou transcrição do áudio)"""
+    if not message.has_media:
+        return message
+
+    if message.tipo == TIPO_IMAGEM: 
+        message.mensagem = analyze_image(message.media) #type: ignore
+
+    elif message.tipo == TIPO_AUDIO:
+        # Passa a mídia inteira: o áudio é lido direto da memória (ou do arquivo)
+        message.mensagem = trancribe_audio(message.media) #type: ignore
+
+    # A mídia já virou texto: solta a referência; o arquivo temporário some
+    # junto com o último dono (o batch do worker pode precisar dela no retry)
+    media_refs.drop(message.media_ref)
+    message.media = None
+    return message
+
+
+def merge_batch_messages(messages: List[MessageRecord], session_id=None) -> Optional[MessageRecord]:
+    """Junta as mensagens (já em texto) de um batch em uma única mensagem"""
+    if not messages:
+        return None
+
+    last = messages[-1]
+    return MessageRecord(
+        telefone=last.telefone,
+        chatwoot_id=last.chatwoot_id,
+        fromMe=last.fromMe,
+        tipo=TIPO_TEXTO,
+        mensagem="\n".join(str(m.mensagem) for m in messages if m.mensagem),
+        session_id=session_id or last.session_id,
+        lead_found=last.lead_found,
+        lead_created=last.lead_created,
+        total_mensagens=len(messages),
+    )
+
+
+def classifying_mensagens(messages: List[MessageRecord]) -> List[MessageRecord]:
+    """
+    Classifica uma lista de mensagens, com as chamadas de mídia em paralelo.
+    Toda chamada de mídia passa pelo pool compartilhado, mesmo quando o batch
+    tem uma só, então MEDIA_CONCURRENCY limita o processo inteiro. Mensagens
+    de texto não custam nada e a ordem original é mantida no resultado.
+    """
+    pending = [i for i, message in enumerate(messages) if message.has_media]
+    if not pending:
+        return list(messages)
+
+    executor = _get_media_executor()
+    # copy_context: as threads herdam o nó/sessão usados na contagem de tokens
+    futures = {i: executor.submit(contextvars.copy_context().run, classifying_mensagem, messages[i]) for i in pending}
+
+    classified = list(messages)
+    error = None
+    for i, future in futures.items():
+        try:
+            classified[i] = future.result()
+        except Exception as e:
+            print(f"Erro ao classificar mensagem {i + 1} do batch: {e}")
+            error = error or e
+    if error is not None:
+        # Sem o texto da mídia a mensagem sumiria do batch: o batch inteiro falha
+        raise error
+    return classified
+
+
+def classifying_batch(messages: List[MessageRecord], session_id=None) -> Optional[MessageRecord]:
+    """
+    Classifica todas as mensagens de um batch acumulado (áudio e imagem viram
+    texto) e devolve uma única mensagem com os textos na ordem de chegada
+    """
+    classified = classifying_mensagens(messages)
+    return merge_batch_messages(classified, session_id)
+
+
+# Pipeline asyncio: o limite de mídia vira um semáforo no loop
+_media_semaphore = None
+
+
+async def aclassifying_mensagem(message: MessageRecord) -> MessageRecord:
+    """Versão asyncio do classifying_mensagem"""
+    global _media_semaphore
+    if not message.has_media:
+        return message
+    if _media_semaphore is None:
+        _media_semaphore = asyncio.Semaphore(MEDIA_CONCURRENCY)
+
+    async with _media_semaphore:
+        if message.tipo == TIPO_IMAGEM:
+            message.mensagem = await aanalyze_image(message.media) #type: ignore
+        elif message.tipo == TIPO_AUDIO:
+            message.mensagem = await atrancribe_audio(message.media) #type: ignore
+
+    media_refs.drop(message.media_ref)
+    message.media = None
+    return message
+
+
+async def aclassifying_batch(messages: List[MessageRecord], session_id=None) -> Optional[MessageRecord]:
+    """Versão asyncio do classifying_batch: as mídias do batch vão juntas, na ordem original"""
+    results = await asyncio.gather(*(aclassifying_mensagem(m) for m in messages), return_exceptions=True)
+    classified = []
+    error = None
+    for i, (message, result) in enumerate(zip(messages, results)):
+        if isinstance(result, BaseException) and not isinstance(result, Exception):
+            # CancelledError (e KeyboardInterrupt/SystemExit) não é falha do
+            # batch: sobe na hora, sem virar mensagem classificada
+            raise result
+        if isinstance(result, Exception):
+            print(f"Erro ao classificar mensagem {i + 1} do batch: {result}")
+            error = error or result
+        else:
+            classified.append(result)
+    if error is not None:
+        raise error
+    return merge_batch_messages(classified, session_id)
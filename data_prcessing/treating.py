@@ -1,74 +1,316 @@
 
-from langchain_openai import ChatOpenAI
-import openai
 import base64
-from io import BytesIO
-from PIL import Image
-import requests
-from langchain.schema import HumanMessage, AIMessage
 import os
 import tempfile
+import threading
 from dotenv import load_dotenv
 import time
-from datetime import datetime
+from .media_cache import media_cache, content_key, file_content_key
+from .image_preprocessing import preprocess_image, IMAGE_MAX_EDGE, IMAGE_JPEG_QUALITY
+from services.rate_limiter import call_with_retry, acall_with_retry, estimate_tokens, retryable_errors
+import asyncio
+from services.usage import usage_tracker
 
-# Inicializar modelo com vis�o
 load_dotenv()
-llm = ChatOpenAI(
-    model="gpt-4o",  # ou gpt-4-vision-preview
-    openai_api_key=os.getenv("OPENAI_API_KEY") #type: ignore
-)
 
-# Configurar cliente OpenAI para transcrição
-client = openai.OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+# Clientes criados no primeiro uso (langchain/openai só são importados aí),
+# para o import do main continuar rápido. As novas tentativas ficam com o
+# call_with_retry (limitador compartilhado), por isso os clientes não
+# refazem chamadas por conta própria
+_llm = None
+_client = None
+_async_client = None
+_clients_lock = threading.Lock()
+
+
+def get_llm():
+    """ChatOpenAI com visão, compartilhado pelo processo"""
+    global _llm
+    if _llm is None:
+        with _clients_lock:
+            if _llm is None:
+                from langchain_openai import ChatOpenAI
+                _llm = ChatOpenAI(
+                    model="gpt-4o",  # ou gpt-4-vision-preview
+                    api_key=os.getenv("OPENAI_API_KEY"), #type: ignore
+                    max_retries=0
+                )
+    return _llm
+
+
+def get_openai_client():
+    """Cliente OpenAI para transcrição, compartilhado pelo processo"""
+    global _client
+    if _client is None:
+        with _clients_lock:
+            if _client is None:
+                import openai
+                _client = openai.OpenAI(api_key=os.getenv("OPENAI_API_KEY"), max_retries=0)
+    return _client
+
+
+def _get_async_client():
+    # Cliente assíncrono (pipeline asyncio): usado só dentro do event loop
+    global _async_client
+    if _async_client is None:
+        import openai
+        _async_client = openai.AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"), max_retries=0)
+    return _async_client
+
+
+IMAGE_MODEL = "gpt-4o"
+AUDIO_MODEL = "whisper-1"
+AUDIO_LANGUAGE = "pt"
+
 
 # Usar com LangChain
-def analyze_image(image_path, prompt="Resumo curto da imagem. Responda sem acento, sem hifens"):
-    image_base64 = image_path
+def analyze_image(image, prompt="Resumo curto da imagem. Responda sem acento, sem hifens"):
+    """Descreve a imagem (MediaPayload, bytes ou base64). Imagens repetidas vêm do cache"""
+    cache_key, cached, message, estimated = _prepare_image(image, prompt)
+    if cached is not None:
+        return cached
+
     try: 
-        message = HumanMessage(
-            content=[
-                {"type": "text", "text": prompt},
-                {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{image_base64}"}}
-            ]
-        )
-        response = llm.invoke([message])
-    except: 
+        def invoke():
+            with usage_tracker.timed(IMAGE_MODEL) as responses:
+                response = get_llm().invoke([message])
+                responses.append(response)
+            return response
+
+        response = call_with_retry(IMAGE_MODEL, invoke, estimated_tokens=estimated)
+    except Exception as e: 
+        with open('erros', 'a') as a:
+            a.write(f'Erro ao tentar converterimagem: {str(e)} - {time.time()}\n')
+        if isinstance(e, retryable_errors()):
+            # OpenAI fora do ar mesmo depois das novas tentativas: sobe para a
+            # mensagem voltar pela fila de retry em vez de sumir do batch
+            raise
+        return None
+
+    media_cache.put(cache_key, response.content) #type: ignore
+    return response.content
+
+def _prepare_image(image, prompt):
+    """
+    Parte local da análise (cache, redução e montagem da mensagem).
+    Retorna (cache_key, resultado em cache ou None, mensagem, tokens estimados)
+    """
+    image_bytes = _media_bytes(image)
+    cache_key = content_key(image_bytes, 'image', IMAGE_MODEL, prompt, IMAGE_MAX_EDGE, IMAGE_JPEG_QUALITY)
+    cached = media_cache.get(cache_key, len(image_bytes))
+    if cached is not None:
+        return cache_key, cached, None, 0
+
+    # Reduz e recodifica antes do envio (menos bytes e menos tokens)
+    prepared, detail = preprocess_image(image_bytes)
+    del image_bytes
+    image_base64 = base64.b64encode(prepared).decode('ascii')
+    from langchain_core.messages import HumanMessage
+    message = HumanMessage(
+        content=[
+            {"type": "text", "text": prompt},
+            {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{image_base64}", "detail": detail}}
+        ]
+    )
+    # Custo aproximado de uma imagem: 85 tokens (low) ou ~765 (high, 768px)
+    image_tokens = 85 if detail == 'low' else 765
+    return cache_key, None, message, estimate_tokens(prompt) + image_tokens
+
+
+async def aanalyze_image(image, prompt="Resumo curto da imagem. Responda sem acento, sem hifens"):
+    """Versão asyncio do analyze_image: a parte de CPU/disco roda em thread"""
+    try:
+        cache_key, cached, message, estimated = await asyncio.to_thread(_prepare_image, image, prompt)
+        if cached is not None:
+            return cached
+
+        async def invoke():
+            with usage_tracker.timed(IMAGE_MODEL) as responses:
+                response = await get_llm().ainvoke([message])
+                responses.append(response)
+            return response
+
+        response = await acall_with_retry(IMAGE_MODEL, invoke, estimated_tokens=estimated)
+    except Exception as e:
         with open('erros', 'a') as a:
-            a.write(f'Erro ao tentar converterimagem: {str(a)} - {time.time()}\n')
+            a.write(f'Erro ao tentar converterimagem: {str(e)} - {time.time()}\n')
+        if isinstance(e, retryable_errors()):
+            raise
+        return None
 
-    
+    await asyncio.to_thread(media_cache.put, cache_key, response.content) #type: ignore
     return response.content
 
-def trancribe_audio(audio_base64, file_extension='mp3'):
-    """Função para transcrever audios com a LLM"""
+# Assinaturas (magic bytes) dos formatos de áudio aceitos pelo Whisper
+_AUDIO_SIGNATURES = [
+    (0, b'OggS', 'ogg', 'audio/ogg'),          # WhatsApp: ogg/opus
+    (0, b'ID3', 'mp3', 'audio/mpeg'),
+    (0, b'\xff\xfb', 'mp3', 'audio/mpeg'),
+    (0, b'\xff\xf3', 'mp3', 'audio/mpeg'),
+    (0, b'\xff\xf2', 'mp3', 'audio/mpeg'),
+    (0, b'fLaC', 'flac', 'audio/flac'),
+    (0, b'\x1aE\xdf\xa3', 'webm', 'audio/webm'),
+    (4, b'ftyp', 'm4a', 'audio/mp4'),
+]
+
+# Acima desse tamanho o áudio é gravado em arquivo temporário antes do envio
+# (0 = nunca usa disco)
+AUDIO_DISK_FALLBACK_BYTES = int(os.getenv("AUDIO_DISK_FALLBACK_BYTES", "0"))
+
 
+def detect_audio_format(header: bytes):
+    """Retorna (extensão, mime) a partir dos primeiros bytes do áudio"""
+    if header[:4] == b'RIFF' and header[8:12] == b'WAVE':
+        return 'wav', 'audio/wav'
+    for offset, signature, extension, mime in _AUDIO_SIGNATURES:
+        if header[offset:offset + len(signature)] == signature:
+            return extension, mime
+    return 'mp3', 'audio/mpeg'
 
+
+def _media_bytes(media) -> bytes:
+    """Aceita MediaPayload, bytes ou base64 (str) e devolve os bytes da mídia"""
+    if hasattr(media, 'decode') and not isinstance(media, (bytes, bytearray, str)):
+        return media.decode()
+    if isinstance(media, (bytes, bytearray, memoryview)):
+        return bytes(media)
     #Decodificar Base64 e transformando em binario novamente
-    audio_data = base64.b64decode(audio_base64)
-    
-    # Criando arquivo temporario
+    return base64.b64decode(media)
+
 
-    with tempfile.NamedTemporaryFile(delete=False, suffix=f'.{file_extension}') as temp_file:
-        #Salvando arquivo
-        temp_file.write(audio_data)
-        temp_file_path = temp_file.name
+def trancribe_audio(audio, file_extension=None):
+    """
+    Função para transcrever audios com a LLM
 
+    O áudio vai para o Whisper direto da memória, com extensão/MIME detectados
+    pelos magic bytes. Só usa disco se a mídia já estiver em arquivo ou se
+    passar de AUDIO_DISK_FALLBACK_BYTES.
+    """
+    temp_file_path = None
     try:
-        #transcrevendo audio
-        with open(temp_file_path, "rb") as audio_file:
-            trancribe_audio = client.audio.transcriptions.create(
-            #Modelo que transcreve audio da openIA
-            model= 'whisper-1',
-            file= audio_file,
-            language='pt'
-        )
-        return trancribe_audio.text
+        file_path = getattr(audio, 'file_path', None)
+        if file_path is not None:
+            # Mídia já gravada em disco (mensagem grande): envia o arquivo
+            cache_key = file_content_key(file_path, 'audio', AUDIO_MODEL, AUDIO_LANGUAGE)
+            cached = media_cache.get(cache_key, os.path.getsize(file_path))
+            if cached is not None:
+                return cached
+
+            with open(file_path, 'rb') as f:
+                extension, mime = detect_audio_format(f.read(16))
+            if file_extension:
+                extension = file_extension
+            with open(file_path, 'rb') as audio_file:
+                text = _whisper_transcribe((f'audio.{extension}', audio_file, mime))
+            media_cache.put(cache_key, text)
+            return text
+
+        audio_data = _media_bytes(audio)
+        cache_key = content_key(audio_data, 'audio', AUDIO_MODEL, AUDIO_LANGUAGE)
+        cached = media_cache.get(cache_key, len(audio_data))
+        if cached is not None:
+            return cached
+
+        extension, mime = detect_audio_format(audio_data[:16])
+        if file_extension:
+            extension = file_extension
+
+        if AUDIO_DISK_FALLBACK_BYTES and len(audio_data) > AUDIO_DISK_FALLBACK_BYTES:
+            with tempfile.NamedTemporaryFile(delete=False, suffix=f'.{extension}') as temp_file:
+                temp_file.write(audio_data)
+                temp_file_path = temp_file.name
+            del audio_data
+            with open(temp_file_path, "rb") as audio_file:
+                text = _whisper_transcribe((f'audio.{extension}', audio_file, mime))
+        else:
+            text = _whisper_transcribe((f'audio.{extension}', audio_data, mime))
+
+        media_cache.put(cache_key, text)
+        return text
+
     except Exception as e:
         with open('erros', 'a') as a:
             a.write(f'Erro ao tentar converter audio: {str(e)} - {time.time()}\n')
+        if isinstance(e, retryable_errors()):
+            # OpenAI fora do ar mesmo depois das novas tentativas: sobe para a
+            # mensagem voltar pela fila de retry em vez de sumir do batch
+            raise
         return None
 
     finally:
         #Excluindo arquivo temporario sempre
-        os.unlink(temp_file_path)
+        if temp_file_path is not None:
+            os.unlink(temp_file_path)
+
+
+def _whisper_transcribe(file_param):
+    filename, content, mime = file_param
+
+    def request():
+        if hasattr(content, 'seek'):
+            # Nova tentativa: reenvia o arquivo desde o início
+            content.seek(0)
+        #transcrevendo audio (Whisper é cobrado por minuto: só a latência entra na conta)
+        with usage_tracker.timed(AUDIO_MODEL):
+            return get_openai_client().audio.transcriptions.create(
+                #Modelo que transcreve audio da openIA
+                model= AUDIO_MODEL,
+                file= (filename, content, mime),
+                language=AUDIO_LANGUAGE
+            )
+
+    trancribe_audio = call_with_retry(AUDIO_MODEL, request)
+    return trancribe_audio.text
+
+
+def _prepare_audio(audio, file_extension=None):
+    """
+    Parte local da transcrição assíncrona: cache e detecção do formato.
+    Retorna (cache_key, texto em cache ou None, (nome, bytes, mime))
+    """
+    file_path = getattr(audio, 'file_path', None)
+    if file_path is not None:
+        cache_key = file_content_key(file_path, 'audio', AUDIO_MODEL, AUDIO_LANGUAGE)
+        cached = media_cache.get(cache_key, os.path.getsize(file_path))
+        if cached is not None:
+            return cache_key, cached, None
+        with open(file_path, 'rb') as f:
+            audio_data = f.read()
+    else:
+        audio_data = _media_bytes(audio)
+        cache_key = content_key(audio_data, 'audio', AUDIO_MODEL, AUDIO_LANGUAGE)
+        cached = media_cache.get(cache_key, len(audio_data))
+        if cached is not None:
+            return cache_key, cached, None
+
+    extension, mime = detect_audio_format(audio_data[:16])
+    if file_extension:
+        extension = file_extension
+    return cache_key, None, (f'audio.{extension}', audio_data, mime)
+
+
+async def atrancribe_audio(audio, file_extension=None):
+    """Versão asyncio do trancribe_audio (envio sempre a partir da memória)"""
+    try:
+        cache_key, cached, file_param = await asyncio.to_thread(_prepare_audio, audio, file_extension)
+        if cached is not None:
+            return cached
+
+        async def request():
+            with usage_tracker.timed(AUDIO_MODEL):
+                return await _get_async_client().audio.transcriptions.create(
+                    model=AUDIO_MODEL,
+                    file=file_param, #type: ignore
+                    language=AUDIO_LANGUAGE
+                )
+
+        result = await acall_with_retry(AUDIO_MODEL, request)
+        await asyncio.to_thread(media_cache.put, cache_key, result.text)
+        return result.text
+
+    except Exception as e:
+        with open('erros', 'a') as a:
+            a.write(f'Erro ao tentar converter audio: {str(e)} - {time.time()}\n')
+        if isinstance(e, retryable_errors()):
+            raise
+        return None
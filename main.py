@@ -1,23 +1,47 @@
-from services.monitore_queues import monitor_rabbitmq_queue
-from services.processing_data import ProcessingFile
-from services.operation import get_lead, create_lead_db
-from typing_extensions import TypedDict
+from services import startup
+from services.monitore_queues import monitor_rabbitmq_queue, RabbitMQConsumer
+from services.processing_data import ProcessingFile, extract_session_key
+from services.dispatcher import SessionDispatcher
+from services.dead_letter import PoisonMessageError, RetryableMessageError
+from services.sharding import ShardRouter, ShardedConsumer, shard_for, RABBITMQ_CONSISTENT_HASH
+from services.lead_cache import lead_cache
+from services.usage import usage_tracker, usage_scope
+from services.metrics import metrics, instrument_node
+from services.operation import get_lead, create_lead_db, coalescer_stats
+from typing_extensions import TypedDict, NotRequired
+from typing import Any, Dict, List, Optional, Union
+from models.models import MessageRecord, media_refs
 from langgraph.graph import START, END, StateGraph
 import os
+import sys
 from dotenv import load_dotenv
-from data_prcessing.ready_message import classifying_mensagem
+from data_prcessing.ready_message import classifying_mensagem, classifying_batch
+from data_prcessing.media_cache import media_cache
+from data_prcessing.messages_acumulate import get_accumulator
 
 load_dotenv()
+startup.mark('imports')
 
 RABBITMQ_QUEUE = os.getenv('RABBITMQ_QUEUE')
 RABBITMQ_HOST = os.getenv('RABBITMQ_HOST')
 RABBITMQ_PORT = os.getenv('RABBITMQ_PORT')
 RABBITMQ_USERNAME = os.getenv('RABBITMQ_USERNAME')
 RABBITMQ_PASSWORD = os.getenv('RABBITMQ_PASSWORD')
+WORKER_CONCURRENCY = int(os.getenv('WORKER_CONCURRENCY', '8'))
+RABBITMQ_PREFETCH = int(os.getenv('RABBITMQ_PREFETCH', str(WORKER_CONCURRENCY)))
 
 class GraphState(TypedDict):
-    input: str
+    # Corpo da mensagem da fila (bytes no worker, str no modo de execução única)
+    input: Union[str, bytes]
     output: str
+    # Mensagem interpretada uma única vez em "process" (MessageRecord.to_state):
+    # só dados serializáveis pelo checkpointer, a mídia vai como id em `media_ref`
+    message: NotRequired[Optional[Dict[str, Any]]]
+    # Batch acumulado da sessão; quando presente, só ele segue para classificação
+    batch: NotRequired[List[Dict[str, Any]]]
+    # Shard da fila que entregou a mensagem (worker com --sharded)
+    shard: NotRequired[Optional[int]]
+    session_id: NotRequired[str]
 
 
 # 3 - Recebendo mensagem
@@ -35,7 +59,7 @@ def receiver_message(state: GraphState):
     
     # Atualiza o estado com os dados recebidos
     new_input = webhook_data if webhook_data else ""
-    print(f"Dados recebidos: {new_input}")
+    print(f"Dados recebidos: {len(new_input)} caracteres")
     
     return {"input": new_input, "output": state.get("output", "")}
 
@@ -47,122 +71,329 @@ def processing_data(state: GraphState):
         print("Processando dados...")
         
         processing_file = ProcessingFile(state["input"])
-        processed_data = processing_file.get_variable()
+        message = processing_file.get_message()
 
-        new_output = str(processed_data)
-        print(f"Dados processados: {new_output}")
-        return {"input": state["input"], "output": new_output}
+        print(f"Dados processados: {message}")
+        return {"message": message.to_state() if message else None, "output": "" if message else "Mensagem inválida"}
     else:
-        new_output = "Nenhum dado recebido"
         print("Nenhum dado para processar")
-        return {"input": state["input"], "output": new_output}
+        return {"message": None, "output": "Nenhum dado recebido"}
 
 #checando a existencia de um lead
 def search_lead(state: GraphState):
 
-    if state['output']:
+    if state.get('message'):
         print('Verificando existencia do lead... ')
 
-        useful_dict = get_lead(state["output"])
-        new_output = str(useful_dict)
-        print(f'informações do lead {new_output}')
+        message = get_lead(MessageRecord.from_dict(state["message"])) #type: ignore
+        print(f'informações do lead: found={message.lead_found} session_id={message.session_id}')
 
-        return {"input": state["input"], "output": new_output}
+        return {"message": message.to_state()}
 
     else:
-        new_output = 'Nenhum dado recebido'
         print('Nenhum dado recebido')
-        return {"input": state["input"], "output": new_output}    
+        return {"output": 'Nenhum dado recebido'}
     
  # Função para decidir o próximo nó baseado no lead_found
 def decide_next_step_client(state: GraphState):
-    import json
-    try:
-        # Converte o output (string) para dict para acessar lead_found
-        result = json.loads(state["output"])
-        lead_found = result.get("lead_found", False)
-
-        if lead_found:
-              return 'classificate_type_message'  # Lead existe
-        else:
-              return "create_lead"             # Lead não existe - vai cadastrar
-    except (json.JSONDecodeError, KeyError):
-          # Em caso de erro, assume que deve cadastrar
-          return "create_lead"
+    message = state.get("message")
+    if message is None:
+        return END                   # Nada para processar
+
+    if message.get("lead_found"):
+          return 'accumulate'        # Lead existe
+    else:
+          return "create_lead"       # Lead não existe - vai cadastrar
     
 
 #Criando cadastro do lead
 def create_lead(state:GraphState):
     print('Estou criando lead')
-    try:    
-        useful_dict = create_lead_db(state["output"])
-        new_output = str(useful_dict)
-    except Exception as e:
-        print(e.args)
-        
-    return {"input": state["input"], "output": new_output}
+    # Falha do Supabase sobe para o consumidor (fila de retry)
+    message = create_lead_db(MessageRecord.from_dict(state["message"])) #type: ignore
+    return {"message": message.to_state()}
+
+
+
+# Acumulando mensagens da sessão: só o batch fechado segue no grafo
+def accumulate_message(state: GraphState):
+    print('Acumulando mensagem na sessão')
+    # O MessageRecord (com a mídia do registro) vai direto para o acumulador;
+    # depois disso a mídia é do storage e sai do registro
+    message = MessageRecord.from_dict(state["message"]) #type: ignore
+    try:
+        result = get_accumulator().accumulate_message(message, shard=state.get("shard"))
+    finally:
+        media_refs.drop(message.media_ref)
 
+    if result["should_process"]:
+        return {"batch": [m.to_state() for m in result["messages"]], "session_id": result["session_id"]}
+
+    print(f"Mensagem adicionada ao batch: {result['status']}")
+    return {"output": result["status"]}
+
+
+def decide_after_accumulate(state: GraphState):
+    if state.get("batch"):
+        return 'classificate_type_message'  # Batch fechado - segue para classificação
+    return END                              # Mensagem ficou no batch - encerra a execução
+
+
+# Execuções disparadas pelo fechamento de batch entram direto na classificação
+def decide_entry(state: GraphState):
+    if state.get("batch"):
+        return 'classificate_type_message'
+    return 'start'
 
 
 def classificate_message(state:GraphState):
     print('Estou classificando mensagem')
-    try:    
-        useful_dict = classifying_mensagem(state["output"])
-        new_output = str(useful_dict)
-    except Exception as e:
-        print(e.args)
-        
-    input(new_output)
-    return {"input": state["input"], "output": new_output}
+    batch = [MessageRecord.from_dict(m) for m in state.get("batch") or []]
+    # Com batch, a mensagem desta execução já está nele (e a mídia dela, no storage)
+    message = MessageRecord.from_dict(state["message"]) if state.get("message") and not batch else None
+    session_id = state.get("session_id") or (message.session_id if message is not None else None)
+    # Erros da OpenAI (já depois das novas tentativas) sobem: a mensagem volta
+    # pela fila de retry e o batch volta para o storage
+    with usage_scope(node='classificate_type_message', session_id=session_id):
+        if batch:
+            message = classifying_batch(batch, state.get("session_id"))
+        elif message is not None:
+            message = classifying_mensagem(message)
+
+    new_output = message.mensagem if message is not None and message.mensagem else ""
+    print(f'Mensagem classificada: {new_output}')
+    return {"message": message.to_state() if message is not None else None, "output": new_output}
 
 
 # 5 - Criando o workflow
-def create_workflow():
+def create_workflow(with_receiver: bool = True, nodes=None):
+    """
+    Monta o grafo. Com `with_receiver=False` o nó "receive" é omitido e o
+    grafo começa em "process": usado pelo worker, que já entrega a mensagem
+    da fila em `input`.
+
+    `nodes` troca as funções dos nós mantendo as mesmas arestas (o
+    main_async.py usa isso para montar o grafo com nós assíncronos).
+    Todo nó é medido (latência, erros e tamanho da entrada) em services/metrics.py.
+    """
     workflow = StateGraph(GraphState)
+    node_functions = {
+        "receive": receiver_message,
+        "process": processing_data,
+        "check_lead": search_lead,
+        "create_lead": create_lead,
+        "accumulate": accumulate_message,
+        "classificate_type_message": classificate_message,
+    }
+    node_functions.update(nodes or {})
     
     # Adicionar nós
-    workflow.add_node("receive", receiver_message)
-    workflow.add_node("process", processing_data)
-    workflow.add_node('check_lead', search_lead)
-    workflow.add_node('create_lead', create_lead)
-    workflow.add_node('classificate_type_message', classificate_message)
+    for name, function in node_functions.items():
+        if name == "receive" and not with_receiver:
+            continue
+        workflow.add_node(name, instrument_node(name, function))
     
     # Adicionar conexão
-    workflow.set_entry_point("receive")
-    workflow.add_edge("receive", "process")
+    first_node = "receive" if with_receiver else "process"
+    workflow.set_conditional_entry_point(
+        decide_entry, {
+        'start': first_node,
+        'classificate_type_message': 'classificate_type_message'
+        }
+    )
+    if with_receiver:
+        workflow.add_edge("receive", "process")
     workflow.add_edge("process", 'check_lead' )
     workflow.add_conditional_edges(
         "check_lead",
         decide_next_step_client, {
         'create_lead': 'create_lead',
-        'classificate_type_message': 'classificate_type_message'
+        'accumulate': 'accumulate',
+        END: END
         }
 )
     # Definir pontos de entrada e saída
-    workflow.add_edge('create_lead', 'classificate_type_message')
+    workflow.add_edge('create_lead', 'accumulate')
+    workflow.add_conditional_edges(
+        'accumulate',
+        decide_after_accumulate, {
+        'classificate_type_message': 'classificate_type_message',
+        END: END
+        }
+    )
     workflow.add_edge('classificate_type_message', END)
     workflow_start = workflow.compile()
     
     return workflow_start
 
 app = create_workflow()
-# 6 - Execução principal
+startup.mark('grafo')
+
+
+def check_processed(final_state):
+    """
+    Confere o fim da execução antes do ack. Mensagem que não pôde ser
+    interpretada não adianta reprocessar: vai para a DLQ. Mensagem sem
+    session_id (lead não encontrado nem criado) não chegou ao batch: volta
+    pela fila de retry.
+    """
+    if final_state.get("batch"):
+        return
+    message = final_state.get("message")
+    if message is None:
+        raise PoisonMessageError(final_state.get("output") or "Mensagem inválida")
+    if not message.get("session_id"):
+        raise RetryableMessageError(f"Lead {message.get('telefone')} sem session_id: mensagem não foi acumulada")
+
+
+# 6 - Modo worker: conexão única com o RabbitMQ e uma execução do grafo por mensagem.
+# Mensagens de telefones diferentes rodam em paralelo (até WORKER_CONCURRENCY);
+# as do mesmo telefone mantêm a ordem de chegada.
+def run_worker(sharded: bool = False):
+    """
+    Com `sharded=True` o worker consome só as filas dos shards que possui
+    (services/sharding.py) e divide o trabalho com os outros nós.
+    """
+    worker_app = create_workflow(with_receiver=False)
+    dispatcher = SessionDispatcher(max_workers=WORKER_CONCURRENCY)
+    accumulator = get_accumulator()
+
+    def handle_message(body: bytes, shard: Optional[int] = None):
+        with media_refs.scope():
+            final_state = worker_app.invoke({"input": body, "output": "", "shard": shard})
+        check_processed(final_state)
+        print(f"Output: {final_state['output']}")
+
+    def handle_batch(result: dict):
+        # Batch fechado: roda o restante do grafo na fila do telefone, sem bloquear o acumulador
+        if not result.get("messages"):
+            return
+        batch = result["messages"]
+        telefone = batch[-1].telefone
+
+        def run_batch():
+            # Os registros ficam com este closure (recover usa as mesmas mídias);
+            # o estado leva só os dicts
+            with media_refs.scope():
+                final_state = worker_app.invoke({"input": "", "output": "", "batch": [m.to_state() for m in batch], "session_id": result["session_id"]})
+            print(f"Output do batch {result['session_id']}: {final_state['output']}")
+
+        def on_batch_done(error):
+            # As mensagens de origem já tiveram ack: o batch volta para o storage (ou dead_letter/)
+            if error is not None:
+                accumulator.recover(result, error)
+
+        dispatcher.submit(telefone, run_batch, on_batch_done)
+
+    accumulator.set_flush_handler(handle_batch)
+
+    consumer_options = dict(
+        host=RABBITMQ_HOST,#type: ignore
+        port=RABBITMQ_PORT,#type: ignore
+        username=RABBITMQ_USERNAME,#type: ignore
+        password=RABBITMQ_PASSWORD,#type: ignore
+        dispatcher=dispatcher,
+        key_func=extract_session_key,
+        prefetch_count=RABBITMQ_PREFETCH
+    )
+    if sharded:
+        # Shards que passam para outro nó: fecha aqui só os batches desses
+        # shards, para as próximas mensagens dessas sessões começarem batch
+        # novo lá; as conversas dos shards que ficam seguem no mesmo batch
+        def release_shards(shards):
+            released = set(shards)
+
+            def delivered_by_released(telefone, shard):
+                # O batch guarda o shard da fila que entregou as mensagens. Sem
+                # ele (batch recuperado do storage), shard_for só vale sem
+                # x-consistent-hash: com o anel do broker, fecha por garantia
+                if shard is None and not RABBITMQ_CONSISTENT_HASH:
+                    shard = shard_for(telefone)
+                return shard is None or shard in released
+
+            closed = accumulator.flush_where(delivered_by_released, reason="rebalance")
+            print(f"{closed} batch(es) fechado(s) dos shards {sorted(released)}")
+
+        consumer = ShardedConsumer(
+            RABBITMQ_QUEUE, #type: ignore
+            on_message=handle_message,
+            on_shards_released=release_shards,
+            **consumer_options
+        )
+    else:
+        consumer = RabbitMQConsumer(RABBITMQ_QUEUE, on_message=handle_message, **consumer_options) #type: ignore
+    consumer.install_signal_handlers()
+
+    print(startup.startup_report())
+    metrics.start_server()
+    print(f"Iniciando worker (concorrência={WORKER_CONCURRENCY})...")
+    consumer.start()
+    # Para de fechar batches e espera os que já estão rodando (uma falha
+    # ainda devolve o batch ao storage); só então fecha o storage. Batches
+    # abertos ficam nele e são retomados na próxima inicialização
+    accumulator.stop()
+    dispatcher.wait_idle()
+    dispatcher.shutdown()
+    accumulator.close(flush=False)
+    print(f"Cache de leads: {lead_cache.stats()}")
+    print(f"Consultas agrupadas ao Supabase: {coalescer_stats()}")
+    print(f"Cache de mídia: {media_cache.stats()}")
+    print(f"Batches: {accumulator.metrics.summary()}")
+    print(usage_tracker.format_report())
+    print(metrics.summary())
+    metrics.stop_server()
+    print("Worker finalizado")
+
+
+# 7 - Execução principal
 if __name__ == "__main__":
+    if "--router" in sys.argv:
+        # Distribui a fila principal entre as filas de shard (modo com vários nós)
+        router = ShardRouter(
+            RABBITMQ_QUEUE, #type: ignore
+            key_func=extract_session_key,
+            host=RABBITMQ_HOST,#type: ignore
+            port=RABBITMQ_PORT,#type: ignore
+            username=RABBITMQ_USERNAME,#type: ignore
+            password=RABBITMQ_PASSWORD,#type: ignore
+            prefetch_count=RABBITMQ_PREFETCH
+        )
+        router.install_signal_handlers()
+        router.start()
+        sys.exit(0)
+
+    if "--worker" in sys.argv:
+        run_worker(sharded="--sharded" in sys.argv)
+        sys.exit(0)
+
+    print(startup.startup_report())
     print("Iniciando workflow...")
-    
-    # Criar workflow
-    
-    
-    # Estado inicial
-    initial_state = {"input": "", "output": ""}
-    
-    try:
+    # Criar workflow: a mensagem vem do consumidor, que só dá ack depois do
+    # grafo terminar (falhas vão para retry/DLQ)
+    once_app = create_workflow(with_receiver=False)
+
+    def handle_once(body: bytes):
         # Executar workflow
-        final_state = app.invoke(initial_state)
-        
+        with media_refs.scope():
+            final_state = once_app.invoke({"input": body, "output": ""})
+        check_processed(final_state)
+
         print(f"\n=== RESULTADO FINAL ===")
-        print(f"Input: {final_state['input']}")
+        print(f"Input: {len(final_state['input'])} bytes")
         print(f"Output: {final_state['output']}")
-        
+
+    consumer = RabbitMQConsumer(
+        RABBITMQ_QUEUE, #type: ignore
+        on_message=handle_once,
+        host=RABBITMQ_HOST,#type: ignore
+        port=RABBITMQ_PORT,#type: ignore
+        username=RABBITMQ_USERNAME,#type: ignore
+        password=RABBITMQ_PASSWORD,#type: ignore
+        max_messages=1
+    )
+    
+    try:
+        consumer.start()
+        print(metrics.summary())
     except Exception as e:
         print(f"Erro no workflow: {e}")
\ No newline at end of file
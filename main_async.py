@@ -0,0 +1,156 @@
+import asyncio
+import os
+from dotenv import load_dotenv
+from main import (
+    GraphState, create_workflow, check_processed,
+    RABBITMQ_QUEUE, RABBITMQ_HOST, RABBITMQ_PORT, RABBITMQ_USERNAME, RABBITMQ_PASSWORD,
+)
+from services.async_consumer import AsyncRabbitMQConsumer
+from services.async_dispatcher import AsyncSessionDispatcher
+from services.processing_data import ProcessingFile, extract_session_key
+from services.operation import aget_lead, acreate_lead_db
+from services.lead_cache import lead_cache
+from services.usage import usage_tracker, usage_scope
+from services.metrics import metrics
+from models.models import MessageRecord, media_refs
+from data_prcessing.ready_message import aclassifying_mensagem, aclassifying_batch
+from data_prcessing.media_cache import media_cache
+from data_prcessing.messages_acumulate import get_accumulator
+
+# Pipeline asyncio: o mesmo grafo do main.py com nós assíncronos, rodando em
+# um único event loop. O grafo síncrono (main.py) continua disponível.
+load_dotenv()
+
+# Conversas em andamento ao mesmo tempo no processo
+ASYNC_CONCURRENCY = int(os.getenv('ASYNC_CONCURRENCY', '200'))
+ASYNC_PREFETCH = int(os.getenv('ASYNC_PREFETCH', str(ASYNC_CONCURRENCY)))
+
+
+# 1 - Nós assíncronos
+async def aprocessing_data(state: GraphState):
+    if state["input"]:
+        # Mensagens grandes gravam a mídia em disco: fica fora do loop
+        message = await asyncio.to_thread(ProcessingFile(state["input"]).get_message)
+        return {"message": message.to_state() if message else None, "output": "" if message else "Mensagem inválida"}
+    return {"message": None, "output": "Nenhum dado recebido"}
+
+
+async def asearch_lead(state: GraphState):
+    if state.get('message'):
+        message = await aget_lead(MessageRecord.from_dict(state["message"])) #type: ignore
+        return {"message": message.to_state()}
+    return {"output": 'Nenhum dado recebido'}
+
+
+async def acreate_lead(state: GraphState):
+    message = await acreate_lead_db(MessageRecord.from_dict(state["message"])) #type: ignore
+    return {"message": message.to_state()}
+
+
+async def aaccumulate_message(state: GraphState):
+    # Escrita no storage do batch (SQLite) em thread, sem travar o loop
+    message = MessageRecord.from_dict(state["message"]) #type: ignore
+    try:
+        result = await asyncio.to_thread(get_accumulator().accumulate_message, message, state.get("shard"))
+    finally:
+        media_refs.drop(message.media_ref)
+
+    if result["should_process"]:
+        return {"batch": [m.to_state() for m in result["messages"]], "session_id": result["session_id"]}
+
+    return {"output": result["status"]}
+
+
+async def aclassificate_message(state: GraphState):
+    batch = [MessageRecord.from_dict(m) for m in state.get("batch") or []]
+    # Com batch, a mensagem desta execução já está nele (e a mídia dela, no storage)
+    message = MessageRecord.from_dict(state["message"]) if state.get("message") and not batch else None
+    session_id = state.get("session_id") or (message.session_id if message is not None else None)
+    with usage_scope(node='classificate_type_message', session_id=session_id):
+        if batch:
+            message = await aclassifying_batch(batch, state.get("session_id"))
+        elif message is not None:
+            message = await aclassifying_mensagem(message)
+
+    new_output = message.mensagem if message is not None and message.mensagem else ""
+    return {"message": message.to_state() if message is not None else None, "output": new_output}
+
+
+# 2 - Grafo com as mesmas arestas do síncrono
+def create_async_workflow():
+    return create_workflow(with_receiver=False, nodes={
+        "process": aprocessing_data,
+        "check_lead": asearch_lead,
+        "create_lead": acreate_lead,
+        "accumulate": aaccumulate_message,
+        "classificate_type_message": aclassificate_message,
+    })
+
+
+# 3 - Worker asyncio
+async def run_async_worker():
+    async_app = create_async_workflow()
+    dispatcher = AsyncSessionDispatcher(max_concurrency=ASYNC_CONCURRENCY)
+    accumulator = get_accumulator()
+    loop = asyncio.get_running_loop()
+
+    async def handle_message(body: bytes):
+        with media_refs.scope():
+            final_state = await async_app.ainvoke({"input": body, "output": ""})
+        check_processed(final_state)
+        print(f"Output: {final_state['output']}")
+
+    def handle_batch(result: dict):
+        # Chamado na thread do agendador: entrega o batch ao loop, na fila do telefone
+        if not result.get("messages"):
+            return
+        batch = result["messages"]
+        telefone = batch[-1].telefone
+
+        async def run_batch():
+            # Os registros ficam com este closure (recover usa as mesmas mídias)
+            with media_refs.scope():
+                final_state = await async_app.ainvoke({"input": "", "output": "", "batch": [m.to_state() for m in batch], "session_id": result["session_id"]})
+            print(f"Output do batch {result['session_id']}: {final_state['output']}")
+
+        async def on_batch_done(error):
+            # As mensagens de origem já tiveram ack: o batch volta para o storage (ou dead_letter/)
+            if error is not None:
+                await asyncio.to_thread(accumulator.recover, result, error)
+
+        loop.call_soon_threadsafe(dispatcher.submit, telefone, run_batch, on_batch_done)
+
+    accumulator.set_flush_handler(handle_batch)
+
+    consumer = AsyncRabbitMQConsumer(
+        RABBITMQ_QUEUE,
+        on_message=handle_message,
+        dispatcher=dispatcher,
+        host=RABBITMQ_HOST,#type: ignore
+        port=RABBITMQ_PORT,#type: ignore
+        username=RABBITMQ_USERNAME,#type: ignore
+        password=RABBITMQ_PASSWORD,#type: ignore
+        key_func=extract_session_key,
+        prefetch_count=ASYNC_PREFETCH
+    )
+    consumer.install_signal_handlers()
+
+    metrics.start_server()
+    print(f"Iniciando worker asyncio (concorrência={ASYNC_CONCURRENCY})...")
+    await consumer.start()
+    # Para de fechar batches e espera os que já estão rodando antes de fechar
+    # o storage; batches abertos são retomados na próxima inicialização
+    await asyncio.to_thread(accumulator.stop)
+    await dispatcher.wait_idle()
+    await asyncio.to_thread(accumulator.close, False)
+    print(f"Cache de leads: {lead_cache.stats()}")
+    print(f"Cache de mídia: {media_cache.stats()}")
+    print(f"Batches: {accumulator.metrics.summary()}")
+    print(usage_tracker.format_report())
+    print(metrics.summary())
+    metrics.stop_server()
+    print("Worker asyncio finalizado")
+
+
+if __name__ == "__main__":
+    asyncio.run(run_async_worker())
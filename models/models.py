@@ -1,2 +1,340 @@
+import base64
+import contextvars
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+import weakref
+from collections import OrderedDict
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Any, BinaryIO, Dict, Optional, Tuple
 
+# Tipos de mensagem aceitos no webhook
+TIPO_TEXTO = 'texto'
+TIPO_AUDIO = 'audio'
+TIPO_IMAGEM = 'imagem'
 
+# Flags usadas no formato dict/JSON legado para cada tipo
+_LEGACY_FLAGS = {
+    TIPO_TEXTO: 'mensagem_text',
+    TIPO_AUDIO: 'mensagem_audio',
+    TIPO_IMAGEM: 'mensagem_Imagem',
+}
+
+# Tempo máximo que uma mídia fica presa ao estado de uma execução que não terminou
+MEDIA_REF_TTL = float(os.getenv("MEDIA_REF_TTL", "900"))
+
+
+class MediaPayload():
+    """
+    Conteúdo de mídia (áudio/imagem) mantido por referência.
+
+    Guarda uma memoryview do base64 dentro do corpo original da mensagem (sem
+    criar `str`), ou um arquivo temporário com os bytes já decodificados
+    quando a mídia passa de MEDIA_SPILL_THRESHOLD. Os bytes só são
+    decodificados quando pedidos.
+    """
+
+    def __init__(self, base64_data=None, file_path: Optional[str] = None, owns_file: bool = True):
+        if isinstance(base64_data, str):
+            base64_data = base64_data.encode('ascii')
+        self._view = memoryview(base64_data) if base64_data is not None else None
+        self.file_path = file_path
+        self._finalizer = None
+        self._ref = None  # id em `media_refs`, quando referenciada pelo estado do grafo
+        if file_path is not None and owns_file:
+            self._finalizer = weakref.finalize(self, _remove_file, file_path)
+
+    @classmethod
+    def from_file(cls, file_path: str) -> "MediaPayload":
+        return cls(file_path=file_path)
+
+    @property
+    def base64(self) -> str:
+        """Base64 como texto (cria uma cópia; prefira `decode`/`open`)"""
+        if self._view is not None:
+            return self._view.tobytes().decode('ascii')
+        return base64.b64encode(self.decode()).decode('ascii')
+
+    def decode(self) -> bytes:
+        if self._view is not None:
+            return base64.b64decode(self._view)
+        with open(self.file_path, 'rb') as f: #type: ignore
+            return f.read()
+
+    def open(self) -> BinaryIO:
+        """Arquivo binário com o conteúdo decodificado"""
+        if self.file_path is not None:
+            return open(self.file_path, 'rb')
+        return io.BytesIO(self.decode())
+
+    @property
+    def size(self) -> int:
+        """Tamanho aproximado, em bytes, do conteúdo decodificado"""
+        if self._view is not None:
+            return len(self._view) * 3 // 4
+        return os.path.getsize(self.file_path) #type: ignore
+
+    def spill(self, directory: Optional[str] = None):
+        """Decodifica para um arquivo temporário e solta a referência ao base64"""
+        if self._view is None:
+            return
+        directory = directory or _spill_dir()
+        fd, path = tempfile.mkstemp(prefix='media_', dir=directory)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(base64.b64decode(self._view))
+        self._view.release()
+        self._view = None
+        self.file_path = path
+        self._finalizer = weakref.finalize(self, _remove_file, path)
+
+    def move_to(self, directory) -> str:
+        """
+        Garante a mídia em um arquivo dentro de `directory` (decodificando o
+        base64 ou movendo o arquivo atual) e retorna o caminho. O arquivo
+        continua sendo deste objeto até `detach_file`.
+        """
+        directory = str(directory)
+        os.makedirs(directory, exist_ok=True)
+        if self._view is not None:
+            self.spill(directory)
+        elif os.path.dirname(os.path.abspath(self.file_path)) != os.path.abspath(directory): #type: ignore
+            fd, path = tempfile.mkstemp(prefix='media_', dir=directory)
+            os.close(fd)
+            if self._finalizer is not None:
+                shutil.move(self.file_path, path) #type: ignore
+                self._finalizer.detach()
+            else:
+                # Arquivo de outro dono: copia em vez de mover
+                shutil.copyfile(self.file_path, path) #type: ignore
+            self.file_path = path
+            self._finalizer = weakref.finalize(self, _remove_file, path)
+        return self.file_path #type: ignore
+
+    def detach_file(self) -> Optional[str]:
+        """Entrega o arquivo temporário a outro dono (ex.: o storage do batch)"""
+        if self._finalizer is not None:
+            self._finalizer.detach()
+            self._finalizer = None
+        return self.file_path
+
+    def release(self):
+        """Libera a mídia (apaga o arquivo temporário, se houver)"""
+        if self._view is not None:
+            self._view.release()
+            self._view = None
+        if self._finalizer is not None:
+            self._finalizer()
+            self._finalizer = None
+
+    def __len__(self):
+        return self.size
+
+    def __repr__(self):
+        where = 'arquivo' if self.file_path else 'memória'
+        return f'MediaPayload({self.size} bytes em {where})'
+
+
+def _remove_file(path: str):
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+
+def _spill_dir() -> str:
+    directory = os.getenv("MEDIA_SPILL_DIR") or os.path.join(tempfile.gettempdir(), 'clinical-media')
+    os.makedirs(directory, exist_ok=True)
+    return directory
+
+
+class MediaRefs():
+    """
+    Mídias referenciadas pelo estado do grafo.
+
+    O estado precisa ser serializável pelo checkpointer, então a mensagem vai
+    como dict e a mídia só como um id deste registro, que segura o
+    MediaPayload entre os nós. Quem consome a mídia (acumulador ou
+    classificação) chama `drop`; o que sobra de uma execução que falhou é
+    solto no fim de `scope()` ou, fora dele, expira depois de `ttl` segundos.
+    """
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._refs: "OrderedDict[str, Tuple[MediaPayload, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def hold(self, media: MediaPayload) -> str:
+        """Registra a mídia (ou renova o prazo do id que ela já tem)"""
+        with self._lock:
+            self._expire()
+            ref = media._ref
+            if ref is None or self._refs.pop(ref, None) is None:
+                ref = media._ref = uuid.uuid4().hex
+            # Reinsere no fim: a ordem do dict é a ordem de expiração
+            self._refs[ref] = (media, time.monotonic() + self.ttl)
+        scope = _media_scope.get()
+        if scope is not None:
+            scope.append(ref)
+        return ref
+
+    @contextmanager
+    def scope(self):
+        """Solta, ao sair do bloco, as mídias registradas nele (uma execução do grafo)"""
+        refs = []
+        token = _media_scope.set(refs)
+        try:
+            yield
+        finally:
+            _media_scope.reset(token)
+            for ref in refs:
+                self.drop(ref)
+
+    def get(self, ref: str) -> Optional[MediaPayload]:
+        with self._lock:
+            entry = self._refs.get(ref)
+        return entry[0] if entry else None
+
+    def drop(self, ref: Optional[str]):
+        if ref is None:
+            return
+        with self._lock:
+            self._refs.pop(ref, None)
+
+    def _expire(self):
+        now = time.monotonic()
+        while self._refs:
+            ref, (_, expires_at) = next(iter(self._refs.items()))
+            if expires_at > now:
+                break
+            del self._refs[ref]
+
+    def __len__(self):
+        with self._lock:
+            return len(self._refs)
+
+
+# Ids registrados pela execução atual do grafo (os nós herdam o contexto)
+_media_scope: contextvars.ContextVar = contextvars.ContextVar('media_scope', default=None)
+
+media_refs = MediaRefs(MEDIA_REF_TTL)
+
+
+@dataclass
+class MessageRecord():
+    """Mensagem do WhatsApp já interpretada (no estado do grafo vai como `to_state()`)"""
+
+    telefone: str
+    chatwoot_id: Any
+    fromMe: bool
+    tipo: str = TIPO_TEXTO
+    mensagem: Optional[str] = None  # texto, transcrição ou descrição da imagem
+    media: Optional[MediaPayload] = None
+    session_id: Optional[str] = None
+    lead_found: Optional[bool] = None
+    lead_created: Optional[bool] = None
+    total_mensagens: int = 1
+
+    @property
+    def has_media(self) -> bool:
+        return self.media is not None and self.mensagem is None
+
+    @property
+    def size(self) -> int:
+        """Tamanho aproximado em bytes (texto + mídia ainda não convertida)"""
+        return len(self.mensagem or '') + (self.media.size if self.has_media else 0) #type: ignore
+
+    def to_dict(self, media_by_reference: bool = False) -> Dict[str, Any]:
+        """
+        Formato dict legado (o mesmo que circulava como JSON entre os nós),
+        com a mídia em base64. Com `media_by_reference=True` a mídia, que
+        precisa já estar em arquivo, sai só como caminho em `media_file`.
+        Não muda a mensagem nem o dono do arquivo.
+        """
+        data = self._fields()
+        if self.has_media:
+            if media_by_reference:
+                if self.media.file_path is None: #type: ignore
+                    raise ValueError("Mídia ainda em memória: use MediaPayload.move_to antes")
+                data['media_file'] = self.media.file_path #type: ignore
+            else:
+                data['mensagem'] = self.media.base64 #type: ignore
+        return data
+
+    def to_state(self) -> Dict[str, Any]:
+        """
+        Dict para o estado do grafo (serializável pelo checkpointer). A mídia
+        ainda não convertida fica em `media_refs` e vai só como id em `media_ref`.
+        """
+        data = self._fields()
+        if self.has_media:
+            data['media_ref'] = media_refs.hold(self.media) #type: ignore
+        return data
+
+    @property
+    def media_ref(self) -> Optional[str]:
+        return self.media._ref if self.media is not None else None
+
+    def _fields(self) -> Dict[str, Any]:
+        """Campos do formato legado, sem o conteúdo da mídia"""
+        data: Dict[str, Any] = {
+            _LEGACY_FLAGS[self.tipo]: True,
+            'telefone': self.telefone,
+            'chatwoot_id': self.chatwoot_id,
+            'mensagem': self.mensagem,
+            'fromMe': self.fromMe,
+        }
+        for key in ('session_id', 'lead_found', 'lead_created'):
+            value = getattr(self, key)
+            if value is not None:
+                data[key] = value
+        if self.tipo != TIPO_TEXTO and not self.has_media:
+            # Mídia já convertida em texto
+            data['media_processada'] = True
+        if self.total_mensagens != 1:
+            data['total_mensagens'] = self.total_mensagens
+        return data
+
+    def to_json(self) -> str:
+        return json.dumps(self.to_dict())
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "MessageRecord":
+        tipo = TIPO_TEXTO
+        for candidate, flag in _LEGACY_FLAGS.items():
+            if data.get(flag):
+                tipo = candidate
+
+        mensagem = data.get('mensagem')
+        media = None
+        if data.get('media_ref'):
+            media = media_refs.get(data['media_ref'])
+            if media is None:
+                raise LookupError(f"Mídia {data['media_ref']} não está mais disponível")
+        elif data.get('media_file'):
+            media = MediaPayload.from_file(data['media_file'])
+        elif tipo != TIPO_TEXTO and mensagem is not None and not data.get('media_processada'):
+            media = MediaPayload(mensagem)
+            mensagem = None
+
+        return cls(
+            telefone=data.get('telefone'), #type: ignore
+            chatwoot_id=data.get('chatwoot_id'),
+            fromMe=data.get('fromMe', False),
+            tipo=tipo,
+            mensagem=mensagem,
+            media=media,
+            session_id=data.get('session_id'),
+            lead_found=data.get('lead_found'),
+            lead_created=data.get('lead_created'),
+            total_mensagens=data.get('total_mensagens', 1),
+        )
+
+    @classmethod
+    def from_json(cls, data: str) -> "MessageRecord":
+        return cls.from_dict(json.loads(data))
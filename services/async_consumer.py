@@ -0,0 +1,146 @@
+import asyncio
+import signal
+import ssl
+import aio_pika
+from services.metrics import metrics
+from services.dead_letter import (
+    dead_letter_names, retry_queue_arguments, next_action,
+    retry_headers, dead_letter_headers, log_failure,
+)
+
+
+class AsyncRabbitMQConsumer():
+    """
+    Consumidor asyncio (aio-pika) equivalente ao RabbitMQConsumer: uma conexão
+    robusta (reconecta sozinha), `on_message(body)` como corrotina e ack só
+    depois do processamento; falhas seguem a mesma política de retry/DLQ
+    (services/dead_letter.py). Mensagens são agrupadas por `key_func(body)` no
+    AsyncSessionDispatcher, então centenas de conversas ficam em andamento no
+    mesmo loop enquanto cada telefone mantém a ordem de chegada.
+    """
+
+    def __init__(self, queue_name, on_message, dispatcher, host='localhost', port=5672, username='guest', password='guest',
+                 use_ssl=False, key_func=None, prefetch_count=None):
+        self.queue_name = queue_name
+        self.on_message = on_message
+        self.dispatcher = dispatcher
+        self.host = host
+        self.port = int(port)
+        self.username = username
+        self.password = password
+        self.use_ssl = use_ssl
+        self.key_func = key_func
+        self.prefetch_count = prefetch_count or dispatcher.max_concurrency
+        self.dlx_name, self.dlq, self.retry_queue = dead_letter_names(queue_name)
+        self.connection = None
+        self._channel = None
+        self._dlx = None
+        self._queue = None
+        self._consumer_tag = None
+        self._stopped = None
+
+    async def _fail(self, message: aio_pika.abc.AbstractIncomingMessage, error: Exception):
+        """Republica a mensagem na fila de retry ou na DLQ e só então dá o ack"""
+        action = next_action(error, message.headers)
+        log_failure(error, action)
+        if action == 'retry':
+            headers = retry_headers(message.headers)
+        else:
+            headers = dead_letter_headers(message.headers, error, self.queue_name)
+        copy = aio_pika.Message(
+            body=message.body,
+            headers=headers,
+            content_type=message.content_type,
+            content_encoding=message.content_encoding,
+            message_id=message.message_id,
+            correlation_id=message.correlation_id,
+            timestamp=message.timestamp,
+            delivery_mode=aio_pika.DeliveryMode.PERSISTENT,
+        )
+        try:
+            if action == 'retry':
+                await self._channel.default_exchange.publish(copy, routing_key=self.retry_queue) #type: ignore
+            else:
+                await self._dlx.publish(copy, routing_key=self.queue_name) #type: ignore
+            await message.ack()
+        except Exception as e:
+            # Não conseguiu republicar: devolve para a fila em vez de perder
+            print(f"Não foi possível republicar a mensagem: {e}")
+            await message.nack(requeue=True)
+
+    async def _connect(self):
+        print(f"Conectando ao RabbitMQ em {self.host}:{self.port}")
+        ssl_context = None
+        if self.use_ssl:
+            ssl_context = ssl.create_default_context()
+            ssl_context.check_hostname = False
+            ssl_context.verify_mode = ssl.CERT_NONE
+
+        self.connection = await aio_pika.connect_robust(
+            host=self.host, port=self.port, login=self.username, password=self.password,
+            ssl=self.use_ssl, ssl_context=ssl_context, heartbeat=600
+        )
+        # publisher_confirms (padrão): o publish de retry/DLQ espera o broker aceitar
+        channel = self._channel = await self.connection.channel()
+        await channel.set_qos(prefetch_count=self.prefetch_count)
+        self._queue = await channel.declare_queue(self.queue_name, durable=True)
+        self._dlx = await channel.declare_exchange(self.dlx_name, aio_pika.ExchangeType.DIRECT, durable=True)
+        dlq = await channel.declare_queue(self.dlq, durable=True)
+        await dlq.bind(self._dlx, routing_key=self.queue_name)
+        await channel.declare_queue(self.retry_queue, durable=True, arguments=retry_queue_arguments(self.queue_name))
+        self._consumer_tag = await self._queue.consume(self._callback)
+
+    async def _callback(self, message: aio_pika.abc.AbstractIncomingMessage):
+        body = message.body
+        if message.timestamp is not None:
+            metrics.observe_queue_wait(message.timestamp.timestamp())
+        try:
+            key = self.key_func(body) if self.key_func is not None else None
+        except Exception:
+            key = None
+
+        async def on_done(error):
+            try:
+                if error is None:
+                    await message.ack()
+                else:
+                    await self._fail(message, error)
+            except Exception as e:
+                # Canal caiu: o broker reentrega a mensagem sozinho
+                print(f"Não foi possível confirmar a mensagem: {e}")
+
+        self.dispatcher.submit(key, lambda: self.on_message(body), on_done)
+
+    async def start(self):
+        """Consome mensagens até `stop()` ser chamado (ou SIGINT/SIGTERM)"""
+        self._stopped = asyncio.Event()
+        await self._connect()
+        print(f"Aguardando mensagens da fila '{self.queue_name}' (prefetch={self.prefetch_count})...")
+        try:
+            await self._stopped.wait()
+        finally:
+            # Para de receber, termina o que está em andamento (com os acks) e fecha
+            if self._queue is not None and self._consumer_tag is not None:
+                try:
+                    await self._queue.cancel(self._consumer_tag)
+                except Exception as e:
+                    print(f"Erro ao cancelar o consumo: {e}")
+            await self.dispatcher.wait_idle()
+            if self.connection is not None:
+                await self.connection.close()
+                self.connection = None
+
+    def stop(self):
+        if self._stopped is not None:
+            self._stopped.set()
+
+    def install_signal_handlers(self):
+        """Faz SIGINT/SIGTERM encerrarem o consumidor de forma limpa"""
+        loop = asyncio.get_running_loop()
+
+        def _handler():
+            print("Sinal de parada recebido, finalizando mensagens em andamento...")
+            self.stop()
+
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, _handler)
@@ -0,0 +1,77 @@
+import asyncio
+import uuid
+from collections import deque
+
+
+class AsyncSessionDispatcher():
+    """
+    Equivalente asyncio do SessionDispatcher: corrotinas de chaves diferentes
+    rodam concorrentemente (até `max_concurrency` no loop); as da mesma chave
+    rodam uma de cada vez, na ordem de chegada.
+    """
+
+    def __init__(self, max_concurrency: int = 100):
+        self.max_concurrency = max_concurrency
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._lanes = {}  # chave -> deque de (fn, on_done)
+        self._tasks = set()
+        self._in_flight = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+    def submit(self, key, fn, on_done=None):
+        """
+        Agenda `await fn()` na fila da chave. `on_done(error)` (função comum ou
+        corrotina) é chamado ao final, com `error=None` em caso de sucesso.
+        """
+        if key is None:
+            key = f'__sem_chave_{uuid.uuid4()}'
+
+        self._in_flight += 1
+        self._idle.clear()
+        lane = self._lanes.get(key)
+        if lane is not None:
+            # Já existe uma tarefa drenando essa chave
+            lane.append((fn, on_done))
+            return
+        self._lanes[key] = deque([(fn, on_done)])
+
+        task = asyncio.get_running_loop().create_task(self._run_lane(key))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run_lane(self, key):
+        lane = self._lanes[key]
+        while lane:
+            fn, on_done = lane.popleft()
+
+            error = None
+            try:
+                async with self._semaphore:
+                    await fn()
+            except Exception as e:
+                error = e
+
+            if on_done is not None:
+                try:
+                    result = on_done(error)
+                    if asyncio.iscoroutine(result):
+                        await result
+                except Exception as e:
+                    print(f"Erro no callback do dispatcher: {e}")
+
+            self._in_flight -= 1
+            if self._in_flight == 0:
+                self._idle.set()
+        del self._lanes[key]
+
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    async def wait_idle(self, timeout=None) -> bool:
+        """Espera todas as tarefas terminarem. Retorna False se estourar o timeout"""
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout=timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
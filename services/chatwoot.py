@@ -0,0 +1,48 @@
+import os
+import threading
+import time
+import requests
+from dotenv import load_dotenv
+
+load_dotenv()
+
+CHATWOOT_URL = os.getenv("CHATWOOT_URL", "").rstrip('/')
+CHATWOOT_API_TOKEN = os.getenv("CHATWOOT_API_TOKEN")
+CHATWOOT_ACCOUNT_ID = os.getenv("CHATWOOT_ACCOUNT_ID")
+CHATWOOT_TIMEOUT = float(os.getenv("CHATWOOT_TIMEOUT", "10"))
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def _get_session() -> requests.Session:
+    """Sessão HTTP compartilhada (mantém a conexão com o Chatwoot aberta)"""
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                _session = requests.Session()
+                _session.headers.update({"api_access_token": CHATWOOT_API_TOKEN or ""})
+    return _session
+
+
+def send_message(conversation_id, content: str) -> bool:
+    """Envia uma mensagem de saída para a conversa do Chatwoot"""
+    if not (CHATWOOT_URL and CHATWOOT_ACCOUNT_ID and conversation_id):
+        print("Chatwoot não configurado: mensagem não enviada")
+        return False
+
+    url = f"{CHATWOOT_URL}/api/v1/accounts/{CHATWOOT_ACCOUNT_ID}/conversations/{conversation_id}/messages"
+    try:
+        response = _get_session().post(
+            url,
+            json={"content": content, "message_type": "outgoing"},
+            timeout=CHATWOOT_TIMEOUT
+        )
+        response.raise_for_status()
+        return True
+    except Exception as e:
+        print(f"Erro ao enviar mensagem ao Chatwoot: {e}")
+        with open('erros', 'a') as f:
+            f.write(f'Erro ao enviar mensagem ao Chatwoot {conversation_id} {time.time()}: {str(e)}\n')
+        return False
@@ -0,0 +1,141 @@
+import asyncio
+import threading
+import time
+
+
+class _Call():
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class BatchCoalescer():
+    """
+    Junta chamadas que chegam em uma janela curta em uma única execução.
+
+    `get(chave)` espera até `max_wait` segundos (ou até juntar `max_batch`
+    chaves) e então `batch_fn(lista_de_chaves)` roda uma vez, devolvendo um
+    dict chave -> resultado. Cada chamador recebe só o resultado da sua
+    chave; chaves repetidas na mesma janela viram uma só. Se `batch_fn`
+    falhar, todos os chamadores daquela janela recebem a exceção.
+    """
+
+    def __init__(self, batch_fn, max_wait: float = 0.005, max_batch: int = 100):
+        self.batch_fn = batch_fn
+        self.max_wait = max_wait
+        self.max_batch = max_batch
+        self._cond = threading.Condition()
+        self._pending = {}  # chave -> _Call
+        self._collecting = False
+        self.batches = 0
+        self.keys = 0
+        self.calls = 0
+
+    def get(self, key):
+        with self._cond:
+            self.calls += 1
+            call = self._pending.get(key)
+            if call is None:
+                call = self._pending[key] = _Call()
+            leader = not self._collecting
+            if leader:
+                self._collecting = True
+            elif len(self._pending) >= self.max_batch:
+                self._cond.notify_all()
+
+        if leader:
+            self._run_batch()
+
+        call.done.wait()
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    def _run_batch(self):
+        # O primeiro chamador da janela espera as outras chaves chegarem
+        deadline = time.monotonic() + self.max_wait
+        with self._cond:
+            while len(self._pending) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(timeout=remaining)
+            batch = self._pending
+            self._pending = {}
+            self._collecting = False
+            self.batches += 1
+            self.keys += len(batch)
+
+        try:
+            results = self.batch_fn(list(batch))
+            for key, call in batch.items():
+                call.result = results.get(key)
+        except Exception as e:
+            for call in batch.values():
+                call.error = e
+        finally:
+            for call in batch.values():
+                call.done.set()
+
+    def stats(self):
+        with self._cond:
+            return {
+                "calls": self.calls,
+                "batches": self.batches,
+                "keys_per_batch": round(self.keys / self.batches, 2) if self.batches else 0.0,
+            }
+
+
+class AsyncBatchCoalescer():
+    """BatchCoalescer para corrotinas (`batch_fn` é async), no loop do worker asyncio"""
+
+    def __init__(self, batch_fn, max_wait: float = 0.005, max_batch: int = 100):
+        self.batch_fn = batch_fn
+        self.max_wait = max_wait
+        self.max_batch = max_batch
+        self._pending = {}  # chave -> Future
+        self._timer = None
+        self.batches = 0
+        self.keys = 0
+        self.calls = 0
+
+    async def get(self, key):
+        self.calls += 1
+        future = self._pending.get(key)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = self._pending[key] = loop.create_future()
+            if len(self._pending) >= self.max_batch:
+                self._flush()
+            elif self._timer is None:
+                self._timer = loop.call_later(self.max_wait, self._flush)
+        return await asyncio.shield(future)
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, {}
+        if batch:
+            self.batches += 1
+            self.keys += len(batch)
+            asyncio.get_running_loop().create_task(self._run_batch(batch))
+
+    async def _run_batch(self, batch):
+        try:
+            results = await self.batch_fn(list(batch))
+            for key, future in batch.items():
+                if not future.done():
+                    future.set_result(results.get(key))
+        except Exception as e:
+            for future in batch.values():
+                if not future.done():
+                    future.set_exception(e)
+
+    def stats(self):
+        return {
+            "calls": self.calls,
+            "batches": self.batches,
+            "keys_per_batch": round(self.keys / self.batches, 2) if self.batches else 0.0,
+        }
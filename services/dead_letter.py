@@ -0,0 +1,96 @@
+import json
+import os
+import time
+import traceback
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Falhas permitidas antes de a mensagem ir para a DLQ
+RABBITMQ_MAX_RETRIES = int(os.getenv('RABBITMQ_MAX_RETRIES', '3'))
+# Espera na fila de retry antes de a mensagem voltar para a fila principal
+RABBITMQ_RETRY_DELAY_MS = int(os.getenv('RABBITMQ_RETRY_DELAY_MS', '5000'))
+
+RETRY_HEADER = 'x-retry-count'
+ERROR_HEADERS = ('x-error', 'x-error-type', 'x-failed-at', 'x-original-queue', 'x-traceback')
+
+
+class PoisonMessageError(Exception):
+    """Mensagem que nunca vai ser processada (JSON inválido, campos faltando...): vai direto para a DLQ"""
+
+
+class RetryableMessageError(Exception):
+    """Mensagem que não terminou por uma falha temporária (ex.: lead sem session_id): volta pela fila de retry"""
+
+
+def dead_letter_names(queue_name: str):
+    """(exchange de dead-letter, fila DLQ, fila de retry) da fila"""
+    return (
+        os.getenv('RABBITMQ_DLX', f'{queue_name}.dlx'),
+        os.getenv('RABBITMQ_DLQ', f'{queue_name}.dlq'),
+        f'{queue_name}.retry',
+    )
+
+
+def retry_queue_arguments(queue_name: str) -> dict:
+    """A fila de retry devolve as mensagens para a fila principal após o TTL"""
+    return {
+        'x-message-ttl': RABBITMQ_RETRY_DELAY_MS,
+        'x-dead-letter-exchange': '',
+        'x-dead-letter-routing-key': queue_name,
+    }
+
+
+def is_poison(error: Exception) -> bool:
+    """Erros em que nova tentativa não adianta (e só gastaria chamadas à OpenAI)"""
+    if isinstance(error, (PoisonMessageError, json.JSONDecodeError, UnicodeDecodeError)):
+        return True
+    # Requisição recusada pela OpenAI por conteúdo/formato: repetir dá o mesmo erro
+    return type(error).__name__ == 'BadRequestError'
+
+
+def retry_count(headers) -> int:
+    try:
+        return int((headers or {}).get(RETRY_HEADER, 0))
+    except (TypeError, ValueError):
+        return 0
+
+
+def next_action(error: Exception, headers) -> str:
+    """'dead_letter' ou 'retry' para uma mensagem que falhou"""
+    if is_poison(error) or retry_count(headers) >= RABBITMQ_MAX_RETRIES:
+        return 'dead_letter'
+    return 'retry'
+
+
+def retry_headers(headers) -> dict:
+    new_headers = dict(headers or {})
+    new_headers[RETRY_HEADER] = retry_count(headers) + 1
+    return new_headers
+
+
+def dead_letter_headers(headers, error: Exception, queue_name: str) -> dict:
+    """Cabeçalhos com o erro anexado, para investigação e replay"""
+    new_headers = dict(headers or {})
+    new_headers.update({
+        'x-error': str(error)[:1000],
+        'x-error-type': type(error).__name__,
+        'x-failed-at': int(time.time()),
+        'x-original-queue': queue_name,
+        'x-traceback': ''.join(traceback.format_exception(type(error), error, error.__traceback__))[-4000:],
+    })
+    new_headers.setdefault(RETRY_HEADER, retry_count(headers))
+    return new_headers
+
+
+def replay_headers(headers) -> dict:
+    """Remove o erro e zera o contador para a mensagem voltar à fila como nova"""
+    new_headers = {k: v for k, v in (headers or {}).items() if k not in ERROR_HEADERS}
+    new_headers.pop(RETRY_HEADER, None)
+    return new_headers
+
+
+def log_failure(error: Exception, action: str):
+    print(f"Erro ao processar mensagem ({action}): {error}")
+    with open('erros', 'a') as f:
+        f.write(f'Erro ao processar mensagem da fila ({action}) {time.time()}: {str(error)}\n')
@@ -0,0 +1,79 @@
+import threading
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+class SessionDispatcher():
+    """
+    Executa tarefas em um pool limitado de threads garantindo ordem por chave.
+
+    Tarefas com chaves diferentes (telefone/session_id) rodam em paralelo;
+    tarefas com a mesma chave rodam uma de cada vez, na ordem de chegada.
+    """
+
+    def __init__(self, max_workers: int = 8):
+        self.max_workers = max_workers
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='session-worker')
+        self._lock = threading.Lock()
+        self._lanes = {}  # chave -> deque de tarefas pendentes
+        self._in_flight = 0
+        self._idle = threading.Condition(self._lock)
+
+    def submit(self, key, fn, on_done=None):
+        """
+        Agenda `fn()` na fila da chave. `on_done(error)` é chamado ao final,
+        com `error=None` em caso de sucesso ou a exceção lançada por `fn`.
+        """
+        if key is None:
+            # Sem chave não há ordem a preservar
+            key = f'__sem_chave_{uuid.uuid4()}'
+
+        with self._lock:
+            self._in_flight += 1
+            lane = self._lanes.get(key)
+            if lane is not None:
+                # Já existe uma thread drenando essa chave
+                lane.append((fn, on_done))
+                return
+            self._lanes[key] = deque([(fn, on_done)])
+
+        self._executor.submit(self._run_lane, key)
+
+    def _run_lane(self, key):
+        while True:
+            with self._lock:
+                lane = self._lanes[key]
+                if not lane:
+                    del self._lanes[key]
+                    return
+                fn, on_done = lane.popleft()
+
+            error = None
+            try:
+                fn()
+            except Exception as e:
+                error = e
+
+            if on_done is not None:
+                try:
+                    on_done(error)
+                except Exception as e:
+                    print(f"Erro no callback do dispatcher: {e}")
+
+            with self._lock:
+                self._in_flight -= 1
+                if self._in_flight == 0:
+                    self._idle.notify_all()
+
+    def in_flight(self) -> int:
+        with self._lock:
+            return self._in_flight
+
+    def wait_idle(self, timeout=None) -> bool:
+        """Espera todas as tarefas terminarem. Retorna False se estourar o timeout"""
+        with self._lock:
+            return self._idle.wait_for(lambda: self._in_flight == 0, timeout=timeout)
+
+    def shutdown(self, wait: bool = True):
+        self._executor.shutdown(wait=wait)
@@ -0,0 +1,69 @@
+import argparse
+import os
+import pika
+from dotenv import load_dotenv
+from services.dead_letter import dead_letter_names, replay_headers, retry_count
+from services.monitore_queues import _build_connection_params, copy_properties
+
+# Ferramenta de replay da DLQ:
+#   python -m services.dlq_replay --list                  # mostra as mensagens e os erros
+#   python -m services.dlq_replay                         # devolve todas para a fila original
+#   python -m services.dlq_replay --limit 10 --error-type KeyError
+#
+# As mensagens lidas e não reenviadas ficam sem ack e voltam para a DLQ
+# quando a conexão fecha, na mesma ordem.
+load_dotenv()
+
+
+def replay(queue_name, limit=None, error_type=None, list_only=False):
+    params = _build_connection_params(
+        os.getenv('RABBITMQ_HOST'), os.getenv('RABBITMQ_PORT', '5672'),
+        os.getenv('RABBITMQ_USERNAME'), os.getenv('RABBITMQ_PASSWORD')
+    )
+    _, dlq, _ = dead_letter_names(queue_name)
+
+    connection = pika.BlockingConnection(params)
+    channel = connection.channel()
+    channel.confirm_delivery()
+    try:
+        # Só percorre o que já estava na DLQ ao começar
+        total = channel.queue_declare(queue=dlq, durable=True, passive=True).method.message_count
+        print(f"{total} mensagem(ns) na DLQ '{dlq}'")
+
+        replayed = 0
+        for _ in range(total):
+            if limit is not None and replayed >= limit:
+                break
+            method, properties, body = channel.basic_get(queue=dlq, auto_ack=False)
+            if method is None:
+                break
+
+            headers = properties.headers or {}
+            print(f"- [{headers.get('x-error-type')}] tentativas={retry_count(headers)} "
+                  f"erro={headers.get('x-error')} tamanho={len(body)} bytes")
+            if list_only or (error_type and headers.get('x-error-type') != error_type):
+                continue
+
+            target = headers.get('x-original-queue') or queue_name
+            channel.basic_publish(exchange='', routing_key=target, body=body,
+                                  properties=copy_properties(properties, replay_headers(headers)))
+            channel.basic_ack(delivery_tag=method.delivery_tag)
+            replayed += 1
+
+        if not list_only:
+            print(f"{replayed} mensagem(ns) reenviada(s) para a fila")
+        return replayed
+    finally:
+        # O que não recebeu ack volta para a DLQ
+        connection.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Reenvia mensagens da DLQ para a fila original")
+    parser.add_argument('--queue', default=os.getenv('RABBITMQ_QUEUE'), help="fila principal (padrão: RABBITMQ_QUEUE)")
+    parser.add_argument('--limit', type=int, default=None, help="máximo de mensagens reenviadas")
+    parser.add_argument('--error-type', default=None, help="só reenvia mensagens com esse x-error-type")
+    parser.add_argument('--list', action='store_true', help="só lista, sem reenviar")
+    args = parser.parse_args()
+
+    replay(args.queue, limit=args.limit, error_type=args.error_type, list_only=args.list)
@@ -0,0 +1,95 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Marcador para telefones que sabidamente não têm cadastro
+_MISSING = object()
+
+
+class LeadCache():
+    """
+    Cache LRU com TTL de telefone (remoteJid) -> session_id.
+
+    Também guarda entradas negativas (telefone sem cadastro) por um tempo
+    curto, para que uma rajada de mensagens de um número novo não vire uma
+    consulta ao Supabase por mensagem.
+    """
+
+    def __init__(self, max_size: int = 10000, ttl: float = 600, negative_ttl: float = 5):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._data = OrderedDict()  # telefone -> (valor, expira_em)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+
+    def get(self, telefone):
+        """
+        Retorna (encontrado, session_id):
+        - (True, session_id) para lead em cache
+        - (True, None) para telefone em cache negativo
+        - (False, None) quando não há entrada válida
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(telefone)
+            if entry is None or entry[1] <= now:
+                if entry is not None:
+                    del self._data[telefone]
+                self.misses += 1
+                return False, None
+
+            self._data.move_to_end(telefone)
+            value = entry[0]
+            if value is _MISSING:
+                self.negative_hits += 1
+                return True, None
+            self.hits += 1
+            return True, value
+
+    def set(self, telefone, session_id):
+        self._store(telefone, session_id, self.ttl)
+
+    def set_missing(self, telefone):
+        self._store(telefone, _MISSING, self.negative_ttl)
+
+    def _store(self, telefone, value, ttl):
+        if ttl <= 0:
+            return
+        with self._lock:
+            self._data[telefone] = (value, time.monotonic() + ttl)
+            self._data.move_to_end(telefone)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def invalidate(self, telefone):
+        with self._lock:
+            self._data.pop(telefone, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.negative_hits + self.misses
+            return {
+                "size": len(self._data),
+                "hits": self.hits,
+                "negative_hits": self.negative_hits,
+                "misses": self.misses,
+                "hit_ratio": (self.hits + self.negative_hits) / lookups if lookups else 0.0,
+            }
+
+
+lead_cache = LeadCache(
+    max_size=int(os.getenv("LEAD_CACHE_MAX_SIZE", "10000")),
+    ttl=float(os.getenv("LEAD_CACHE_TTL", "600")),
+    negative_ttl=float(os.getenv("LEAD_CACHE_NEGATIVE_TTL", "5")),
+)
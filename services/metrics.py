@@ -0,0 +1,226 @@
+import asyncio
+import functools
+import os
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from dotenv import load_dotenv
+from models.models import media_refs
+
+load_dotenv()
+
+# Endereço e porta do endpoint /metrics (formato Prometheus); porta 0 desliga.
+# Só localhost por padrão: use METRICS_HOST=0.0.0.0 para o Prometheus de fora
+# da máquina. A 9100 ficou de fora por ser a do node_exporter
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '9471'))
+# Amostras guardadas por série para os percentis do resumo
+METRICS_SAMPLES = int(os.getenv('METRICS_SAMPLES', '2048'))
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+COUNT_BUCKETS = (1, 2, 3, 5, 10, 20, 50, 100)
+
+
+class Histogram():
+    """Histograma com buckets cumulativos (Prometheus) e amostragem para percentis"""
+
+    def __init__(self, buckets, max_samples: int = METRICS_SAMPLES):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.max_samples = max_samples
+        self._samples = []
+
+    def observe(self, value: float):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+        # Reservoir sampling: amostra uniforme de tudo que já foi observado
+        if len(self._samples) < self.max_samples:
+            self._samples.append(value)
+        else:
+            i = random.randrange(self.count)
+            if i < self.max_samples:
+                self._samples[i] = value
+
+    def percentile(self, q: float) -> float:
+        if not self._samples:
+            return 0.0
+        ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class Metrics():
+    """Métricas do processo: latência, erros e tamanho por nó do grafo, espera na fila e chamadas à OpenAI"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = {}  # (nome, label) -> Histogram
+        self._counters = {}    # (nome, label) -> int
+        self._server = None
+
+    def observe(self, name: str, label: str, value: float, buckets=LATENCY_BUCKETS):
+        with self._lock:
+            histogram = self._histograms.get((name, label))
+            if histogram is None:
+                histogram = self._histograms[(name, label)] = Histogram(buckets)
+            histogram.observe(value)
+
+    def increment(self, name: str, label: str, amount: int = 1):
+        with self._lock:
+            self._counters[(name, label)] = self._counters.get((name, label), 0) + amount
+
+    def observe_queue_wait(self, published_at):
+        """Espera na fila a partir do timestamp AMQP (segundos desde a época)"""
+        if published_at:
+            self.observe('queue_wait_seconds', 'queue', max(0.0, time.time() - float(published_at)))
+
+    # Exposição
+    def render(self) -> str:
+        """Texto no formato de exposição do Prometheus"""
+        lines = []
+        with self._lock:
+            names = sorted({name for name, _ in self._histograms})
+            for name in names:
+                lines.append(f'# TYPE {name} histogram')
+                for (hist_name, label), histogram in sorted(self._histograms.items()):
+                    if hist_name != name:
+                        continue
+                    label_name = _label_name(name)
+                    for bound, count in zip(histogram.buckets, histogram.counts):
+                        lines.append(f'{name}_bucket{{{label_name}="{label}",le="{bound}"}} {count}')
+                    lines.append(f'{name}_bucket{{{label_name}="{label}",le="+Inf"}} {histogram.count}')
+                    lines.append(f'{name}_sum{{{label_name}="{label}"}} {histogram.sum}')
+                    lines.append(f'{name}_count{{{label_name}="{label}"}} {histogram.count}')
+            for name in sorted({name for name, _ in self._counters}):
+                lines.append(f'# TYPE {name} counter')
+                for (counter_name, label), value in sorted(self._counters.items()):
+                    if counter_name == name:
+                        lines.append(f'{name}{{{_label_name(name)}="{label}"}} {value}')
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> str:
+        """Resumo p50/p95/p99 de cada série, para imprimir no desligamento"""
+        lines = ["=== Métricas do worker ==="]
+        with self._lock:
+            for (name, label), histogram in sorted(self._histograms.items()):
+                if not histogram.count:
+                    continue
+                lines.append(
+                    f"  {name}[{label}]: n={histogram.count} p50={histogram.percentile(0.50):.3f} "
+                    f"p95={histogram.percentile(0.95):.3f} p99={histogram.percentile(0.99):.3f}"
+                )
+            for (name, label), value in sorted(self._counters.items()):
+                lines.append(f"  {name}[{label}]: {value}")
+        return "\n".join(lines)
+
+    def start_server(self, port: int = METRICS_PORT, host: str = METRICS_HOST):
+        """Sobe o endpoint /metrics em uma thread daemon (só na primeira chamada)"""
+        if not port or self._server is not None:
+            return
+        registry = self
+
+        class _Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.rstrip('/') != '/metrics':
+                    self.send_error(404)
+                    return
+                body = registry.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        try:
+            self._server = ThreadingHTTPServer((host, port), _Handler)
+        except OSError as e:
+            print(f"Não foi possível abrir o endpoint de métricas em {host}:{port}: {e}")
+            return
+        threading.Thread(target=self._server.serve_forever, name='metrics', daemon=True).start()
+        print(f"Métricas em http://{host}:{port}/metrics")
+
+    def stop_server(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server = None
+
+
+def _label_name(metric: str) -> str:
+    if metric.startswith('graph_node'):
+        return 'node'
+    if metric.startswith('openai'):
+        return 'model'
+    if metric.startswith('batch'):
+        return 'reason'
+    return 'source'
+
+
+metrics = Metrics()
+
+
+def _payload_size(state) -> int:
+    """Tamanho do que entra no nó: batch, mensagem (texto + mídia) ou, antes do "process", o corpo da fila"""
+    if not isinstance(state, dict):
+        return 0
+    batch = state.get("batch")
+    if batch:
+        return sum(_message_size(m) for m in batch)
+    message = state.get("message")
+    if message is not None:
+        return _message_size(message)
+    return len(state.get("input") or '')
+
+
+def _message_size(message: dict) -> int:
+    """Texto + mídia ainda não convertida de uma mensagem do estado (MessageRecord.to_state)"""
+    media = media_refs.get(message['media_ref']) if message.get('media_ref') else None
+    return len(str(message.get('mensagem') or '')) + (media.size if media is not None else 0)
+
+
+def instrument_node(name: str, fn):
+    """Envolve um nó do grafo (síncrono ou async) medindo latência, erros e tamanho da entrada"""
+
+    def record(size, started, failed):
+        metrics.observe('graph_node_seconds', name, time.perf_counter() - started)
+        metrics.observe('graph_node_payload_bytes', name, size, SIZE_BUCKETS)
+        if failed:
+            metrics.increment('graph_node_errors_total', name)
+
+    if asyncio.iscoroutinefunction(fn):
+        @functools.wraps(fn)
+        async def async_wrapper(state, *args, **kwargs):
+            # Medido antes: alguns nós liberam a mídia da mensagem ao terminar
+            size = _payload_size(state)
+            started = time.perf_counter()
+            failed = False
+            try:
+                return await fn(state, *args, **kwargs)
+            except Exception:
+                failed = True
+                raise
+            finally:
+                record(size, started, failed)
+        return async_wrapper
+
+    @functools.wraps(fn)
+    def wrapper(state, *args, **kwargs):
+        size = _payload_size(state)
+        started = time.perf_counter()
+        failed = False
+        try:
+            return fn(state, *args, **kwargs)
+        except Exception:
+            failed = True
+            raise
+        finally:
+            record(size, started, failed)
+    return wrapper
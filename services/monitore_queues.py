@@ -1,34 +1,91 @@
 import pika
 import ssl
 import json
+import signal
+import time
+from services.metrics import metrics
+from services.dead_letter import (
+    dead_letter_names, retry_queue_arguments, next_action,
+    retry_headers, dead_letter_headers, log_failure,
+)
+
+
+def _build_connection_params(host, port, username, password, use_ssl=False):
+    """Monta os parametros de conexão com o RabbitMQ"""
+    credentials = pika.PlainCredentials(username, password)
+
+    if use_ssl:
+        ssl_context = ssl.create_default_context()
+        ssl_context.check_hostname = False
+        ssl_context.verify_mode = ssl.CERT_NONE
+        return pika.ConnectionParameters(
+            host=host, port=int(port), credentials=credentials,
+            ssl_options=pika.SSLOptions(ssl_context),
+            heartbeat=600, blocked_connection_timeout=300
+        )
+
+    return pika.ConnectionParameters(
+        host=host, port=int(port), credentials=credentials,
+        heartbeat=600, blocked_connection_timeout=300
+    )
+
+
+def declare_dead_letter(channel, queue_name):
+    """
+    Declara a topologia de falhas da fila: exchange de dead-letter com a DLQ
+    ligada a ela e a fila de retry, que devolve as mensagens para a fila
+    principal depois de RABBITMQ_RETRY_DELAY_MS (sem segurar a fila principal)
+    """
+    dlx, dlq, retry_queue = dead_letter_names(queue_name)
+    channel.exchange_declare(exchange=dlx, exchange_type='direct', durable=True)
+    channel.queue_declare(queue=dlq, durable=True)
+    channel.queue_bind(queue=dlq, exchange=dlx, routing_key=queue_name)
+    channel.queue_declare(queue=retry_queue, durable=True, arguments=retry_queue_arguments(queue_name))
+
+
+def copy_properties(properties, headers):
+    """Propriedades da mensagem original com novos cabeçalhos (sempre persistente)"""
+    return pika.BasicProperties(
+        content_type=getattr(properties, 'content_type', None),
+        content_encoding=getattr(properties, 'content_encoding', None),
+        message_id=getattr(properties, 'message_id', None),
+        correlation_id=getattr(properties, 'correlation_id', None),
+        timestamp=getattr(properties, 'timestamp', None),
+        headers=headers,
+        delivery_mode=2,
+    )
+
 
 def monitor_rabbitmq_queue(queue_name, host='localhost', port=5672, username='guest', password='guest', use_ssl=False):
+    """
+    Recebe uma única mensagem (nó "receive" do grafo servido pelo LangGraph).
+    Aqui o ack é no recebimento, porque o grafo continua depois que a conexão
+    fecha; o worker e a execução única do main.py usam o RabbitMQConsumer,
+    que só confirma depois do processamento. Mensagens que nem são JSON
+    válido vão direto para a DLQ e a espera continua.
+    """
     received_data = None  # Variável para guardar o webhook
     
     def callback(ch, method, properties, body):
         nonlocal received_data  # Acessa a variável de fora
-        received_data = body.decode('utf-8')
+        try:
+            decoded = body.decode('utf-8')
+            json.loads(decoded)
+        except ValueError as e:
+            # UnicodeDecodeError e JSONDecodeError: mensagem envenenada
+            log_failure(e, 'dead_letter')
+            dlx, _, _ = dead_letter_names(queue_name)
+            ch.basic_publish(exchange=dlx, routing_key=queue_name, body=body,
+                             properties=copy_properties(properties, dead_letter_headers(properties.headers, e, queue_name)))
+            ch.basic_ack(delivery_tag=method.delivery_tag)
+            return
+        received_data = decoded
         print(f"Mensagem recebida: {received_data}")
         ch.basic_ack(delivery_tag=method.delivery_tag)
         ch.stop_consuming()  # Para após receber a primeira mensagem
     
     try:
-        credentials = pika.PlainCredentials(username, password)
-        
-        if use_ssl:
-            ssl_context = ssl.create_default_context()
-            ssl_context.check_hostname = False
-            ssl_context.verify_mode = ssl.CERT_NONE
-            connection_params = pika.ConnectionParameters(
-                host=host, port=port, credentials=credentials,
-                ssl_options=pika.SSLOptions(ssl_context),
-                heartbeat=600, blocked_connection_timeout=300
-            )
-        else:
-            connection_params = pika.ConnectionParameters(
-                host=host, port=port, credentials=credentials,
-                heartbeat=600, blocked_connection_timeout=300
-            )
+        connection_params = _build_connection_params(host, port, username, password, use_ssl)
         
         print(f"Conectando ao RabbitMQ em {host}:{port}")
         connection = pika.BlockingConnection(connection_params)
@@ -36,6 +93,7 @@ def monitor_rabbitmq_queue(queue_name, host='localhost', port=5672, username='gu
         
         # Declarar a fila
         channel.queue_declare(queue=queue_name, durable=True)
+        declare_dead_letter(channel, queue_name)
         channel.basic_consume(queue=queue_name, on_message_callback=callback)
         
         print(f"Aguardando mensagem da fila '{queue_name}'...")
@@ -56,6 +114,178 @@ def monitor_rabbitmq_queue(queue_name, host='localhost', port=5672, username='gu
         return None
 
 
+class RabbitMQConsumer():
+    """
+    Consumidor residente: mantém uma única conexão/canal abertos e chama
+    `on_message(body)` para cada mensagem da fila. O corpo é entregue em
+    bytes, sem decodificar, para a mídia em base64 não virar `str`.
+
+    A mensagem só recebe ack depois que `on_message` termina. Se o handler
+    lançar exceção, a mensagem é republicada na fila de retry com o
+    cabeçalho `x-retry-count` incrementado (volta para a fila depois de
+    RABBITMQ_RETRY_DELAY_MS). Depois de RABBITMQ_MAX_RETRIES falhas, ou na
+    hora para mensagens envenenadas (PoisonMessageError, JSON inválido), ela
+    vai para a exchange de dead-letter com o erro nos cabeçalhos. O erro
+    também vai para o arquivo `erros`, sem derrubar o consumidor.
+
+    Com um `dispatcher` (SessionDispatcher) as mensagens são processadas em
+    paralelo, agrupadas pela chave devolvida por `key_func(body)`; o
+    `prefetch_count` limita quantas mensagens sem ack ficam com o worker.
+    `max_messages` encerra o consumo depois de N mensagens (execução única).
+    """
+
+    def __init__(self, queue_name, on_message, host='localhost', port=5672, username='guest', password='guest', use_ssl=False,
+                 reconnect_delay=5, dispatcher=None, key_func=None, prefetch_count=None, max_messages=None):
+        self.queue_name = queue_name
+        self.on_message = on_message
+        self.connection_params = _build_connection_params(host, port, username, password, use_ssl)
+        self.host = host
+        self.port = port
+        self.reconnect_delay = reconnect_delay
+        self.dispatcher = dispatcher
+        self.key_func = key_func
+        if prefetch_count is None:
+            prefetch_count = dispatcher.max_workers if dispatcher is not None else 1
+        self.prefetch_count = prefetch_count
+        self.max_messages = max_messages
+        self._received = 0
+        self.dlx, self.dlq, self.retry_queue = dead_letter_names(queue_name)
+        self.connection = None
+        self.channel = None
+        self._stopping = False
+
+    def _fail(self, ch, delivery_tag, properties, body, error):
+        """Republica a mensagem na fila de retry ou na DLQ e só então dá o ack"""
+        headers = getattr(properties, 'headers', None)
+        action = next_action(error, headers)
+        log_failure(error, action)
+        try:
+            if action == 'retry':
+                ch.basic_publish(exchange='', routing_key=self.retry_queue, body=body,
+                                 properties=copy_properties(properties, retry_headers(headers)))
+            else:
+                ch.basic_publish(exchange=self.dlx, routing_key=self.queue_name, body=body,
+                                 properties=copy_properties(properties, dead_letter_headers(headers, error, self.queue_name)))
+            ch.basic_ack(delivery_tag=delivery_tag)
+        except Exception as e:
+            # Não conseguiu republicar: devolve para a fila em vez de perder
+            print(f"Não foi possível republicar a mensagem: {e}")
+            if ch.is_open:
+                ch.basic_nack(delivery_tag=delivery_tag, requeue=True)
+
+    def _count_received(self):
+        self._received += 1
+        if self.max_messages is not None and self._received >= self.max_messages:
+            self._stopping = True
+            self.channel.stop_consuming() #type: ignore
+
+    def _callback(self, ch, method, properties, body):
+        metrics.observe_queue_wait(getattr(properties, 'timestamp', None))
+        if self.dispatcher is not None:
+            self._dispatch(ch, method, properties, body)
+            self._count_received()
+            return
+
+        try:
+            self._handler(method, body)()
+            ch.basic_ack(delivery_tag=method.delivery_tag)
+        except Exception as e:
+            self._fail(ch, method.delivery_tag, properties, body, e)
+        self._count_received()
+
+    def _dispatch(self, ch, method, properties, body):
+        delivery_tag = method.delivery_tag
+        connection = self.connection
+
+        try:
+            key = self.key_func(body) if self.key_func is not None else None
+        except Exception:
+            key = None
+
+        def on_done(error):
+            # ack e republicação precisam rodar na thread da conexão
+            if error is None:
+                callback = lambda: ch.basic_ack(delivery_tag=delivery_tag)
+            else:
+                callback = lambda: self._fail(ch, delivery_tag, properties, body, error)
+            try:
+                connection.add_callback_threadsafe(lambda: ch.is_open and callback()) #type: ignore
+            except Exception as e:
+                # Conexão caiu: o broker reentrega a mensagem sozinho
+                print(f"Não foi possível confirmar a mensagem: {e}")
+
+        self.dispatcher.submit(key, self._handler(method, body), on_done) #type: ignore
+
+    def _handler(self, method, body):
+        """Chamada que processa a mensagem entregue (subclasses podem passar mais contexto)"""
+        return lambda: self.on_message(body)
+
+    def _connect(self):
+        print(f"Conectando ao RabbitMQ em {self.host}:{self.port}")
+        self.connection = pika.BlockingConnection(self.connection_params)
+        self.channel = self.connection.channel()
+        self.channel.queue_declare(queue=self.queue_name, durable=True)
+        declare_dead_letter(self.channel, self.queue_name)
+        # Com confirmação do broker, o ack só sai depois que a cópia da
+        # mensagem (retry/DLQ) foi aceita
+        self.channel.confirm_delivery()
+        self.channel.basic_qos(prefetch_count=self.prefetch_count)
+        self.channel.basic_consume(queue=self.queue_name, on_message_callback=self._callback)
+
+    def start(self):
+        """Consome mensagens até `stop()` ser chamado (ou SIGINT/SIGTERM)"""
+        while not self._stopping:
+            try:
+                self._connect()
+                print(f"Aguardando mensagens da fila '{self.queue_name}' (prefetch={self.prefetch_count})...")
+                self.channel.start_consuming() #type: ignore
+                self._drain()
+            except pika.exceptions.AMQPConnectionError as e:
+                if self._stopping:
+                    break
+                print(f"Conexão perdida ({e}), reconectando em {self.reconnect_delay}s...")
+                time.sleep(self.reconnect_delay)
+            finally:
+                self._close()
+
+    def _drain(self):
+        """Espera as mensagens em andamento terminarem, enviando seus acks"""
+        if self.dispatcher is None:
+            return
+        while self.dispatcher.in_flight() > 0:
+            self.connection.process_data_events(time_limit=0.2) #type: ignore
+        # Garante que os últimos acks agendados saiam antes de fechar
+        self.connection.process_data_events(time_limit=0) #type: ignore
+
+    def _request_stop(self):
+        if self.channel is not None and self.channel.is_open:
+            self.channel.stop_consuming()
+
+    def stop(self):
+        """Encerra o consumo. Pode ser chamado de outra thread ou de um signal handler"""
+        self._stopping = True
+        if self.connection is not None and self.connection.is_open:
+            self.connection.add_callback_threadsafe(self._request_stop)
+
+    def _close(self):
+        try:
+            if self.connection is not None and self.connection.is_open:
+                self.connection.close()
+        except Exception:
+            pass
+        self.connection = None
+        self.channel = None
+
+    def install_signal_handlers(self):
+        """Faz SIGINT/SIGTERM encerrarem o consumidor de forma limpa"""
+        def _handler(signum, frame):
+            print("Sinal de parada recebido, finalizando mensagens em andamento...")
+            self.stop()
+
+        signal.signal(signal.SIGINT, _handler)
+        signal.signal(signal.SIGTERM, _handler)
+
+
 if __name__ == '__main__':
     # Uso:
     monitor_rabbitmq_queue('santa-casa', host='rabbitmq.itech360.com.br', port=5672, username='admin', password='admin')
@@ -1,102 +1,210 @@
-import requests
-import json
-from supabase import create_client, Client
+from typing import TYPE_CHECKING
+from services.supabase_client import get_supabase_client, get_async_supabase_client
+from services.lead_cache import lead_cache
+from services.single_flight import SingleFlight, AsyncSingleFlight
+from services.coalescer import BatchCoalescer, AsyncBatchCoalescer
 from services.services import generator_uuid 
+from models.models import MessageRecord
 import os
 import time
 
+if TYPE_CHECKING:
+    from supabase import Client
+
+# Janela em que consultas/criações de leads são juntadas em uma única ida ao Supabase
+LEAD_COALESCE_WAIT = float(os.getenv('LEAD_COALESCE_WAIT_MS', '5')) / 1000
+LEAD_COALESCE_MAX_BATCH = int(os.getenv('LEAD_COALESCE_MAX_BATCH', '100'))
+
+
+def _fetch_leads(telefones) -> dict:
+    """Uma consulta `in_` para vários telefones: {telefone: session_id}"""
+    supabase: "Client" = get_supabase_client()
+    response = supabase.table('clientes_cadastro').select("numero, session_id").in_('numero', telefones).execute()
+    return {str(row['numero']): row['session_id'] for row in response.data or []}
+
+
+def _insert_leads(telefones) -> dict:
+    """
+    Cria vários leads com um único upsert em `numero` e retorna o session_id
+    vencedor de cada um.
+
+    Com `ignore_duplicates` o banco não sobrescreve cadastros existentes
+    (criados por outro worker); esses não voltam no insert e o session_id já
+    gravado é lido em uma consulta só.
+    """
+    supabase: "Client" = get_supabase_client()
+    leads = [{"numero": telefone, "session_id": generator_uuid()} for telefone in telefones]
+    response = supabase.table('clientes_cadastro').upsert(
+        leads, on_conflict='numero', ignore_duplicates=True
+    ).execute()
+    created = {str(row['numero']): row['session_id'] for row in response.data or []}
+    if created:
+        print(f"Leads criados com sucesso: {list(created)}")
+
+    existing = [telefone for telefone in telefones if telefone not in created]
+    if existing:
+        # Outro processo ganhou a corrida: usa o cadastro existente
+        created.update(_fetch_leads(existing))
+    return created
+
+
+_lead_lookups = BatchCoalescer(_fetch_leads, LEAD_COALESCE_WAIT, LEAD_COALESCE_MAX_BATCH)
+_lead_inserts = BatchCoalescer(_insert_leads, LEAD_COALESCE_WAIT, LEAD_COALESCE_MAX_BATCH)
+
+
+def coalescer_stats():
+    return {"consultas": _lead_lookups.stats(), "criacoes": _lead_inserts.stats()}
+
 #Verificando a existencia do lead
-def get_lead(useful_variables: str) -> str:
-    try:
-        user_variables = json.loads(useful_variables)
-
-    except json.JSONDecodeError as e:
-        print('Erro ao tentar converter para json')
-        with open('erros', 'a')as e:
-            e.write(f'Erro ao tentar converter para json {time.time()}')
-
-        error_convertion = json.loads(useful_variables)
-        error_convertion['lead_found'] = False
-        return  error_convertion
-        
-    print(user_variables)
-    telefone = user_variables['telefone']
-    
-    # Configuração do Supabase
-    url = os.getenv("SUPABASE_URL")
-    key = os.getenv("SUPABASE_ANON_KEY")
-    supabase: Client = create_client(url, key) #type: ignore
+def get_lead(message: MessageRecord) -> MessageRecord:
+    print(f'Consultando lead {message.telefone}')
+    telefone = message.telefone
+
+    # Consulta o cache antes de ir ao Supabase
+    cached, session_id = lead_cache.get(telefone)
+    if cached:
+        message.lead_found = session_id is not None
+        if session_id is not None:
+            message.session_id = session_id
+        return message
     
     try:
-        # Fazer consulta GET na tabela 'leads'
-
-        response = supabase.table('clientes_cadastro').select("*").eq('numero', f'{telefone}').execute()
-        if response.data:
-            user_variables['lead_found'] = True
-            
-            user_variables['session_id'] = response.data[0]['session_id']
-            return json.dumps(user_variables)
+        # Consulta junto com os outros telefones que chegaram na mesma janela
+        session_id = _lead_lookups.get(str(telefone))
+        if session_id is not None:
+            message.lead_found = True
+            message.session_id = session_id
+            lead_cache.set(telefone, message.session_id)
+            return message
 
         else:
-            user_variables['lead_found'] = False
-            return json.dumps(user_variables)
-
+            message.lead_found = False
+            lead_cache.set_missing(telefone)
+            return message
 
-            
     except Exception as e:
-        
+        # Sem resposta do Supabase não dá para saber se o lead existe: a
+        # mensagem falha e volta pela fila de retry
         print(f"Erro ao consultar Supabase: {e}")
-        user_variables['lead_found'] = False
-
-        with open('erros', 'a')as e:
-            e.write(f'Erro ao tentar buscar lead no supabase{time.time()}')
-        return json.dumps(user_variables)
+        with open('erros', 'a') as f:
+            f.write(f'Erro ao tentar buscar lead no supabase {time.time()}: {str(e)}\n')
+        raise
     
 
+# Uma única criação em andamento por telefone neste processo
+_create_flight = SingleFlight()
+
+
+def _upsert_lead(telefone) -> str:
+    """Cria o lead (em lote com as outras criações da janela) e retorna o session_id vencedor"""
+    cached, session_id = lead_cache.get(telefone)
+    if cached and session_id is not None:
+        return session_id
+
+    session_id = _lead_inserts.get(str(telefone))
+    if session_id is None:
+        raise RuntimeError(f"Lead {telefone} não foi criado nem encontrado")
+
+    lead_cache.set(telefone, session_id)
+    return session_id
+
+
 # Criar novo lead no Supabase
-def create_lead_db(useful_variables: str) -> str:
+def create_lead_db(message: MessageRecord) -> MessageRecord:
+    print(f"Criando lead {message.telefone}")
+    telefone = message.telefone
+    
     try:
-        user_variables = json.loads(useful_variables)
-    except json.JSONDecodeError as e:
-        print('Erro ao tentar converter para json')
+        message.session_id = _create_flight.do(telefone, lambda: _upsert_lead(telefone))
+        message.lead_created = True
+        return message
+            
+    except Exception as e:
+        # Sem session_id a mensagem não pode ser acumulada: falha e volta pela fila de retry
+        print(f"Erro ao criar lead no Supabase: {e}")
         with open('erros', 'a') as f:
-            f.write(f'Erro ao tentar converter para json {time.time()}\n')
-        return json.dumps({"error": "JSON decode error", "lead_created": False})
-        
-    print(f"Criando lead com dados: {user_variables}")
-    telefone = user_variables.get('telefone')
-    
-    # Configuração do Supabase
-    url = os.getenv("SUPABASE_URL")
-    key = os.getenv("SUPABASE_ANON_KEY")
-    supabase: Client = create_client(url, key) #type: ignore
-    
-    # Gerar session_id único para o novo lead
-    session_id = generator_uuid()
-    
+            f.write(f'Erro ao tentar criar lead no supabase {time.time()}: {str(e)}\n')
+        raise
+
+
+# Versões assíncronas (pipeline asyncio): mesma lógica, com o cliente AsyncClient
+async def _afetch_leads(telefones) -> dict:
+    supabase = await get_async_supabase_client()
+    response = await supabase.table('clientes_cadastro').select("numero, session_id").in_('numero', telefones).execute()
+    return {str(row['numero']): row['session_id'] for row in response.data or []}
+
+
+async def _ainsert_leads(telefones) -> dict:
+    supabase = await get_async_supabase_client()
+    leads = [{"numero": telefone, "session_id": generator_uuid()} for telefone in telefones]
+    response = await supabase.table('clientes_cadastro').upsert(
+        leads, on_conflict='numero', ignore_duplicates=True
+    ).execute()
+    created = {str(row['numero']): row['session_id'] for row in response.data or []}
+
+    existing = [telefone for telefone in telefones if telefone not in created]
+    if existing:
+        created.update(await _afetch_leads(existing))
+    return created
+
+
+_async_lead_lookups = AsyncBatchCoalescer(_afetch_leads, LEAD_COALESCE_WAIT, LEAD_COALESCE_MAX_BATCH)
+_async_lead_inserts = AsyncBatchCoalescer(_ainsert_leads, LEAD_COALESCE_WAIT, LEAD_COALESCE_MAX_BATCH)
+
+
+async def aget_lead(message: MessageRecord) -> MessageRecord:
+    telefone = message.telefone
+
+    cached, session_id = lead_cache.get(telefone)
+    if cached:
+        message.lead_found = session_id is not None
+        if session_id is not None:
+            message.session_id = session_id
+        return message
+
     try:
-        # Dados para inserir na tabela clientes_cadastro
-        lead_data = {
-            "numero": telefone,
-            "session_id": session_id
-        }
-        
-        # Inserir lead na tabela clientes_cadastro
-        response = supabase.table('clientes_cadastro').insert(lead_data).execute()
-        
-        if response.data:
-            print(f"Lead criado com sucesso: {response.data}")
-            user_variables['lead_created'] = True
-            user_variables['session_id'] = session_id
-            return json.dumps(user_variables)
+        session_id = await _async_lead_lookups.get(str(telefone))
+        if session_id is not None:
+            message.lead_found = True
+            message.session_id = session_id
+            lead_cache.set(telefone, message.session_id)
         else:
-            print("Erro ao criar lead - resposta vazia")
-            user_variables['lead_created'] = False
-            return json.dumps(user_variables)
-            
+            message.lead_found = False
+            lead_cache.set_missing(telefone)
+        return message
+
+    except Exception as e:
+        print(f"Erro ao consultar Supabase: {e}")
+        with open('erros', 'a') as f:
+            f.write(f'Erro ao tentar buscar lead no supabase {time.time()}: {str(e)}\n')
+        raise
+
+
+_async_create_flight = AsyncSingleFlight()
+
+
+async def _aupsert_lead(telefone) -> str:
+    cached, session_id = lead_cache.get(telefone)
+    if cached and session_id is not None:
+        return session_id
+
+    session_id = await _async_lead_inserts.get(str(telefone))
+    if session_id is None:
+        raise RuntimeError(f"Lead {telefone} não foi criado nem encontrado")
+
+    lead_cache.set(telefone, session_id)
+    return session_id
+
+
+async def acreate_lead_db(message: MessageRecord) -> MessageRecord:
+    telefone = message.telefone
+    try:
+        message.session_id = await _async_create_flight.do(telefone, lambda: _aupsert_lead(telefone))
+        message.lead_created = True
+        return message
+
     except Exception as e:
         print(f"Erro ao criar lead no Supabase: {e}")
-        user_variables['lead_created'] = False
         with open('erros', 'a') as f:
             f.write(f'Erro ao tentar criar lead no supabase {time.time()}: {str(e)}\n')
-        return json.dumps(user_variables)
+        raise
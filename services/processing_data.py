@@ -1,54 +1,105 @@
 from services.monitore_queues import monitor_rabbitmq_queue
+from models.models import MessageRecord, MediaPayload, TIPO_TEXTO, TIPO_AUDIO, TIPO_IMAGEM
 import json
+import os
+import re
 import traceback
 
+# Campo com a mídia em base64 dentro do webhook ("base64": "....")
+_BASE64_FIELD = re.compile(rb'"base64"\s*:\s*"')
+
+# Mídias maiores que isso (bytes decodificados) vão para um arquivo temporário
+MEDIA_SPILL_THRESHOLD = int(os.getenv("MEDIA_SPILL_THRESHOLD", str(8 * 1024 * 1024)))
+
+
+def _split_media(body: bytes):
+    """
+    Separa o valor do campo "base64" do restante do JSON sem decodificá-lo.
+
+    Retorna (json_sem_midia, memoryview_do_base64). O JSON restante é pequeno
+    e pode ser lido com json.loads; a mídia continua apontando para o corpo
+    original da mensagem.
+    """
+    match = _BASE64_FIELD.search(body)
+    if match is None:
+        return body, None
+
+    start = match.end()
+    end = body.find(b'"', start)
+    if end == -1:
+        return body, None
+
+    media = memoryview(body)[start:end]
+    if body.find(b'\\', start, end) != -1:
+        # Base64 com escapes JSON (ex.: "\/" ou "\n"): caminho lento, raro
+        media = memoryview(json.loads(b'"' + media.tobytes() + b'"').encode('ascii'))
+
+    return body[:start] + body[end:], media
+
 
 class ProcessingFile():
 
-    def __init__(self, body :str) :
-        self.body = body 
+    def __init__(self, body) :
+        # Aceita o corpo cru da fila (bytes) ou já decodificado (str)
+        self.body = body.encode('utf-8') if isinstance(body, str) else body
 
 
 
-    def get_variable(self):
-        useful_variables = {}
+    def get_message(self):
+        """Interpreta o webhook uma única vez e devolve um MessageRecord (ou None)"""
         try:
-            object_webhook = json.loads(self.body)
-        except json.JSONDecodeError as e:
+            webhook_json, media_view = _split_media(self.body)
+            object_webhook = json.loads(webhook_json)
+        except (json.JSONDecodeError, UnicodeDecodeError) as e:
             print(f'Erro ao converter arquivo json: {e}')
             return None
         
         try: 
-            conversation = object_webhook['body']['data']["message"].get("conversation")
-            audio_message = object_webhook['body']['data']["message"].get("audioMessage")
+            data = object_webhook['body']['data']
+            conversation = data["message"].get("conversation")
+            audio_message = data["message"].get("audioMessage")
             if conversation is not None:
-                useful_variables = {
-                    'mensagem_text': True,
-                    'telefone': object_webhook['body']['data']['key']['remoteJid'],
-                    'chatwoot_id':object_webhook['body']['data']['chatwootConversationId'],
-                    'mensagem' : object_webhook['body']['data']["message"]["conversation"],
-                    'fromMe' :  object_webhook['body']['data']['key']['fromMe']
-                }
+                tipo = TIPO_TEXTO
             elif audio_message is not None: 
-                useful_variables = {
-                    'mensagem_audio': True,
-                    'telefone': object_webhook['body']['data']['key']['remoteJid'],
-                    'chatwoot_id':object_webhook['body']['data']['chatwootConversationId'],
-                    'mensagem' : object_webhook['body']['data']["message"]["base64"],
-                    'fromMe' :  object_webhook['body']['data']['key']['fromMe']
-                    }
+                tipo = TIPO_AUDIO
             else :
-                useful_variables = {
-                    'mensagem_Imagem': True,
-                    'telefone': object_webhook['body']['data']['key']['remoteJid'],
-                    'chatwoot_id':object_webhook['body']['data']['chatwootConversationId'],
-                    'mensagem' : object_webhook['body']['data']["message"]["base64"],
-                    'fromMe' :  object_webhook['body']['data']['key']['fromMe']
-                    }
+                tipo = TIPO_IMAGEM
 
+            media = None
+            if tipo != TIPO_TEXTO:
+                if media_view is None:
+                    raise KeyError('base64')
+                # A mídia fica por referência: nenhuma cópia em str
+                media = MediaPayload(media_view)
+                if media.size > MEDIA_SPILL_THRESHOLD:
+                    media.spill()
+
+            return MessageRecord(
+                telefone=data['key']['remoteJid'],
+                chatwoot_id=data['chatwootConversationId'],
+                fromMe=data['key']['fromMe'],
+                tipo=tipo,
+                mensagem=conversation if tipo == TIPO_TEXTO else None,
+                media=media,
+            )
 
         except Exception as e:
             print('Deu erro ',e)
             traceback.print_exc()
+            return None
+
+    def get_variable(self):
+        """Formato JSON legado de `get_message`"""
+        message = self.get_message()
+        return json.dumps(message.to_dict() if message is not None else {})
+
 
-        return json.dumps(useful_variables)
+def extract_session_key(body):
+    """Retorna o remoteJid (telefone) da mensagem, usado para ordenar o processamento por sessão"""
+    try:
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        webhook_json, _ = _split_media(body)
+        return json.loads(webhook_json)['body']['data']['key']['remoteJid']
+    except (json.JSONDecodeError, UnicodeDecodeError, KeyError, TypeError):
+        return None
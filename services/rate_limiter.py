@@ -0,0 +1,234 @@
+import asyncio
+import os
+import random
+import threading
+import time
+from typing import Awaitable, Callable, Dict, Optional, TypeVar
+from dotenv import load_dotenv
+
+load_dotenv()
+
+T = TypeVar('T')
+
+# Limites padrão por modelo: (requisições/minuto, tokens/minuto). None = sem limite
+DEFAULT_LIMITS = {
+    'gpt-4o': (500, 30000),
+    'gpt-4o-mini': (500, 200000),
+    'whisper-1': (50, None),
+}
+
+_retryable_errors = None
+
+
+def retryable_errors() -> tuple:
+    """
+    Erros que valem nova tentativa; o resto (chave inválida, payload ruim...)
+    falha na hora. O openai só é importado na primeira chamada.
+    """
+    global _retryable_errors
+    if _retryable_errors is None:
+        import openai
+        _retryable_errors = (
+            openai.RateLimitError,
+            openai.APIConnectionError,
+            openai.APITimeoutError,
+            openai.InternalServerError,
+        )
+    return _retryable_errors
+
+
+def _is_rate_limit(error: Exception) -> bool:
+    # O primeiro da tupla é o openai.RateLimitError
+    return isinstance(error, retryable_errors()[0])
+
+
+class TokenBucket():
+    """Balde de tokens com reposição contínua; `acquire` espera até haver saldo"""
+
+    def __init__(self, capacity: float, refill_per_second: float):
+        self.capacity = capacity
+        self.refill_per_second = refill_per_second
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._cond = threading.Condition()
+
+    def _refill(self, now: float):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.refill_per_second)
+        self._updated = now
+
+    def acquire(self, amount: float = 1) -> float:
+        """Consome `amount` tokens, esperando o necessário. Retorna o tempo esperado"""
+        amount = min(amount, self.capacity)
+        started = time.monotonic()
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                wait = self._blocked_until - now
+                if wait <= 0 and self._tokens >= amount:
+                    self._tokens -= amount
+                    return now - started
+                if wait <= 0:
+                    wait = (amount - self._tokens) / self.refill_per_second
+                self._cond.wait(timeout=wait)
+
+    def try_acquire(self, amount: float = 1) -> float:
+        """
+        Versão sem bloqueio (para asyncio): consome e retorna 0 se houver
+        saldo; senão retorna quantos segundos esperar antes de tentar de novo
+        """
+        amount = min(amount, self.capacity)
+        with self._cond:
+            now = time.monotonic()
+            self._refill(now)
+            wait = self._blocked_until - now
+            if wait > 0:
+                return wait
+            if self._tokens >= amount:
+                self._tokens -= amount
+                return 0.0
+            return (amount - self._tokens) / self.refill_per_second
+
+    def pause(self, seconds: float):
+        """Bloqueia o balde por `seconds` (ex.: após um 429 com Retry-After)"""
+        with self._cond:
+            self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+
+
+class ModelLimiter():
+    """Baldes de requisições e de tokens por minuto de um modelo"""
+
+    def __init__(self, rpm: Optional[int], tpm: Optional[int]):
+        self.requests = TokenBucket(rpm, rpm / 60) if rpm else None
+        self.tokens = TokenBucket(tpm, tpm / 60) if tpm else None
+
+    def acquire(self, estimated_tokens: int = 0) -> float:
+        waited = 0.0
+        if self.requests is not None:
+            waited += self.requests.acquire(1)
+        if self.tokens is not None and estimated_tokens:
+            waited += self.tokens.acquire(estimated_tokens)
+        return waited
+
+    async def acquire_async(self, estimated_tokens: int = 0) -> float:
+        """Igual a `acquire`, mas espera com asyncio.sleep sem bloquear o loop"""
+        waited = 0.0
+        for bucket, amount in ((self.requests, 1), (self.tokens, estimated_tokens)):
+            if bucket is None or not amount:
+                continue
+            while True:
+                wait = bucket.try_acquire(amount)
+                if wait <= 0:
+                    break
+                waited += wait
+                await asyncio.sleep(wait)
+        return waited
+
+    def pause(self, seconds: float):
+        for bucket in (self.requests, self.tokens):
+            if bucket is not None:
+                bucket.pause(seconds)
+
+
+class RateLimiter():
+    """Limitador compartilhado do processo, com um ModelLimiter por modelo"""
+
+    def __init__(self, limits: Optional[Dict[str, tuple]] = None):
+        self._limits = dict(limits or DEFAULT_LIMITS)
+        self._models: Dict[str, ModelLimiter] = {}
+        self._lock = threading.Lock()
+
+    def _env_limits(self, model: str):
+        rpm, tpm = self._limits.get(model, (None, None))
+        suffix = model.upper().replace('-', '_').replace('.', '_')
+        rpm = int(os.getenv(f'OPENAI_RPM_{suffix}', rpm or 0)) or None
+        tpm = int(os.getenv(f'OPENAI_TPM_{suffix}', tpm or 0)) or None
+        return rpm, tpm
+
+    def for_model(self, model: str) -> ModelLimiter:
+        with self._lock:
+            limiter = self._models.get(model)
+            if limiter is None:
+                limiter = ModelLimiter(*self._env_limits(model))
+                self._models[model] = limiter
+            return limiter
+
+
+rate_limiter = RateLimiter()
+
+
+def _retry_after(error: Exception) -> Optional[float]:
+    """Lê Retry-After (ou retry-after-ms) da resposta de erro da OpenAI"""
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None)
+    if not headers:
+        return None
+    try:
+        if headers.get('retry-after-ms'):
+            return float(headers['retry-after-ms']) / 1000
+        if headers.get('retry-after'):
+            return float(headers['retry-after'])
+    except ValueError:
+        pass
+    return None
+
+
+def call_with_retry(model: str, fn: Callable[[], T], estimated_tokens: int = 0,
+                    max_retries: int = int(os.getenv('OPENAI_MAX_RETRIES', '6')),
+                    base_delay: float = 1.0, max_delay: float = 60.0) -> T:
+    """
+    Executa `fn` respeitando o limite do modelo e refaz a chamada em erros
+    transitórios, com backoff exponencial com jitter. Um 429 com Retry-After
+    pausa o balde do modelo inteiro, segurando também as outras chamadas.
+    """
+    limiter = rate_limiter.for_model(model)
+    attempt = 0
+    while True:
+        limiter.acquire(estimated_tokens)
+        try:
+            return fn()
+        except Exception as e:
+            if not isinstance(e, retryable_errors()) or attempt >= max_retries:
+                raise
+
+            delay = _retry_after(e)
+            if delay is None:
+                # Backoff exponencial com jitter ("full jitter")
+                delay = random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+            if _is_rate_limit(e):
+                limiter.pause(delay)
+
+            attempt += 1
+            print(f"[{model}] {type(e).__name__}, nova tentativa {attempt}/{max_retries} em {delay:.1f}s")
+            time.sleep(delay)
+
+
+async def acall_with_retry(model: str, fn: Callable[[], Awaitable[T]], estimated_tokens: int = 0,
+                           max_retries: int = int(os.getenv('OPENAI_MAX_RETRIES', '6')),
+                           base_delay: float = 1.0, max_delay: float = 60.0) -> T:
+    """Versão asyncio do call_with_retry; `fn` devolve uma corrotina nova a cada tentativa"""
+    limiter = rate_limiter.for_model(model)
+    attempt = 0
+    while True:
+        await limiter.acquire_async(estimated_tokens)
+        try:
+            return await fn()
+        except Exception as e:
+            if not isinstance(e, retryable_errors()) or attempt >= max_retries:
+                raise
+
+            delay = _retry_after(e)
+            if delay is None:
+                delay = random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+            if _is_rate_limit(e):
+                limiter.pause(delay)
+
+            attempt += 1
+            print(f"[{model}] {type(e).__name__}, nova tentativa {attempt}/{max_retries} em {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+
+def estimate_tokens(text: str) -> int:
+    """Estimativa grosseira de tokens (~4 caracteres por token)"""
+    return len(text) // 4 + 1
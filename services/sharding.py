@@ -0,0 +1,234 @@
+import functools
+import hashlib
+import json
+import os
+import socket
+import time
+import uuid
+import pika
+from dotenv import load_dotenv
+from services.monitore_queues import RabbitMQConsumer, copy_properties, declare_dead_letter
+
+load_dotenv()
+
+# Número de shards (filas) em que a fila principal é dividida. Deve ser o
+# mesmo em todos os nós e bem maior que o número de workers
+RABBITMQ_SHARDS = int(os.getenv('RABBITMQ_SHARDS', '16'))
+# Publica via exchange x-consistent-hash (plugin rabbitmq_consistent_hash_exchange)
+# em vez de escolher a fila do shard no roteador
+RABBITMQ_CONSISTENT_HASH = os.getenv('RABBITMQ_CONSISTENT_HASH', '0') == '1'
+# Intervalo dos heartbeats de membros; um membro some após 3 intervalos sem sinal
+SHARD_HEARTBEAT_INTERVAL = float(os.getenv('SHARD_HEARTBEAT_INTERVAL', '5'))
+# Espera antes de assumir um shard novo, para o dono anterior terminar as mensagens em andamento
+SHARD_HANDOFF_GRACE = float(os.getenv('SHARD_HANDOFF_GRACE', '15'))
+
+
+def _hash(value: str) -> int:
+    # Hash estável entre processos e máquinas (o hash() do Python muda a cada execução)
+    return int.from_bytes(hashlib.sha1(value.encode('utf-8')).digest()[:8], 'big')
+
+
+def shard_for(key, shards: int = RABBITMQ_SHARDS) -> int:
+    """Shard de um remoteJid. Mensagens sem chave vão para o shard 0"""
+    if key is None:
+        return 0
+    return _hash(str(key)) % shards
+
+
+def shard_queue_name(queue_name: str, shard: int) -> str:
+    return f'{queue_name}.shard.{shard}'
+
+
+def shard_exchange_name(queue_name: str) -> str:
+    return f'{queue_name}.shards'
+
+
+def assign_shards(members, shards: int = RABBITMQ_SHARDS):
+    """
+    Dono de cada shard por rendezvous hashing (maior hash de membro+shard).
+    Quando um membro entra ou sai, só os shards dele mudam de dono.
+    """
+    members = sorted(members)
+    if not members:
+        return {}
+    return {shard: max(members, key=lambda m: _hash(f'{m}:{shard}')) for shard in range(shards)}
+
+
+def declare_shards(channel, queue_name: str, shards: int = RABBITMQ_SHARDS):
+    """
+    Declara as filas de shard. Com `x-single-active-consumer` o broker entrega
+    cada fila a um consumidor por vez: mesmo se dois nós acharem que são donos
+    do mesmo shard durante um rebalanceamento, a ordem é preservada.
+    """
+    if RABBITMQ_CONSISTENT_HASH:
+        channel.exchange_declare(exchange=shard_exchange_name(queue_name), exchange_type='x-consistent-hash', durable=True)
+    for shard in range(shards):
+        name = shard_queue_name(queue_name, shard)
+        channel.queue_declare(queue=name, durable=True, arguments={'x-single-active-consumer': True})
+        if RABBITMQ_CONSISTENT_HASH:
+            # Peso 1 para todas as filas
+            channel.queue_bind(queue=name, exchange=shard_exchange_name(queue_name), routing_key='1')
+
+
+class ShardRouter(RabbitMQConsumer):
+    """
+    Substituto local de um publicador com consistent hashing: lê a fila
+    principal (onde o webhook publica) e republica cada mensagem na fila do
+    shard do remoteJid. Rode um único roteador para manter a ordem por
+    telefone; as retentativas (fila de retry) também voltam por ele.
+    """
+
+    def __init__(self, queue_name, key_func, shards: int = RABBITMQ_SHARDS, **kwargs):
+        super().__init__(queue_name, on_message=None, **kwargs)
+        self.key_func = key_func
+        self.shards = shards
+
+    def _connect(self):
+        super()._connect()
+        declare_shards(self.channel, self.queue_name, self.shards)
+
+    def _callback(self, ch, method, properties, body):
+        try:
+            key = self.key_func(body)
+        except Exception:
+            key = None
+        try:
+            if RABBITMQ_CONSISTENT_HASH:
+                ch.basic_publish(exchange=shard_exchange_name(self.queue_name), routing_key=str(key or ''), body=body,
+                                 properties=copy_properties(properties, properties.headers))
+            else:
+                ch.basic_publish(exchange='', routing_key=shard_queue_name(self.queue_name, shard_for(key, self.shards)),
+                                 body=body, properties=copy_properties(properties, properties.headers))
+            ch.basic_ack(delivery_tag=method.delivery_tag)
+        except Exception as e:
+            self._fail(ch, method.delivery_tag, properties, body, e)
+
+
+class ShardedConsumer(RabbitMQConsumer):
+    """
+    Worker de um grupo de nós: consome só as filas dos shards que possui e
+    chama `on_message(body, shard)` com o shard da fila que entregou a
+    mensagem (com x-consistent-hash ele não sai de `shard_for`).
+
+    Os nós trocam heartbeats por uma exchange fanout; cada um calcula a
+    mesma divisão (rendezvous hashing) a partir dos membros vivos. Ao perder
+    um shard o nó cancela o consumo e chama `on_shards_released` (o worker
+    fecha os batches abertos); ao ganhar um, espera SHARD_HANDOFF_GRACE
+    antes de consumir, tempo para o dono anterior terminar o que já recebeu.
+    Falhas seguem a política de retry/DLQ da fila principal.
+    """
+
+    def __init__(self, queue_name, on_message, shards: int = RABBITMQ_SHARDS, worker_id=None,
+                 heartbeat_interval: float = SHARD_HEARTBEAT_INTERVAL, handoff_grace: float = SHARD_HANDOFF_GRACE,
+                 on_shards_released=None, **kwargs):
+        super().__init__(queue_name, on_message, **kwargs)
+        self.shards = shards
+        self.worker_id = worker_id or f'{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}'
+        self.heartbeat_interval = heartbeat_interval
+        self.handoff_grace = handoff_grace
+        self.on_shards_released = on_shards_released
+        self.membership_exchange = f'{queue_name}.membership'
+        self._members = {}        # worker_id -> último heartbeat (monotonic)
+        self._consumers = {}      # shard -> consumer_tag
+        self._shard_by_tag = {}   # consumer_tag -> shard (inclusive de shards já liberados)
+        self._pending = {}        # shard -> horário a partir do qual pode consumir
+
+    # Membros
+    def _publish_presence(self, event='heartbeat'):
+        self.channel.basic_publish( #type: ignore
+            exchange=self.membership_exchange, routing_key='',
+            body=json.dumps({"worker_id": self.worker_id, "event": event}).encode('utf-8')
+        )
+
+    def _on_membership(self, ch, method, properties, body):
+        try:
+            data = json.loads(body)
+        except ValueError:
+            return
+        if data.get("event") == "leave":
+            self._members.pop(data.get("worker_id"), None)
+            self._rebalance()
+        else:
+            self._members[data.get("worker_id")] = time.monotonic()
+
+    def _alive_members(self):
+        limit = time.monotonic() - 3 * self.heartbeat_interval
+        self._members = {m: seen for m, seen in self._members.items() if seen >= limit}
+        self._members[self.worker_id] = time.monotonic()
+        return list(self._members)
+
+    def _tick(self):
+        if self._stopping or self.connection is None or not self.connection.is_open:
+            return
+        self._publish_presence()
+        self._rebalance()
+        self.connection.call_later(self.heartbeat_interval, self._tick)
+
+    # Shards
+    def owned_shards(self):
+        return sorted(self._consumers)
+
+    def _rebalance(self):
+        assignment = assign_shards(self._alive_members(), self.shards)
+        mine = {shard for shard, owner in assignment.items() if owner == self.worker_id}
+
+        released = [shard for shard in self._consumers if shard not in mine]
+        for shard in released:
+            self.channel.basic_cancel(self._consumers.pop(shard)) #type: ignore
+        for shard in list(self._pending):
+            if shard not in mine:
+                del self._pending[shard]
+        if released:
+            print(f"[{self.worker_id}] shards liberados: {released}")
+            if self.on_shards_released is not None:
+                try:
+                    self.on_shards_released(released)
+                except Exception as e:
+                    print(f"Erro ao liberar shards: {e}")
+
+        now = time.monotonic()
+        for shard in mine:
+            if shard in self._consumers:
+                continue
+            start_at = self._pending.setdefault(shard, now + self.handoff_grace)
+            if now >= start_at:
+                del self._pending[shard]
+                tag = self.channel.basic_consume( #type: ignore
+                    queue=shard_queue_name(self.queue_name, shard), on_message_callback=self._callback
+                )
+                self._consumers[shard] = tag
+                self._shard_by_tag[tag] = shard
+                print(f"[{self.worker_id}] consumindo shard {shard}")
+
+    def _handler(self, method, body):
+        shard = self._shard_by_tag.get(method.consumer_tag)
+        return functools.partial(self.on_message, body, shard)
+
+    def _connect(self):
+        print(f"Conectando ao RabbitMQ em {self.host}:{self.port} (worker {self.worker_id})")
+        self.connection = pika.BlockingConnection(self.connection_params)
+        self.channel = self.connection.channel()
+        self.channel.queue_declare(queue=self.queue_name, durable=True)
+        declare_dead_letter(self.channel, self.queue_name)
+        declare_shards(self.channel, self.queue_name, self.shards)
+        self.channel.confirm_delivery()
+        self.channel.basic_qos(prefetch_count=self.prefetch_count)
+
+        self.channel.exchange_declare(exchange=self.membership_exchange, exchange_type='fanout', durable=False)
+        membership = self.channel.queue_declare(queue='', exclusive=True, auto_delete=True).method.queue
+        self.channel.queue_bind(queue=membership, exchange=self.membership_exchange)
+        self.channel.basic_consume(queue=membership, on_message_callback=self._on_membership, auto_ack=True)
+
+        # Nova conexão: os consumos antigos morreram com a anterior
+        self._consumers = {}
+        self._pending = {}
+        # No primeiro ciclo só anuncia presença; a divisão sai depois de ouvir os outros
+        self._publish_presence()
+        self.connection.call_later(self.heartbeat_interval, self._tick)
+
+    def _request_stop(self):
+        try:
+            self._publish_presence('leave')
+        except Exception:
+            pass
+        super()._request_stop()
@@ -0,0 +1,74 @@
+import asyncio
+import threading
+
+
+class _Call():
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight():
+    """
+    Garante uma única execução em andamento por chave.
+
+    Se várias threads chamam `do(chave, fn)` ao mesmo tempo, só a primeira
+    executa `fn`; as demais esperam e recebem o mesmo resultado (ou exceção).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+
+        if not leader:
+            call.done.wait() #type: ignore
+            if call.error is not None: #type: ignore
+                raise call.error #type: ignore
+            return call.result #type: ignore
+
+        try:
+            call.result = fn() #type: ignore
+        except Exception as e:
+            call.error = e #type: ignore
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set() #type: ignore
+
+        return call.result #type: ignore
+
+
+class AsyncSingleFlight():
+    """SingleFlight para corrotinas: os concorrentes aguardam a mesma Future"""
+
+    def __init__(self):
+        self._calls = {}
+
+    async def do(self, key, fn):
+        future = self._calls.get(key)
+        if future is not None:
+            return await asyncio.shield(future)
+
+        future = asyncio.get_running_loop().create_future()
+        self._calls[key] = future
+        try:
+            result = await fn()
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            # Evita o aviso de "exception was never retrieved" sem concorrentes
+            future.exception()
+            raise
+        finally:
+            del self._calls[key]
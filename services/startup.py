@@ -0,0 +1,24 @@
+import sys
+import time
+
+# Marcos da inicialização (o primeiro é o import deste módulo, feito logo no
+# início do main.py). Para o detalhe por módulo use `python -X importtime`.
+_marks = [('inicio', time.perf_counter())]
+
+# Dependências pesadas que devem ficar fora da inicialização
+HEAVY_MODULES = ('langchain', 'langchain_openai', 'openai', 'PIL', 'supabase', 'httpx')
+
+
+def mark(name: str):
+    """Registra o fim de uma etapa da inicialização"""
+    _marks.append((name, time.perf_counter()))
+
+
+def startup_report() -> str:
+    lines = ["=== Inicialização ==="]
+    for (_, previous), (name, current) in zip(_marks, _marks[1:]):
+        lines.append(f"  {name}: {current - previous:.3f}s")
+    lines.append(f"  total: {_marks[-1][1] - _marks[0][1]:.3f}s")
+    loaded = [module for module in HEAVY_MODULES if module in sys.modules]
+    lines.append(f"  módulos pesados já carregados: {', '.join(loaded) if loaded else 'nenhum'}")
+    return "\n".join(lines)
@@ -0,0 +1,94 @@
+import asyncio
+import os
+import threading
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from supabase import Client, AsyncClient
+
+# Cliente único do processo. O httpx.Client por baixo é thread-safe e mantém
+# um pool de conexões keep-alive, então todas as threads do worker podem
+# compartilhar o mesmo cliente sem refazer TLS a cada mensagem.
+# supabase/httpx só são importados na criação do cliente.
+_client = None
+_client_lock = threading.Lock()
+
+
+def _build_client() -> "Client":
+    import httpx
+    from supabase import create_client, ClientOptions
+
+    url = os.getenv("SUPABASE_URL")
+    key = os.getenv("SUPABASE_ANON_KEY")
+    timeout = float(os.getenv("SUPABASE_TIMEOUT", "10"))
+    pool_size = int(os.getenv("SUPABASE_POOL_SIZE", os.getenv("WORKER_CONCURRENCY", "8")))
+
+    http_client = httpx.Client(
+        timeout=httpx.Timeout(timeout),
+        limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+    )
+    options = ClientOptions(
+        postgrest_client_timeout=timeout,
+        auto_refresh_token=False,
+        persist_session=False,
+        httpx_client=http_client,
+    )
+    client = create_client(url, key, options=options) #type: ignore
+    # Cria o cliente postgrest agora, dentro do lock, para não haver corrida
+    # na inicialização preguiçosa quando várias threads usam o cliente
+    client.postgrest
+    return client
+
+
+def get_supabase_client() -> "Client":
+    """Retorna o cliente Supabase compartilhado, criando na primeira chamada"""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = _build_client()
+    return _client
+
+
+def reset_supabase_client():
+    """Descarta o cliente atual (ex.: após trocar as variáveis de ambiente)"""
+    global _client
+    with _client_lock:
+        _client = None
+
+
+# Cliente assíncrono (pipeline asyncio): um por processo, no loop do worker
+_async_client = None
+_async_client_lock = None
+
+
+async def get_async_supabase_client() -> "AsyncClient":
+    """Retorna o cliente Supabase assíncrono compartilhado, criando na primeira chamada"""
+    global _async_client, _async_client_lock
+    if _async_client is not None:
+        return _async_client
+    if _async_client_lock is None:
+        _async_client_lock = asyncio.Lock()
+
+    async with _async_client_lock:
+        if _async_client is None:
+            import httpx
+            from supabase import acreate_client, AsyncClientOptions
+
+            url = os.getenv("SUPABASE_URL")
+            key = os.getenv("SUPABASE_ANON_KEY")
+            timeout = float(os.getenv("SUPABASE_TIMEOUT", "10"))
+            pool_size = int(os.getenv("SUPABASE_POOL_SIZE", os.getenv("ASYNC_CONCURRENCY", "100")))
+
+            http_client = httpx.AsyncClient(
+                timeout=httpx.Timeout(timeout),
+                limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+            )
+            options = AsyncClientOptions(
+                postgrest_client_timeout=timeout,
+                auto_refresh_token=False,
+                persist_session=False,
+                httpx_client=http_client,
+            )
+            _async_client = await acreate_client(url, key, options=options) #type: ignore
+    return _async_client
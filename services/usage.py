@@ -0,0 +1,193 @@
+import contextvars
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict, Iterable, Optional, Tuple
+from dotenv import load_dotenv
+from services.metrics import metrics
+
+load_dotenv()
+
+# Preço em USD por 1M de tokens: (entrada, entrada em cache, saída).
+# Sobrescreva com OPENAI_PRICE_<MODELO>="entrada,cache,saida"
+DEFAULT_PRICES = {
+    'gpt-4o': (2.50, 1.25, 10.00),
+    'gpt-4o-mini': (0.15, 0.075, 0.60),
+}
+
+# Sessões mantidas no relatório (as mais antigas saem primeiro)
+USAGE_MAX_SESSIONS = int(os.getenv("USAGE_MAX_SESSIONS", "10000"))
+
+# Nó do grafo e sessão a que as chamadas em andamento pertencem
+_scope = contextvars.ContextVar('usage_scope', default=(None, None))
+
+
+@contextmanager
+def usage_scope(node: Optional[str] = None, session_id: Optional[str] = None):
+    """Atribui as chamadas feitas dentro do bloco a um nó do grafo e a uma sessão"""
+    current_node, current_session = _scope.get()
+    token = _scope.set((node or current_node, session_id or current_session))
+    try:
+        yield
+    finally:
+        _scope.reset(token)
+
+
+def _price(model: str) -> Tuple[float, float, float]:
+    suffix = model.upper().replace('-', '_').replace('.', '_')
+    value = os.getenv(f'OPENAI_PRICE_{suffix}')
+    if value:
+        prices = tuple(float(p) for p in value.split(','))
+        if len(prices) == 3:
+            return prices #type: ignore
+    return DEFAULT_PRICES.get(model, (0.0, 0.0, 0.0))
+
+
+def token_usage(message) -> Tuple[int, int, int]:
+    """(entrada, entrada em cache, saída) a partir do usage_metadata de uma AIMessage"""
+    usage = getattr(message, 'usage_metadata', None) or {}
+    details = usage.get('input_token_details') or {}
+    return (
+        int(usage.get('input_tokens') or 0),
+        int(details.get('cache_read') or 0),
+        int(usage.get('output_tokens') or 0),
+    )
+
+
+class _Totals():
+    __slots__ = ('calls', 'input_tokens', 'cached_tokens', 'output_tokens', 'cost', 'latency')
+
+    def __init__(self):
+        self.calls = 0
+        self.input_tokens = 0
+        self.cached_tokens = 0
+        self.output_tokens = 0
+        self.cost = 0.0
+        self.latency = 0.0
+
+    def add(self, input_tokens, cached_tokens, output_tokens, cost, latency):
+        self.calls += 1
+        self.input_tokens += input_tokens
+        self.cached_tokens += cached_tokens
+        self.output_tokens += output_tokens
+        self.cost += cost
+        self.latency += latency
+
+    def as_dict(self):
+        return {
+            "calls": self.calls,
+            "input_tokens": self.input_tokens,
+            "cached_tokens": self.cached_tokens,
+            "output_tokens": self.output_tokens,
+            "cache_hit_ratio": round(self.cached_tokens / self.input_tokens, 3) if self.input_tokens else 0.0,
+            "cost_usd": round(self.cost, 6),
+            "avg_latency": round(self.latency / self.calls, 3) if self.calls else 0.0,
+            "total_latency": round(self.latency, 3),
+        }
+
+
+class UsageTracker():
+    """
+    Contabiliza tokens (entrada, cache e saída), custo e latência das
+    chamadas à OpenAI, agregados por modelo, por nó do grafo e por sessão.
+    """
+
+    def __init__(self, max_sessions: int = USAGE_MAX_SESSIONS):
+        self.max_sessions = max_sessions
+        self._models: Dict[str, _Totals] = {}
+        self._nodes: Dict[str, _Totals] = {}
+        self._sessions = OrderedDict()  # session_id -> _Totals
+        self._lock = threading.Lock()
+
+    def record(self, model: str, input_tokens: int = 0, cached_tokens: int = 0, output_tokens: int = 0,
+               latency: float = 0.0, node: Optional[str] = None, session_id: Optional[str] = None):
+        scope_node, scope_session = _scope.get()
+        node = node or scope_node or 'sem_no'
+        session_id = session_id or scope_session
+
+        input_price, cached_price, output_price = _price(model)
+        cost = ((input_tokens - cached_tokens) * input_price
+                + cached_tokens * cached_price
+                + output_tokens * output_price) / 1_000_000
+        values = (input_tokens, cached_tokens, output_tokens, cost, latency)
+        metrics.observe('openai_call_seconds', model, latency)
+
+        with self._lock:
+            self._models.setdefault(model, _Totals()).add(*values)
+            self._nodes.setdefault(node, _Totals()).add(*values)
+            if session_id:
+                totals = self._sessions.get(session_id)
+                if totals is None:
+                    totals = self._sessions[session_id] = _Totals()
+                    while len(self._sessions) > self.max_sessions:
+                        self._sessions.popitem(last=False)
+                else:
+                    self._sessions.move_to_end(session_id)
+                totals.add(*values)
+
+    def record_messages(self, model: str, messages: Iterable, latency: float = 0.0, **scope):
+        """Soma o uso de todas as AIMessages de uma execução (ex.: as voltas do agent)"""
+        input_tokens = cached_tokens = output_tokens = 0
+        for message in messages:
+            i, c, o = token_usage(message)
+            input_tokens += i
+            cached_tokens += c
+            output_tokens += o
+        self.record(model, input_tokens, cached_tokens, output_tokens, latency, **scope)
+
+    @contextmanager
+    def timed(self, model: str, **scope):
+        """
+        Mede a latência de uma chamada. O bloco recebe uma lista onde deve
+        colocar a(s) mensagem(ns) de resposta para a contagem de tokens.
+        """
+        responses = []
+        started = time.monotonic()
+        try:
+            yield responses
+        finally:
+            self.record_messages(model, responses, time.monotonic() - started, **scope)
+
+    def session(self, session_id: str) -> Optional[dict]:
+        with self._lock:
+            totals = self._sessions.get(session_id)
+            return totals.as_dict() if totals else None
+
+    def report(self) -> dict:
+        with self._lock:
+            return {
+                "models": {k: v.as_dict() for k, v in self._models.items()},
+                "nodes": {k: v.as_dict() for k, v in self._nodes.items()},
+                "sessions": {k: v.as_dict() for k, v in self._sessions.items()},
+            }
+
+    def format_report(self, top_sessions: int = 10) -> str:
+        report = self.report()
+        lines = ["=== Uso da OpenAI ==="]
+        for title, key in (("Por modelo", "models"), ("Por nó", "nodes")):
+            lines.append(f"{title}:")
+            for name, t in sorted(report[key].items()):
+                lines.append(
+                    f"  {name}: {t['calls']} chamadas, entrada={t['input_tokens']} "
+                    f"(cache {t['cache_hit_ratio']:.0%}), saída={t['output_tokens']}, "
+                    f"US$ {t['cost_usd']:.4f}, latência média {t['avg_latency']:.2f}s"
+                )
+        sessions = sorted(report["sessions"].items(), key=lambda item: item[1]["cost_usd"], reverse=True)
+        lines.append(f"Sessões mais caras ({len(sessions)} no total):")
+        for session_id, t in sessions[:top_sessions]:
+            lines.append(
+                f"  {session_id}: {t['calls']} chamadas, US$ {t['cost_usd']:.4f}, "
+                f"cache {t['cache_hit_ratio']:.0%}, latência total {t['total_latency']:.2f}s"
+            )
+        return "\n".join(lines)
+
+    def clear(self):
+        with self._lock:
+            self._models.clear()
+            self._nodes.clear()
+            self._sessions.clear()
+
+
+usage_tracker = UsageTracker()